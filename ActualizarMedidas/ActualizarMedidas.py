@@ -11,6 +11,8 @@
 """
 
 from .deploy import version
+from .profiling import PROFILER
+from .task_scheduler import MAX_PARALLEL, ChunkScheduler
 from pathlib import Path
 
 from qgis.gui import QgsRubberBand, QgsDockWidget, QgsExpressionBuilderWidget
@@ -66,6 +68,7 @@ from PyQt5.QtWidgets import (
     QCompleter,
     QCalendarWidget,
     QTableView,
+    QFileDialog,
     )
 
 file_path = Path(__file__)
@@ -79,10 +82,17 @@ OSMWD_TOOLS_LOG = 'Actualizar medidas'
 
 
 class PerformQueriesTask(QgsTask):
-    def __init__(self, description, queries, caller):
+    """
+    Performs the jobs in queries in a background thread, see task_scheduler for what a job looks like
+
+    Chunked jobs are split up, their chunks run up to max_parallel at a time. None of the jobs
+    of this dock has a chunk_finished, so no results are handed to the main thread along the way
+    """
+    def __init__(self, description, queries, caller, max_parallel=MAX_PARALLEL):
         super().__init__(description, QgsTask.CanCancel)
         self.queries = queries
         self.caller = caller
+        self.max_parallel = max_parallel
         self.busy = None
         self.exception = None
 
@@ -96,11 +106,22 @@ class PerformQueriesTask(QgsTask):
                                  OSMWD_TOOLS_LOG, Qgis.Info)
         self.busy = True
 
-        return True
+        scheduler = ChunkScheduler(self.setProgress, self.isCancelled, max_parallel=self.max_parallel)
+        try:
+            with PROFILER.stage('task', self.description()):
+                return scheduler.run(self.queries)
+        except Exception as e:
+            self.exception = e
+            return False
 
     def finished(self, task_result):
         self.busy = False
 
+        for query in self.queries:
+            summary = query.finished(task_result)
+            if summary:
+                QgsMessageLog.logMessage(summary, OSMWD_TOOLS_LOG, Qgis.Info)
+
         if task_result:
             pass
         else:
@@ -421,6 +442,7 @@ class ActualizarMedidasDock:
 
         self.toolbar = self.iface.addToolBar('Catastro')
         self.toolbar.setObjectName('Catastro')
+        PROFILER.log = lambda message: QgsMessageLog.logMessage(message, OSMWD_TOOLS_LOG, Qgis.Info)
 
         self.text_edit = {}
         self.line_edit = {}
@@ -483,6 +505,42 @@ class ActualizarMedidasDock:
             text=self.tr('Catastro'),
             callback=self.run,
             parent=self.iface.mainWindow())
+        self.profile_action = self.add_action(
+            icon_path,
+            text=self.tr('Profile stages'),
+            callback=self.toggle_profiling,
+            add_to_toolbar=False,
+            status_tip='Log wall time, features and memory of every stage to the "{}" log'.format(OSMWD_TOOLS_LOG),
+            parent=self.iface.mainWindow())
+        self.profile_action.setCheckable(True)
+        self.profile_action.setChecked(PROFILER.enabled)
+        self.add_action(
+            icon_path,
+            text=self.tr('Export stage timings'),
+            callback=self.export_profile,
+            add_to_toolbar=False,
+            parent=self.iface.mainWindow())
+
+    def toggle_profiling(self, checked):
+        if checked:
+            PROFILER.enable(memory=True)
+        else:
+            if PROFILER.records:
+                QgsMessageLog.logMessage('\n'.join(['Stage timings:'] + PROFILER.summary_lines()),
+                                         OSMWD_TOOLS_LOG, Qgis.Info)
+            PROFILER.disable()
+
+    def export_profile(self):
+        if not PROFILER.records:
+            QgsMessageLog.logMessage('No stage timings yet, switch on "Profile stages" first',
+                                     OSMWD_TOOLS_LOG, Qgis.Warning)
+            return
+        path, file_filter = QFileDialog.getSaveFileName(self.iface.mainWindow(), 'Export stage timings',
+                                                        'catastro_profile.json', 'JSON (*.json)')
+        if path:
+            PROFILER.to_json(path)
+            QgsMessageLog.logMessage('Wrote {} stage timings to {}'.format(len(PROFILER.records), path),
+                                     OSMWD_TOOLS_LOG, Qgis.Info)
 
     def unload(self):
         """Removes the plugin menu item and icon from QGIS GUI."""
@@ -512,7 +570,8 @@ class ActualizarMedidasDock:
 
         """
         if not self.dockwidget:
-            self.dockwidget = DockOSMWD()
+            with PROFILER.stage('widget build', 'dock'):
+                self.dockwidget = DockOSMWD()
             self.dockwidget.setWindowTitle("Gestion de Catastro EPS del Sector Saneamiento - v{}".format(VERSION))
 
         # wd_properties_file = Path(__file__).resolve().parent / 'wd properties.pickle'
@@ -568,8 +627,8 @@ class ActualizarMedidasDock:
             pass
         button.released.connect(method)
 
-    def perform_query_in_background_thread(self, task_name):
-        self.task = PerformQueriesTask(task_name, self.queries, self)
+    def perform_query_in_background_thread(self, task_name, queries):
+        self.task = PerformQueriesTask(task_name, queries, self)
         QgsApplication.taskManager().addTask(self.task)
         self.clear_selection_on_all_layers()
 
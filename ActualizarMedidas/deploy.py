@@ -58,6 +58,8 @@ deprecated=False'''
 
     try:
         for f in ["ActualizarMedidas.py",
+                  "profiling.py",
+                  "task_scheduler.py",
                   "__init__.py",
                   "metadata.txt",
                   "deploy.py",
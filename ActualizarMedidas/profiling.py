@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+ Timing of the stages of the plugin: wall time, features handled and memory delta per stage
+
+ with PROFILER.stage('layer scan', layer.name()) as stage:
+     for feature in features:
+         ...
+     stage.count(feature_count)
+
+ or, for a whole function, @PROFILER.profiled('rule compile')
+
+ It doesn't import Qt or QGIS, the dock hands it a log callable. While switched off, stage() returns
+ one shared stage that does nothing, so an instrumented stage costs a call and a with.
+ Memory deltas come from tracemalloc, which slows down every allocation, so it is only
+ traced when the profiler is enabled with memory=True.
+ Setting OSMWD_PROFILE switches the profiler on at start, OSMWD_PROFILE=memory with memory deltas
+
+ Copy of OSM_Wikidata/profiling.py, the plugins are deployed on their own. Make changes
+ there and copy the module over, tests/test_copies.py checks that they match
+"""
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+
+class NullStage:
+    """What stage() returns while the profiler is off"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def count(self, features):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage:
+    __slots__ = ('profiler', 'name', 'detail', 'features', 'started', 'memory_before')
+
+    def __init__(self, profiler, name, detail=None, features=None):
+        self.profiler = profiler
+        self.name = name
+        self.detail = detail
+        self.features = features
+        self.started = None
+        self.memory_before = None
+
+    def __enter__(self):
+        if self.profiler.memory and tracemalloc.is_tracing():
+            self.memory_before = tracemalloc.get_traced_memory()[0]
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.started
+        memory_delta = None
+        if self.memory_before is not None and tracemalloc.is_tracing():
+            memory_delta = tracemalloc.get_traced_memory()[0] - self.memory_before
+        self.profiler.add({
+            'stage': self.name,
+            'detail': self.detail,
+            'started': round(self.started - self.profiler.origin, 6),
+            'seconds': round(seconds, 6),
+            'features': self.features,
+            'memory_delta': memory_delta,
+            'thread': threading.current_thread().name,
+            'failed': exc_type is not None,
+        })
+        return False
+
+    def count(self, features):
+        """Adds to the number of features the stage handled"""
+        self.features = (self.features or 0) + features
+
+
+def describe(record):
+    """One line for the message log"""
+    text = 'Stage "{}"'.format(record['stage'])
+    if record['detail']:
+        text += ' ({})'.format(record['detail'])
+    text += ': {:.1f} ms'.format(1000 * record['seconds'])
+    if record['features'] is not None:
+        text += ', {} features'.format(record['features'])
+        if record['seconds'] > 0:
+            text += ' ({:.0f}/s)'.format(record['features'] / record['seconds'])
+    if record['memory_delta'] is not None:
+        text += ', {:+.1f} MB'.format(record['memory_delta'] / 2 ** 20)
+    if record['failed']:
+        text += ', failed'
+    return text
+
+
+class Profiler:
+    """
+    Collects a record per stage, they go to log(message) as they are done
+    and to a JSON file with to_json()
+    """
+    def __init__(self, enabled=False, memory=False, log=None):
+        self.enabled = False
+        self.memory = False
+        self.log = log
+        self.records = []
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._started_tracing = False
+        if enabled:
+            self.enable(memory)
+
+    def enable(self, memory=False):
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self.memory = False
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def stage(self, name, detail=None, features=None):
+        """
+        :param detail: e.g. the name of the layer, shown with the stage but not grouped by
+        :param features: the number of features, if known in advance, otherwise see Stage.count()
+        """
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name, detail, features)
+
+    def profiled(self, name=None):
+        """Decorator that runs the function as a stage, named after the function unless name is given"""
+        def decorator(function):
+            stage_name = name or function.__qualname__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with Stage(self, stage_name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+        if self.log is not None:
+            self.log(describe(record))
+
+    def summary(self):
+        """:returns: dict of stage: calls, total and longest seconds, features and memory delta over all its records"""
+        with self._lock:
+            records = list(self.records)
+        totals = {}
+        for record in records:
+            total = totals.setdefault(record['stage'], {'calls': 0, 'seconds': 0.0, 'longest': 0.0,
+                                                        'features': None, 'memory_delta': None})
+            total['calls'] += 1
+            total['seconds'] += record['seconds']
+            total['longest'] = max(total['longest'], record['seconds'])
+            for key in ('features', 'memory_delta'):
+                if record[key] is not None:
+                    total[key] = (total[key] or 0) + record[key]
+        return totals
+
+    def summary_lines(self):
+        lines = []
+        for name, total in sorted(self.summary().items(), key=lambda item: -item[1]['seconds']):
+            line = '{}: {} x, {:.1f} ms, longest {:.1f} ms'.format(name, total['calls'], 1000 * total['seconds'],
+                                                                 1000 * total['longest'])
+            if total['features'] is not None:
+                line += ', {} features'.format(total['features'])
+            if total['memory_delta'] is not None:
+                line += ', {:+.1f} MB'.format(total['memory_delta'] / 2 ** 20)
+            lines.append(line)
+        return lines
+
+    def to_json(self, path):
+        with self._lock:
+            records = list(self.records)
+        with open(path, 'w', encoding='utf-8') as handle:
+            json.dump({'records': records, 'summary': self.summary()}, handle, indent=1)
+
+    def reset(self):
+        with self._lock:
+            self.records = []
+        self.origin = time.perf_counter()
+
+
+PROFILER = Profiler(enabled=bool(os.environ.get('OSMWD_PROFILE')), memory=os.environ.get('OSMWD_PROFILE') == 'memory')
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+ Runs the jobs of a task, splitting the chunked ones up and running their chunks
+ up to max_parallel at a time
+
+ It doesn't import Qt or QGIS. PerformQueriesTask hands it setProgress and isCancelled of the task
+ and a deliver callback that emits a signal, so results reach the jobs in the main thread.
+
+ A job is either a plain one, with run(task) returning whether it completed, or a chunked one:
+
+   chunks()                   list of the pieces of work, called in the background thread first,
+                              or for a job that isn't parallel a generator, read one chunk at a time
+   chunk_count()              optional, how many chunks a generator is going to yield, for the progress
+   run_chunk(chunk, task)     does one piece and returns its result, for a job with parallel = True
+                              this runs in several threads at once
+   collect(chunk, result)     optional, gets the results one at a time and in the order of chunks(),
+                              still in the background thread
+   chunk_finished(result)     optional, gets every result in the main thread
+
+ Either way finished(task_result) is invoked in the main thread at the end, as before
+
+ Copy of OSM_Wikidata/task_scheduler.py, the plugins are deployed on their own. Make changes
+ there and copy the module over, tests/test_copies.py checks that they match
+"""
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# chunks of a parallel job that run at the same time
+MAX_PARALLEL = min(4, os.cpu_count() or 1)
+
+
+class JobProgress:
+    """
+    What a job gets to see of the task: isCancelled() of the task, and a setProgress()
+    that maps the 0-100 of the job onto its share of the task
+    """
+    def __init__(self, report, cancelled, start=0.0, share=100.0):
+        self.report = report
+        self.cancelled = cancelled
+        self.start = start
+        self.share = share
+
+    def setProgress(self, percentage):
+        self.report(self.start + self.share * percentage / 100.0)
+
+    def isCancelled(self):
+        return self.cancelled()
+
+
+class ChunkScheduler:
+    """
+    scheduler = ChunkScheduler(task.setProgress, task.isCancelled, deliver)
+    scheduler.run(jobs) runs the jobs one after the other and returns whether all of them completed
+
+    deliver(job, result) is called for every result of a chunked job that has chunk_finished,
+    from the thread the scheduler runs in
+    """
+    def __init__(self, report, cancelled, deliver=None, max_parallel=MAX_PARALLEL):
+        self.report = report
+        self.cancelled = cancelled
+        self.deliver = deliver
+        self.max_parallel = max(1, max_parallel)
+
+    def run(self, jobs):
+        jobs = list(jobs)
+        for number, job in enumerate(jobs):
+            if self.cancelled():
+                return False
+            progress = JobProgress(self.report, self.cancelled, 100.0 * number / len(jobs), 100.0 / len(jobs))
+            if hasattr(job, 'chunks'):
+                completed = self.run_chunks(job, progress)
+            else:
+                completed = job.run(progress)
+            if not completed:
+                return False
+        self.report(100.0)
+        return True
+
+    def _done(self, job, chunk, result):
+        if hasattr(job, 'collect'):
+            job.collect(chunk, result)
+        if self.deliver is not None and hasattr(job, 'chunk_finished'):
+            self.deliver(job, result)
+
+    def run_chunks(self, job, progress):
+        chunks = job.chunks()
+        if not getattr(job, 'parallel', False) or self.max_parallel == 1:
+            if hasattr(chunks, '__len__'):
+                total = len(chunks)
+            else:
+                total = job.chunk_count() if hasattr(job, 'chunk_count') else None
+            for number, chunk in enumerate(chunks, 1):
+                if progress.isCancelled():
+                    return False
+                self._done(job, chunk, job.run_chunk(chunk, progress))
+                if total:
+                    progress.setProgress(min(100.0, 100.0 * number / total))
+            return not progress.isCancelled()
+
+        chunks = list(chunks)
+
+        # Never more than max_parallel chunks are submitted, so a cancel takes effect after those
+        results = {}
+        running = {}
+        submitted = 0
+        delivered = 0
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+            try:
+                while delivered < len(chunks):
+                    while submitted < len(chunks) and len(running) < self.max_parallel and not progress.isCancelled():
+                        running[executor.submit(job.run_chunk, chunks[submitted], progress)] = submitted
+                        submitted += 1
+                    if not running:
+                        return False
+                    done, pending = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        results[running.pop(future)] = future.result()
+                    # in the order of the chunks, whatever order they finished in
+                    while delivered in results:
+                        self._done(job, chunks[delivered], results.pop(delivered))
+                        delivered += 1
+                    progress.setProgress(100.0 * delivered / len(chunks))
+            finally:
+                for future in running:
+                    future.cancel()
+        return not progress.isCancelled()
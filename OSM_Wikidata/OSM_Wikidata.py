@@ -10,18 +10,30 @@
  ***************************************************************************
 """
 import json
-import pickle
 import re
+import time
 import pywikibot
 from pywikibot.data import api
 
 from .deploy import version
+from .cleanup_engine import join_fragments
+from .entity_search import EntitySearch
+from .entity_store import EntityStore
+from .layer_jobs import (CleanupLayerJob, InterpretLayerJob, MatchLayerJob, OsmChangeExportJob, OsmImportJob,
+                            OverpassLayerJob, RulePreviewJob, SearchLayerJob)
+from .osm_import import tag_filter, wanted_keys
+from .profiling import PROFILER
+from .property_catalog import PropertyCatalog
+from .property_search import PropertySearchIndex, SearchIndexJob
+from .rule_cache import load_rules, save_rules
+from .task_scheduler import MAX_PARALLEL, ChunkScheduler
 from pathlib import Path
 
 from qgis.gui import QgsRubberBand, QgsDockWidget, QgsExpressionBuilderWidget
 from qgis.core import (Qgis, QgsTask, QgsMessageLog, QgsProject, QgsFeature, QgsVectorLayer, QgsMapLayer,
                        QgsLayerTreeLayer, QgsMapLayerStyle, QgsWkbTypes, QgsExpression, QgsFeatureRequest,
-                       QgsRectangle, QgsGeometry, QgsSpatialIndex, QgsDataSourceUri, QgsApplication)
+                       QgsRectangle, QgsGeometry, QgsSpatialIndex, QgsDataSourceUri, QgsApplication,
+                       QgsCoordinateReferenceSystem, QgsCoordinateTransform)
 from PyQt5.QtCore import (
     Qt,
     QCoreApplication,
@@ -31,7 +43,10 @@ from PyQt5.QtCore import (
     QPointF,
     QDate,
     QTimer,
-    QRegExp
+    QRegExp,
+    QAbstractListModel,
+    QModelIndex,
+    pyqtSignal
 )
 from PyQt5.QtGui import (QIcon, QColor, QPainter, QIntValidator, QFont, QStandardItemModel, QStandardItem,
                          QTextDocument, QTextCharFormat, QSyntaxHighlighter, QTextCursor)
@@ -71,6 +86,7 @@ from PyQt5.QtWidgets import (
     QCompleter,
     QCalendarWidget,
     QTableView,
+    QFileDialog,
     )
 
 file_path = Path(__file__)
@@ -82,14 +98,38 @@ APP_ICON = 'OpenStreetMap_Wikidata_logo.svg'
 
 OSMWD_TOOLS_LOG = 'OSM_Wikidata'
 
+# milliseconds without typing before a pattern gets validated
+VALIDATION_DELAY = 400
+# and before the rule being edited gets previewed on the active layer
+PREVIEW_DELAY = 500
+# milliseconds from clicking the toolbar icon to the dock being shown, slower gets logged as a warning
+COLD_START_TARGET = 200
+
 
 class PerformQueriesTask(QgsTask):
-    def __init__(self, description, queries, caller):
+    """
+    Performs the jobs in queries in a background thread, see task_scheduler for what a job looks like
+
+    Chunked jobs are split up, their chunks run up to max_parallel at a time. The results
+    their chunk_finished wants are marshalled back to the main thread through chunk_ready,
+    that is how CleanupLayerJob gets its batches into the edit buffer.
+    What finished() returns is logged, and what warnings() returns, if the job has it, as warnings
+    """
+    chunk_ready = pyqtSignal(object, object)
+
+    def __init__(self, description, queries, caller, verbose=True, max_parallel=MAX_PARALLEL):
+        """
+        :param verbose: whether starting and cancelling get logged, previews run too often for that
+        """
         super().__init__(description, QgsTask.CanCancel)
         self.queries = queries
         self.caller = caller
+        self.verbose = verbose
+        self.max_parallel = max_parallel
         self.busy = None
         self.exception = None
+        # The task lives in the main thread, so emitting from run() queues the call
+        self.chunk_ready.connect(self.deliver_chunk)
 
     def run(self):
         """This method periodically tests for isCancelled() to gracefully abort.
@@ -97,15 +137,34 @@ class PerformQueriesTask(QgsTask):
         raise them in self.finished
         """
 
-        QgsMessageLog.logMessage('Started task "{}"'.format(self.description()),
-                                 OSMWD_TOOLS_LOG, Qgis.Info)
+        if self.verbose:
+            QgsMessageLog.logMessage('Started task "{}"'.format(self.description()),
+                                     OSMWD_TOOLS_LOG, Qgis.Info)
         self.busy = True
 
-        return True
+        scheduler = ChunkScheduler(self.setProgress, self.isCancelled, self.chunk_ready.emit, self.max_parallel)
+        try:
+            with PROFILER.stage('task', self.description()):
+                return scheduler.run(self.queries)
+        except Exception as e:
+            self.exception = e
+            return False
+
+    def deliver_chunk(self, query, result):
+        """Invoked in the main thread"""
+        query.chunk_finished(result)
 
     def finished(self, task_result):
         self.busy = False
 
+        for query in self.queries:
+            summary = query.finished(task_result)
+            if summary:
+                QgsMessageLog.logMessage(summary, OSMWD_TOOLS_LOG, Qgis.Info)
+            if hasattr(query, 'warnings'):
+                for warning in query.warnings():
+                    QgsMessageLog.logMessage(warning, OSMWD_TOOLS_LOG, Qgis.Warning)
+
         if task_result:
             pass
         else:
@@ -117,8 +176,9 @@ class PerformQueriesTask(QgsTask):
                 raise self.exception
 
     def cancel(self):
-        QgsMessageLog.logMessage('Task "{name}" was cancelled'.format(name=self.description()),
-                                 OSMWD_TOOLS_LOG, Qgis.Info)
+        if self.verbose:
+            QgsMessageLog.logMessage('Task "{name}" was cancelled'.format(name=self.description()),
+                                     OSMWD_TOOLS_LOG, Qgis.Info)
         super().cancel()
 
 
@@ -138,8 +198,14 @@ class OSMWDFrame(QFrame):
 
 
 class OSMWDPlainTextEdit(QPlainTextEdit):
-    def __init__(self, *__args, text=''):
+    """
+    Editor of a cleanup rule. contents is the rule as cleanup.json has it, a single string
+    or a list of lines, and contents() gives the edited rule back in the same shape
+    """
+    def __init__(self, *__args, contents=''):
         super().__init__(*__args)
+        self.multi_line = not isinstance(contents, str)
+        text = '\n'.join(contents) if self.multi_line else contents
         font = QFont()
         font.setFamily("Courier")
         font.setFixedPitch(True)
@@ -148,6 +214,12 @@ class OSMWDPlainTextEdit(QPlainTextEdit):
         self.highlighter = RegexHighlighter(self.document())
         if text:
             self.setPlainText(text)
+        # The pattern is only validated once typing pauses
+        self.validation_timer = QTimer(self)
+        self.validation_timer.setSingleShot(True)
+        self.validation_timer.setInterval(VALIDATION_DELAY)
+        self.validation_timer.timeout.connect(self.validate)
+        self.error = ''
         self.textChanged.connect(self.text_changed)
         self.close_parentheses = {'(': ')',
                                   '[': ']',
@@ -166,7 +238,29 @@ class OSMWDPlainTextEdit(QPlainTextEdit):
             self.moveCursor(QTextCursor.PreviousCharacter)
 
     def text_changed(self):
-        self.highlighter.highlightBlock(self.toPlainText())
+        # QSyntaxHighlighter already rehighlights the blocks that changed
+        self.validation_timer.start()
+
+    def contents(self):
+        text = self.toPlainText()
+        return text.split('\n') if self.multi_line else text
+
+    def pattern(self):
+        """:returns: (pattern source, flags), as the cleanup engine compiles it"""
+        return join_fragments(self.contents())
+
+    def validate(self):
+        try:
+            re.compile(*self.pattern())
+            self.error = ''
+        except re.error as e:
+            self.error = str(e)
+        if self.error:
+            self.setStyleSheet('background-color: rgb(255, 220, 220);')
+            self.setToolTip(self.error)
+        else:
+            self.setStyleSheet('')
+            self.setToolTip('')
 
 class OSMWDLabel(QLabel):
     """
@@ -210,11 +304,18 @@ class OSMWDComboBox(QComboBox):
     It colors differently if multiple values are in the data
 
     or when the user selects 1 value manually
+
+    rows is a hash index from text to row, so values can be found without findText
     """
+    # set_value() and set_values() add the values that aren't in the list yet, unless it is read-only
+    read_only = False
+
     def __init__(self, name, column_name, update_method=None):
         super().__init__()
         self.items = {}
         self.reverse_items = {}
+        self.rows = {}
+        self.highlighted = set()
         self.values = {}
         self.changed = False
         self.setObjectName(name)
@@ -260,20 +361,41 @@ class OSMWDComboBox(QComboBox):
         self.setToolTip(self.name)
         self.setStyleSheet('background-color: rgb(254, 148, 125); font-weight:normal;')
         # reset background color for the items in the dropdown comboboxes back to neutral
-        for key in self.items:
-            self.setItemData(self.findText(key), QColor(222, 222, 222), Qt.BackgroundRole)
+        for row in self.highlighted:
+            self.setItemData(row, QColor(222, 222, 222), Qt.BackgroundRole)
+        self.highlighted.clear()
+
+    def find_row(self, text):
+        return self.rows.get(text, -1)
 
     def add_item(self, text, value, icon=None):
         self.items[text] = value
         self.reverse_items[value] = text
+        self.rows[text] = self.count()
         if icon:
             super().addItem(icon, text)
         else:
             super().addItem(text)
 
+    def add_items(self, texts):
+        """Adds several items, with their text as value, in one go"""
+        texts = [text for text in dict.fromkeys(texts) if text not in self.rows]
+        for row, text in enumerate(texts, self.count()):
+            self.items[text] = text
+            self.reverse_items[text] = text
+            self.rows[text] = row
+        super().addItems(texts)
+
     def insert_item(self, position, text, value, icon=None):
         self.items[text] = value
         self.reverse_items[value] = text
+        if 0 <= position < self.count():
+            # everything from position onwards moves down a row
+            self.rows = {key: row + 1 if row >= position else row for key, row in self.rows.items()}
+            self.highlighted = {row + 1 if row >= position else row for row in self.highlighted}
+        else:
+            position = self.count()
+        self.rows[text] = position
         if icon:
             super().insertItem(position, icon, text)
         else:
@@ -294,11 +416,9 @@ class OSMWDComboBox(QComboBox):
             return ''
 
     def set_value(self, value, update_tool_tip=True):
-        index = self.findText(value)
-        if index < 0:
+        if self.find_row(value) < 0 and not self.read_only:
             self.add_item(value, value)
-            index = self.findText(value)
-        if index >= 0:
+        if self.find_row(value) >= 0:
             if value in self.values:
                 self.values[value] += 1
             else:
@@ -306,10 +426,29 @@ class OSMWDComboBox(QComboBox):
         if update_tool_tip:
             self.update_tool_tip()
 
+    def set_values(self, counter):
+        """
+        Sets all the values of a selection in one go
+
+        :param counter: mapping of value: number of features with that value,
+            e.g. a collections.Counter, or an iterable of values
+        """
+        if not hasattr(counter, 'items'):
+            counts = {}
+            for value in counter:
+                counts[value] = counts.get(value, 0) + 1
+            counter = counts
+        if not self.read_only:
+            self.add_items(value for value in counter if self.find_row(value) < 0)
+        for value, count in counter.items():
+            if self.find_row(value) >= 0:
+                self.values[value] = self.values.get(value, 0) + count
+        self.update_tool_tip()
+
     def update_tool_tip(self):
         if len(self.values) == 1:
             self.setStyleSheet('background-color: rgb(240, 240, 240); font-weight:normal;')
-            self.setCurrentIndex(self.findText(list(self.values)[0]))
+            self.setCurrentIndex(self.find_row(list(self.values)[0]))
         else:
             self.setStyleSheet('background-color: rgb(255, 201, 140); font-weight:normal;')
             self.setCurrentIndex(-1)
@@ -317,7 +456,10 @@ class OSMWDComboBox(QComboBox):
             for key, value in sorted(self.values.items(), key=lambda x: x[0]):
                 tool_tips.append('{}x {}'.format(value, key))
                 # highlight the rows in the drop down that represent segments from the selection
-                self.setItemData(self.findText(key), QColor(205, 92, 92), Qt.BackgroundRole)
+                row = self.find_row(key)
+                if row not in self.highlighted:
+                    self.setItemData(row, QColor(205, 92, 92), Qt.BackgroundRole)
+                    self.highlighted.add(row)
             self.setToolTip('\n'.join(tool_tips))
 
     def get_item_text_for(self, value):
@@ -333,15 +475,135 @@ class OSMWDComboBox(QComboBox):
             self.update_method()
 
 
+class PropertyListModel(QAbstractListModel):
+    """
+    All the properties of the catalog, read-only, with their labels as display text
+
+    One instance is shared by every PropertiesComboBox, together with the lookup maps
+    items (label to P-id) and reverse_items (P-id to label) and the search index
+    """
+    def __init__(self, catalog, parent=None):
+        super().__init__(parent)
+        self.catalog = catalog
+        self.ids = list(catalog)
+        self.labels = [catalog[wd_property] for wd_property in self.ids]
+        self.items = dict(zip(self.labels, self.ids))
+        self.reverse_items = dict(zip(self.ids, self.labels))
+        self.rows = {label: row for row, label in enumerate(self.labels)}
+        self._search_index = None
+
+    @property
+    def search_index(self):
+        """
+        Built in the background when the dock opens, see OSMWikidataDock.index_properties,
+        only somebody who types before that is done waits for it here
+        """
+        if self._search_index is None:
+            with PROFILER.stage('catalog index', features=len(self.ids)):
+                self._search_index = PropertySearchIndex.from_catalog(self.catalog)
+        return self._search_index
+
+    def set_search_index(self, index):
+        if self._search_index is None:
+            self._search_index = index
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.ids)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return self.labels[index.row()]
+        if role == Qt.ToolTipRole:
+            return self.ids[index.row()]
+        return None
+
+    def flags(self, index):
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable
+
+
+class PropertySearchModel(QAbstractListModel):
+    """
+    The properties found by the search index of a PropertyListModel, best match first
+    """
+    def __init__(self, property_model, parent=None):
+        super().__init__(parent)
+        self.property_model = property_model
+        self.ids = []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.ids)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        wd_property = self.ids[index.row()]
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return self.property_model.reverse_items[wd_property]
+        if role == Qt.ToolTipRole:
+            return wd_property
+        return None
+
+    def search(self, text):
+        self.beginResetModel()
+        self.ids = self.property_model.search_index.search_ids(text)
+        self.endResetModel()
+
+
+class PropertyCompleter(QCompleter):
+    """
+    A QCompleter that shows the ranked results of a PropertySearchIndex
+    instead of scanning all the labels for the text typed so far
+    """
+    def __init__(self, property_model, parent=None):
+        super().__init__(parent)
+        self.setModel(PropertySearchModel(property_model, self))
+        self.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        self.setCaseSensitivity(Qt.CaseInsensitive)
+        self.setMaxVisibleItems(15)
+
+    def splitPath(self, path):
+        # The model holds exactly the matches, so there is nothing left for the completer to filter
+        self.model().search(path)
+        return ['']
+
+
 class PropertiesComboBox(OSMWDComboBox):
-    def __init__(self, properties):
+    """
+    An OSMWDComboBox on the shared PropertyListModel
+
+    Creating one doesn't add any items, the model and the lookup maps are shared.
+    The model is read-only, so values that aren't properties are left out by set_value()
+    and adding items raises TypeError
+    """
+    read_only = True
+
+    def __init__(self, property_model):
         super().__init__('', '')
-        properties_list = []
-        for wd_property in properties:
-            self.add_item(properties[wd_property], wd_property)
-            properties_list.append(properties[wd_property])
-        self.add_completer(properties_list)
-        del(properties_list)
+        self.property_model = property_model
+        self.setModel(property_model)
+        self.items = property_model.items
+        self.reverse_items = property_model.reverse_items
+        self.rows = property_model.rows
+        self.setEditable(True)
+        self.setInsertPolicy(QComboBox.NoInsert)
+        self.setCompleter(PropertyCompleter(property_model, self))
+        self.setStyleSheet('QScrollBar: vertical {width: 20px;}')
+        self.setCurrentIndex(-1)
+
+    def read_only_error(self):
+        return TypeError('The items of a PropertiesComboBox are the properties of the shared catalog, '
+                         'they are read-only')
+
+    def add_item(self, text, value, icon=None):
+        raise self.read_only_error()
+
+    def add_items(self, texts):
+        raise self.read_only_error()
+
+    def insert_item(self, position, text, value, icon=None):
+        raise self.read_only_error()
 
 
 class OSMWDDateEdit(QDateEdit):
@@ -496,6 +758,11 @@ STYLES = {
 
 class RegexHighlighter(QSyntaxHighlighter):
     """Syntax highlighter for regular expressions.
+
+    Qt calls highlightBlock only for the lines that changed. The state of a block is
+    the number of groups still open at its end, so groups in verbose patterns
+    that span several lines get highlighted, and the next line is only
+    rehighlighted when that number changes
     """
 
     operators = [
@@ -511,12 +778,9 @@ class RegexHighlighter(QSyntaxHighlighter):
     ]
 
     def __init__(self, document):
-        # print(document.toPlainText())
         QSyntaxHighlighter.__init__(self, document)
 
-        rules = [(r'(\(.*\))', 0, STYLES['group']),]
-
-        rules += [(r'%s' % o, 0, STYLES['operator']) for o in RegexHighlighter.operators]
+        rules = [(r'%s' % o, 0, STYLES['operator']) for o in RegexHighlighter.operators]
         rules += [(r'%s' % b, 0, STYLES['brace']) for b in RegexHighlighter.braces]
         rules += [(r'%s' % l, 0, STYLES['literal']) for l in RegexHighlighter.literals]
 
@@ -531,7 +795,41 @@ class RegexHighlighter(QSyntaxHighlighter):
         ]
 
         self.rules = [(QRegExp(pat), index, fmt) for (pat, index, fmt) in rules]
-        # print(self.rules)
+
+    @staticmethod
+    def group_spans(text, depth):
+        """
+        :param depth: number of groups open at the start of the line
+        :returns: list of (start, end) of the text inside groups, and the depth at the end of the line
+        """
+        spans = []
+        start = 0 if depth else None
+        escaped = in_class = False
+        end_of_code = len(text)
+        for position, ch in enumerate(text):
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif in_class:
+                in_class = ch != ']'
+            elif ch == '[':
+                in_class = True
+            elif ch == '#':
+                end_of_code = position
+                break
+            elif ch == '(':
+                depth += 1
+                if depth == 1:
+                    start = position
+            elif ch == ')' and depth:
+                depth -= 1
+                if depth == 0:
+                    spans.append((start, position + 1))
+                    start = None
+        if start is not None:
+            spans.append((start, end_of_code))
+        return spans, depth
 
     def highlightBlock(self, text):
         for expression, nth, character_format in self.rules:
@@ -543,7 +841,16 @@ class RegexHighlighter(QSyntaxHighlighter):
                 self.setFormat(index, length, character_format)
                 index = expression.indexIn(text, index + length)
 
-        self.setCurrentBlockState(0)
+        spans, depth = self.group_spans(text, max(self.previousBlockState(), 0))
+        background = STYLES['group'].background()
+        for start, end in spans:
+            for position in range(start, end):
+                character_format = self.format(position)
+                character_format.setBackground(background)
+                self.setFormat(position, 1, character_format)
+
+        self.setCurrentBlockState(depth)
+
 
 class DockOSMWD(QgsDockWidget):
     """
@@ -572,18 +879,59 @@ class DockOSMWD(QgsDockWidget):
         self.cleanup_data_widget_tab.setWidget(self.cleanup_data_content_widget)
         self.cleanup_data_widget_grid_layout = QGridLayout(self.cleanup_data_content_widget)
         self.cleanup_data_widget_tab.setWidgetResizable(True)
+        self.cleanup_apply_button = QPushButton('Apply to active layer', self.cleanup_data_content_widget)
+        self.cleanup_apply_button.setEnabled(False)
+        self.cleanup_data_widget_grid_layout.addWidget(self.cleanup_apply_button, 0, 3)
+        self.cleanup_import_button = QPushButton('Import OSM extract', self.cleanup_data_content_widget)
+        self.cleanup_import_button.setEnabled(False)
+        self.cleanup_data_widget_grid_layout.addWidget(self.cleanup_import_button, 0, 0)
+        self.cleanup_overpass_button = QPushButton('Load from Overpass', self.cleanup_data_content_widget)
+        self.cleanup_overpass_button.setEnabled(False)
+        self.cleanup_data_widget_grid_layout.addWidget(self.cleanup_overpass_button, 0, 1)
+        self.cleanup_save_button = QPushButton('Save rules', self.cleanup_data_content_widget)
+        self.cleanup_save_button.setEnabled(False)
+        self.cleanup_data_widget_grid_layout.addWidget(self.cleanup_save_button, 0, 2)
+
+        # The rules scroll, the preview of the rule being edited stays in view below them
+        self.cleanup_tab = QWidget()
+        cleanup_tab_layout = QVBoxLayout(self.cleanup_tab)
+        cleanup_tab_layout.addWidget(self.cleanup_data_widget_tab, 3)
+        self.cleanup_preview_label = QLabel('Edit a rule to preview it on the active layer', self.cleanup_tab)
+        self.cleanup_preview_label.setWordWrap(True)
+        cleanup_tab_layout.addWidget(self.cleanup_preview_label)
+        self.cleanup_preview_table = QTableWidget(0, 3, self.cleanup_tab)
+        self.cleanup_preview_table.setHorizontalHeaderLabels(['Before', 'After', 'Features'])
+        self.cleanup_preview_table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.cleanup_preview_table.verticalHeader().hide()
+        header = self.cleanup_preview_table.horizontalHeader()
+        header.setSectionResizeMode(0, QHeaderView.Stretch)
+        header.setSectionResizeMode(1, QHeaderView.Stretch)
+        header.setSectionResizeMode(2, QHeaderView.ResizeToContents)
+        cleanup_tab_layout.addWidget(self.cleanup_preview_table, 1)
 
         self.interpret_widget_tab = QScrollArea()
         self.interpret_content_widget = QWidget()
         self.interpret_widget_tab.setWidget(self.interpret_content_widget)
         self.interpret_widget_grid_layout = QGridLayout(self.interpret_content_widget)
         self.interpret_widget_tab.setWidgetResizable(True)
+        self.interpret_apply_button = QPushButton('Interpret active layer', self.interpret_content_widget)
+        self.interpret_apply_button.setEnabled(False)
+        self.interpret_widget_grid_layout.addWidget(self.interpret_apply_button, 0, 2)
+        self.interpret_export_button = QPushButton('Export osmChange', self.interpret_content_widget)
+        self.interpret_export_button.setEnabled(False)
+        self.interpret_widget_grid_layout.addWidget(self.interpret_export_button, 0, 1)
 
         self.items_widget_tab = QScrollArea()
         self.items_content_widget = QWidget()
         self.items_widget_tab.setWidget(self.items_content_widget)
         self.items_widget_grid_layout = QGridLayout(self.items_content_widget)
         self.items_widget_tab.setWidgetResizable(True)
+        self.items_search_button = QPushButton('Search Wikidata for active layer', self.items_content_widget)
+        self.items_search_button.setEnabled(False)
+        self.items_widget_grid_layout.addWidget(self.items_search_button, 0, 0)
+        self.items_match_button = QPushButton('Match search results by location', self.items_content_widget)
+        self.items_match_button.setEnabled(False)
+        self.items_widget_grid_layout.addWidget(self.items_match_button, 0, 1)
 
         self.properties_widget_tab = QScrollArea()
         self.properties_content_widget = QWidget()
@@ -604,7 +952,7 @@ class DockOSMWD(QgsDockWidget):
         self.references_widget_tab.setWidgetResizable(True)
 
         self.tabs_widget.addTab(self.tests_widget, 'Tests')
-        self.tabs_widget.addTab(self.cleanup_data_widget_tab, 'Cleanup tags')
+        self.tabs_widget.addTab(self.cleanup_tab, 'Cleanup tags')
         self.tabs_widget.addTab(self.interpret_widget_tab, 'Interpret tags')
         self.tabs_widget.addTab(self.items_widget_tab, 'WD Items')
         self.tabs_widget.addTab(self.properties_widget_tab, 'WD Properties')
@@ -615,8 +963,27 @@ class DockOSMWD(QgsDockWidget):
             'sc_500': ['copy', 'add', 'save', 'delete'],
         }
 
+        # Callables that fill a tab, invoked the first time the tab is shown
+        self.tab_builders = {}
+        self.tabs_widget.currentChanged.connect(self.build_tab)
+
         # self.tab_widget.resize(500, QApplication.desktop().screenGeometry().bottom() - 100)
 
+    def add_tab_builder(self, tab, builder):
+        self.tab_builders[tab] = builder
+        if self.tabs_widget.currentWidget() is tab:
+            self.build_tab(self.tabs_widget.currentIndex())
+
+    def build_tab(self, index):
+        builder = self.tab_builders.pop(self.tabs_widget.widget(index), None)
+        if builder is None:
+            return
+        started = time.perf_counter()
+        with PROFILER.stage('widget build', self.tabs_widget.tabText(index)):
+            builder()
+        QgsMessageLog.logMessage('Built tab "{}" in {:.0f} ms'.format(
+            self.tabs_widget.tabText(index), 1000 * (time.perf_counter() - started)), OSMWD_TOOLS_LOG, Qgis.Info)
+
 
 class OSMWikidataDock:
     """QGIS Plugin Implementation.
@@ -638,10 +1005,31 @@ class OSMWikidataDock:
 
         self.toolbar = self.iface.addToolBar('OpenStreetMap')
         self.toolbar.setObjectName('OSM_Wikidata')
+        PROFILER.log = lambda message: QgsMessageLog.logMessage(message, OSMWD_TOOLS_LOG, Qgis.Info)
 
         self.text_edit = {}
         self.line_edit = {}
-        self.wd_properties = {}
+        # opened on first lookup
+        self.wd_properties = PropertyCatalog()
+        self._property_model = None
+        self.property_index = None
+        self.index_task = None
+        self.compiled_rules = None
+        self.cleanup_engine = None
+        self.interpret_engine = None
+        self.interpretations = {}
+        self.entity_search = None
+        self.search_results = {}
+        self.entity_store = None
+        self.matches = {}
+        self.cleanup_data = {}
+        self.cleanup_macros = {}
+        # (tag, index) of a cleanup rule in the dock: its position in the cleanup engine
+        self.cleanup_positions = {}
+        self.preview_timer = None
+        self.preview_key = None
+        self.preview_job = None
+        self.preview_task = None
 
     # noinspection PyMethodMayBeStatic
     def tr(self, message):
@@ -658,6 +1046,29 @@ class OSMWikidataDock:
         # noinspection PyTypeChecker,PyArgumentList,PyCallByClass
         return QCoreApplication.translate('OpenStreetMap', message)
 
+    @property
+    def property_model(self):
+        if self._property_model is None:
+            with PROFILER.stage('catalog load') as stage:
+                self._property_model = PropertyListModel(self.wd_properties)
+                stage.count(len(self._property_model.ids))
+            if self.property_index is not None:
+                self._property_model.set_search_index(self.property_index)
+        return self._property_model
+
+    def index_properties(self):
+        """Builds the search index of the property catalog in the background"""
+        self.index_task = PerformQueriesTask('Index Wikidata properties',
+                                             [SearchIndexJob(self.wd_properties, self.set_property_index)], self,
+                                             verbose=False)
+        QgsApplication.taskManager().addTask(self.index_task)
+
+    def set_property_index(self, index):
+        """Invoked in the main thread"""
+        self.property_index = index
+        if self._property_model is not None:
+            self._property_model.set_search_index(index)
+
     def add_action(
             self,
             icon_path,
@@ -700,6 +1111,42 @@ class OSMWikidataDock:
             text=self.tr('OSM_Wikidata'),
             callback=self.run,
             parent=self.iface.mainWindow())
+        self.profile_action = self.add_action(
+            icon_path,
+            text=self.tr('Profile stages'),
+            callback=self.toggle_profiling,
+            add_to_toolbar=False,
+            status_tip='Log wall time, features and memory of every stage to the "{}" log'.format(OSMWD_TOOLS_LOG),
+            parent=self.iface.mainWindow())
+        self.profile_action.setCheckable(True)
+        self.profile_action.setChecked(PROFILER.enabled)
+        self.add_action(
+            icon_path,
+            text=self.tr('Export stage timings'),
+            callback=self.export_profile,
+            add_to_toolbar=False,
+            parent=self.iface.mainWindow())
+
+    def toggle_profiling(self, checked):
+        if checked:
+            PROFILER.enable(memory=True)
+        else:
+            if PROFILER.records:
+                QgsMessageLog.logMessage('\n'.join(['Stage timings:'] + PROFILER.summary_lines()),
+                                         OSMWD_TOOLS_LOG, Qgis.Info)
+            PROFILER.disable()
+
+    def export_profile(self):
+        if not PROFILER.records:
+            QgsMessageLog.logMessage('No stage timings yet, switch on "Profile stages" first',
+                                     OSMWD_TOOLS_LOG, Qgis.Warning)
+            return
+        path, file_filter = QFileDialog.getSaveFileName(self.iface.mainWindow(), 'Export stage timings',
+                                                        'osmwd_profile.json', 'JSON (*.json)')
+        if path:
+            PROFILER.to_json(path)
+            QgsMessageLog.logMessage('Wrote {} stage timings to {}'.format(len(PROFILER.records), path),
+                                     OSMWD_TOOLS_LOG, Qgis.Info)
 
     def unload(self):
         """Removes the plugin menu item and icon from QGIS GUI."""
@@ -724,85 +1171,144 @@ class OSMWikidataDock:
         """
         This is invoked when the icon on the QGIS toolbar is clicked
 
-        It fetches data from the database to create all the GUI widgets and to
-        populate all the ComboBoxes
+        The dock is created the first time, with its tabs still empty.
+        Each tab gets its widgets the first time it is shown
 
         """
+        started = time.perf_counter()
         if not self.dockwidget:
             self.dockwidget = DockOSMWD()
             self.dockwidget.setWindowTitle("OpenStreetMap - Wikidata v{}".format(VERSION))
-
-        wd_properties_file = Path(__file__).resolve().parent / 'wd properties.pickle'
-        with open(Path(wd_properties_file), 'rb') as handle:
-            self.wd_properties = pickle.load(handle)
-
-        from pprint import  pprint
-
-        cleanup_file = Path(__file__).resolve().parent / 'cleanup.json'
-        with open(cleanup_file) as data_file:
-            data = json.load(data_file)
-
-        for group in data:
-            # pprint(group)
-            if group == 'cleanup':
-                for tag in data[group]:
-                    i = 0
-                    for entry in data[group][tag]:
-                        for key, contents in entry.items():
-                            self.text_edit[key] = OSMWDPlainTextEdit(self.dockwidget.cleanup_data_widget_tab,
-                                                                     text='\n'.join(contents))
-                            self.text_edit[key].setMinimumHeight(len(contents) * 17 + 10)
-                            self.line_edit[key] = QLineEdit(key, self.dockwidget.cleanup_data_widget_tab)
-                            self.line_edit[key].setFixedWidth(140)
-                            self.dockwidget.cleanup_data_widget_grid_layout.addWidget(self.text_edit[key], i, 0, 1, 3)
-                            self.dockwidget.cleanup_data_widget_grid_layout.addWidget(self.line_edit[key], i, 3)
-                            i += 1
-            elif group == 'Interpret':
-                pass
-            elif group == 'Wikidata items':
-                pass
-            elif group == 'Wikidata properties':
-                pass
-            elif group == 'Wikidata references':
-                i = 0
-                for reference_label in data[group]:
-                    wd_property = data[group][reference_label][0]
-                    wd_value = data[group][reference_label][1]
-                    self.line_edit[reference_label] = QLineEdit(reference_label, self.dockwidget.references_widget_tab)
-                    self.line_edit[reference_label + '_' + wd_property] = PropertiesComboBox(self.wd_properties)
-                    self.line_edit[reference_label + '_' + wd_property].set_value(self.wd_properties[wd_property])
-                    self.line_edit[reference_label + '_' + wd_property].setFixedWidth(250)
-                    self.line_edit[reference_label + '_' + wd_value] = QLineEdit(wd_value, self.dockwidget.references_widget_tab)
-                    self.line_edit[reference_label + '_' + wd_value].setFixedWidth(140)
-                    self.dockwidget.references_widget_grid_layout.addWidget(self.line_edit[reference_label], i, 0)
-                    self.dockwidget.references_widget_grid_layout.addWidget(self.line_edit[reference_label + '_' + wd_property], i, 1)
-                    self.dockwidget.references_widget_grid_layout.addWidget(self.line_edit[reference_label + '_' + wd_value], i, 2)
-                    i += 1
-            elif group == 'Wikidata statements':
-                i = 0
-                for statement_label in data[group]:
-                    wd_property = data[group][statement_label][0]
-                    wd_value = data[group][statement_label][1]
-                    wd_references = data[group][statement_label][2]
-                    self.line_edit[statement_label] = QLineEdit(statement_label, self.dockwidget.references_widget_tab)
-                    self.line_edit[statement_label + '_' + wd_property] = PropertiesComboBox(self.wd_properties)
-                    self.line_edit[statement_label + '_' + wd_property].set_value(self.wd_properties[wd_property])
-                    self.line_edit[statement_label + '_' + wd_property].setFixedWidth(250)
-                    self.line_edit[statement_label + '_' + wd_value] = QLineEdit(wd_value, self.dockwidget.references_widget_tab)
-                    self.line_edit[statement_label + '_' + wd_value].setFixedWidth(140)
-                    self.line_edit[statement_label + '_' + wd_references] = QLineEdit(wd_value, self.dockwidget.references_widget_tab)
-                    self.line_edit[statement_label + '_' + wd_references].setFixedWidth(140)
-                    self.dockwidget.references_widget_grid_layout.addWidget(self.line_edit[statement_label], i, 0)
-                    self.dockwidget.references_widget_grid_layout.addWidget(self.line_edit[statement_label + '_' + wd_property], i, 1)
-                    self.dockwidget.references_widget_grid_layout.addWidget(self.line_edit[statement_label + '_' + wd_value], i, 2)
-                    self.dockwidget.references_widget_grid_layout.addWidget(self.line_edit[statement_label + '_' + wd_references], i, 2)
-                    i += 1
-
-        self.iface.addDockWidget(Qt.RightDockWidgetArea, self.dockwidget)
+            self.preview_timer = QTimer(self.dockwidget)
+            self.preview_timer.setSingleShot(True)
+            self.preview_timer.setInterval(PREVIEW_DELAY)
+            self.preview_timer.timeout.connect(self.start_cleanup_preview)
+
+            # unpickled from rules.cache unless cleanup.json changed
+            rules_started = time.perf_counter()
+            with PROFILER.stage('rule compile'):
+                self.compiled_rules = load_rules()
+            self.cleanup_data = self.compiled_rules.data
+            self.cleanup_macros = self.compiled_rules.macros
+            QgsMessageLog.logMessage('Cleanup rules {} in {:.0f} ms'.format(
+                'loaded from cache' if self.compiled_rules.cached else 'compiled',
+                1000 * (time.perf_counter() - rules_started)), OSMWD_TOOLS_LOG, Qgis.Info)
+
+            self.dockwidget.add_tab_builder(self.dockwidget.cleanup_tab, self.build_cleanup_tab)
+            self.dockwidget.add_tab_builder(self.dockwidget.interpret_widget_tab, self.build_interpret_tab)
+            self.dockwidget.add_tab_builder(self.dockwidget.items_widget_tab, self.build_items_tab)
+            self.dockwidget.add_tab_builder(self.dockwidget.statements_widget_tab, self.build_statements_tab)
+            self.dockwidget.add_tab_builder(self.dockwidget.references_widget_tab, self.build_references_tab)
+
+            self.iface.addDockWidget(Qt.RightDockWidgetArea, self.dockwidget)
+            self.index_properties()
         self.iface.openMessageLog()
 
-
         self.dockwidget.show()
+        # Measured once the event loop gets to it, after the dock got painted
+        QTimer.singleShot(0, lambda: self.log_cold_start(started))
+
+    def log_cold_start(self, started):
+        elapsed = 1000 * (time.perf_counter() - started)
+        QgsMessageLog.logMessage('Dock shown in {:.0f} ms'.format(elapsed), OSMWD_TOOLS_LOG,
+                                 Qgis.Info if elapsed <= COLD_START_TARGET else Qgis.Warning)
+
+    def build_cleanup_tab(self):
+        data = self.cleanup_data
+        for tag in data.get('cleanup', {}):
+            # row 0 holds the button to apply the rules
+            i = 1
+            for entry in data['cleanup'][tag]:
+                for replacement, contents in entry.items():
+                    # by position, several rules can have the same replacement, like "Saint "
+                    key = (tag, i - 1)
+                    if tag == self.compiled_rules.tag:
+                        self.cleanup_positions[key] = i - 1
+                    self.text_edit[key] = OSMWDPlainTextEdit(self.dockwidget.cleanup_data_widget_tab,
+                                                             contents=contents)
+                    line_count = 1 if isinstance(contents, str) else len(contents)
+                    self.text_edit[key].setMinimumHeight(line_count * 17 + 10)
+                    self.line_edit[key] = QLineEdit(replacement, self.dockwidget.cleanup_data_widget_tab)
+                    self.line_edit[key].setFixedWidth(140)
+                    self.dockwidget.cleanup_data_widget_grid_layout.addWidget(self.text_edit[key], i, 0, 1, 3)
+                    self.dockwidget.cleanup_data_widget_grid_layout.addWidget(self.line_edit[key], i, 3)
+                    self.text_edit[key].textChanged.connect(lambda key=key: self.preview_cleanup_rule(key))
+                    self.line_edit[key].textEdited.connect(lambda text, key=key: self.preview_cleanup_rule(key))
+                    i += 1
+        self.enable_button_and_connect_slot(self.dockwidget.cleanup_apply_button, self.cleanup_active_layer)
+        self.enable_button_and_connect_slot(self.dockwidget.cleanup_import_button, self.import_osm_extract)
+        self.enable_button_and_connect_slot(self.dockwidget.cleanup_overpass_button, self.load_from_overpass)
+        self.enable_button_and_connect_slot(self.dockwidget.cleanup_save_button, self.save_cleanup_rules)
+
+    def build_interpret_tab(self):
+        data = self.cleanup_data
+        # row 0 holds the button to apply the rules
+        i = 1
+        for tag in data.get('Interpret', {}):
+            for entry in data['Interpret'][tag]:
+                for key, contents in entry.items():
+                    osm_tags = ['{}={}'.format(k, v) for osm_tag in contents.get('OSM', [])
+                                for k, v in osm_tag.items()]
+                    self.line_edit['Interpret_' + tag + '_' + key] = QLineEdit(key, self.dockwidget.interpret_widget_tab)
+                    self.dockwidget.interpret_widget_grid_layout.addWidget(
+                        QLabel(tag, self.dockwidget.interpret_widget_tab), i, 0)
+                    self.dockwidget.interpret_widget_grid_layout.addWidget(
+                        self.line_edit['Interpret_' + tag + '_' + key], i, 1)
+                    self.dockwidget.interpret_widget_grid_layout.addWidget(
+                        QLabel('\n'.join(osm_tags + contents.get('WD', [])), self.dockwidget.interpret_widget_tab), i, 2)
+                    i += 1
+        self.enable_button_and_connect_slot(self.dockwidget.interpret_apply_button, self.interpret_active_layer)
+        self.enable_button_and_connect_slot(self.dockwidget.interpret_export_button, self.export_osmchange)
+
+    def build_items_tab(self):
+        self.enable_button_and_connect_slot(self.dockwidget.items_search_button, self.search_active_layer)
+        self.enable_button_and_connect_slot(self.dockwidget.items_match_button, self.match_active_layer)
+
+    def build_references_tab(self):
+        data = self.cleanup_data
+        group = 'Wikidata references'
+        i = 0
+        for reference_label in data.get(group, {}):
+            wd_property = data[group][reference_label][0]
+            # properties can be referred to by their label in "Wikidata properties"
+            wd_property = data.get('Wikidata properties', {}).get(wd_property, wd_property)
+            wd_value = data[group][reference_label][1]
+            self.line_edit[reference_label] = QLineEdit(reference_label, self.dockwidget.references_widget_tab)
+            self.line_edit[reference_label + '_' + wd_property] = PropertiesComboBox(self.property_model)
+            self.line_edit[reference_label + '_' + wd_property].set_value(self.wd_properties.get(wd_property, wd_property))
+            self.line_edit[reference_label + '_' + wd_property].setFixedWidth(250)
+            self.line_edit[reference_label + '_' + wd_value] = QLineEdit(wd_value, self.dockwidget.references_widget_tab)
+            self.line_edit[reference_label + '_' + wd_value].setFixedWidth(140)
+            self.dockwidget.references_widget_grid_layout.addWidget(self.line_edit[reference_label], i, 0)
+            self.dockwidget.references_widget_grid_layout.addWidget(self.line_edit[reference_label + '_' + wd_property], i, 1)
+            self.dockwidget.references_widget_grid_layout.addWidget(self.line_edit[reference_label + '_' + wd_value], i, 2)
+            i += 1
+
+    def build_statements_tab(self):
+        data = self.cleanup_data
+        group = 'Wikidata statements'
+        i = 0
+        for statement_label in data.get(group, {}):
+            statement = data[group][statement_label]
+            if len(statement) != 3:
+                QgsMessageLog.logMessage('Statement "{}" has to be [property, item, references]'.format(
+                    statement_label), OSMWD_TOOLS_LOG, Qgis.Warning)
+                continue
+            wd_property, wd_value, wd_references = statement
+            wd_property = data.get('Wikidata properties', {}).get(wd_property, wd_property)
+            self.line_edit[statement_label] = QLineEdit(statement_label, self.dockwidget.statements_widget_tab)
+            self.line_edit[statement_label + '_property'] = PropertiesComboBox(self.property_model)
+            self.line_edit[statement_label + '_property'].set_value(self.wd_properties.get(wd_property, wd_property))
+            self.line_edit[statement_label + '_property'].setFixedWidth(250)
+            self.line_edit[statement_label + '_' + wd_value] = QLineEdit(wd_value, self.dockwidget.statements_widget_tab)
+            self.line_edit[statement_label + '_' + wd_value].setFixedWidth(140)
+            self.line_edit[statement_label + '_references'] = QLineEdit(', '.join(wd_references), self.dockwidget.statements_widget_tab)
+            self.line_edit[statement_label + '_references'].setFixedWidth(140)
+            self.dockwidget.statements_widget_grid_layout.addWidget(self.line_edit[statement_label], i, 0)
+            self.dockwidget.statements_widget_grid_layout.addWidget(self.line_edit[statement_label + '_property'], i, 1)
+            self.dockwidget.statements_widget_grid_layout.addWidget(self.line_edit[statement_label + '_' + wd_value], i, 2)
+            self.dockwidget.statements_widget_grid_layout.addWidget(self.line_edit[statement_label + '_references'], i, 3)
+            i += 1
 
     # self.site = pywikibot.Site("wikidata", "wikidata")
     # self.repo = self.site.data_repository()
@@ -838,10 +1344,252 @@ class OSMWikidataDock:
             pass
         button.released.connect(method)
 
-    def perform_query_in_background_thread(self, task_name):
-        self.task = PerformQueriesTask(task_name, self.queries, self)
+    def perform_query_in_background_thread(self, task_name, queries):
+        self.task = PerformQueriesTask(task_name, queries, self)
         QgsApplication.taskManager().addTask(self.task)
-        self.clear_selection_on_all_layers()
+
+    def import_osm_extract(self):
+        """
+        Imports the objects the "Interpret" rules are for from an .osm or .osm.pbf file,
+        into a GeoPackage or, when none is chosen, a memory layer
+        """
+        engine = self.compiled_rules.interpret_engine
+        filters = tag_filter(engine)
+        if not filters:
+            QgsMessageLog.logMessage('The Interpret rules under "*" have no OSM tags to import by',
+                                     OSMWD_TOOLS_LOG, Qgis.Warning)
+            return
+        path, file_filter = QFileDialog.getOpenFileName(self.dockwidget, 'Import OSM extract', '',
+                                                        'OpenStreetMap (*.osm *.pbf)')
+        if not path:
+            return
+        gpkg_path, file_filter = QFileDialog.getSaveFileName(
+            self.dockwidget, 'GeoPackage to import into, cancel for a memory layer',
+            str(Path(path).with_name(Path(path).name.split('.')[0] + '.gpkg')), 'GeoPackage (*.gpkg)')
+        job = OsmImportJob(path, filters, wanted_keys(engine, filters, (self.compiled_rules.tag,)),
+                           gpkg_path or None)
+        self.perform_query_in_background_thread('Import {}'.format(Path(path).name), [job])
+
+    def load_from_overpass(self):
+        """
+        Loads the objects the "Interpret" rules are for in the extent of the map canvas
+        from Overpass into a memory layer. Tiles loaded before come from the response cache
+        """
+        engine = self.compiled_rules.interpret_engine
+        filters = tag_filter(engine)
+        if not filters:
+            QgsMessageLog.logMessage('The Interpret rules under "*" have no OSM tags to query by',
+                                     OSMWD_TOOLS_LOG, Qgis.Warning)
+            return
+        canvas = self.iface.mapCanvas()
+        transform = QgsCoordinateTransform(canvas.mapSettings().destinationCrs(),
+                                           QgsCoordinateReferenceSystem('EPSG:4326'), QgsProject.instance())
+        extent = transform.transformBoundingBox(canvas.extent())
+        bbox = (extent.yMinimum(), extent.xMinimum(), extent.yMaximum(), extent.xMaximum())
+        job = OverpassLayerJob(bbox, filters, wanted_keys(engine, filters, (self.compiled_rules.tag,)))
+        self.perform_query_in_background_thread('Load from Overpass', [job])
+
+    def cleanup_active_layer(self):
+        """
+        Applies the cleanup rules to the name field of the active layer,
+        only to the selected features if there is a selection
+        """
+        layer = self.iface.activeLayer()
+        if not layer or layer.type() != QgsMapLayer.VectorLayer:
+            QgsMessageLog.logMessage('Select a vector layer to clean up', OSMWD_TOOLS_LOG, Qgis.Warning)
+            return
+        if self.cleanup_engine is None:
+            # every cleanup job quarantines the rules that keep taking too long on a name, see RuleGuard
+            self.cleanup_engine = self.compiled_rules.cleanup_engine
+            for rule, kind, description in self.compiled_rules.findings:
+                QgsMessageLog.logMessage('Cleanup rule "{}" may backtrack catastrophically, {}: {}'.format(
+                    rule.replacement, kind, description), OSMWD_TOOLS_LOG, Qgis.Warning)
+        try:
+            job = CleanupLayerJob(layer, self.cleanup_engine, 'name',
+                                  selected_only=bool(layer.selectedFeatureCount()))
+        except ValueError as e:
+            QgsMessageLog.logMessage(str(e), OSMWD_TOOLS_LOG, Qgis.Warning)
+            return
+        self.perform_query_in_background_thread('Cleanup names on {}'.format(layer.name()), [job])
+
+    def search_active_layer(self):
+        """
+        Searches Wikidata for the names of the features of the active layer,
+        only for the selected features if there is a selection
+        """
+        layer = self.iface.activeLayer()
+        if not layer or layer.type() != QgsMapLayer.VectorLayer:
+            QgsMessageLog.logMessage('Select a vector layer to search Wikidata for', OSMWD_TOOLS_LOG, Qgis.Warning)
+            return
+        if self.entity_search is None:
+            self.entity_search = EntitySearch()
+        try:
+            job = SearchLayerJob(layer, self.entity_search, 'name', selected_only=bool(layer.selectedFeatureCount()))
+        except ValueError as e:
+            QgsMessageLog.logMessage(str(e), OSMWD_TOOLS_LOG, Qgis.Warning)
+            return
+        self.search_results[layer.id()] = job.results
+        self.perform_query_in_background_thread('Search Wikidata for {}'.format(layer.name()), [job])
+
+    def match_active_layer(self):
+        """
+        Matches the features of the active layer to the items found by searching Wikidata for its names,
+        only considering the items within reach of each feature
+        """
+        layer = self.iface.activeLayer()
+        if not layer or layer.type() != QgsMapLayer.VectorLayer:
+            QgsMessageLog.logMessage('Select a vector layer to match', OSMWD_TOOLS_LOG, Qgis.Warning)
+            return
+        candidate_ids = {found['id'] for results in self.search_results.get(layer.id(), {}).values()
+                         for found in results}
+        if not candidate_ids:
+            QgsMessageLog.logMessage('Search Wikidata for the names on {} first'.format(layer.name()),
+                                     OSMWD_TOOLS_LOG, Qgis.Warning)
+            return
+        if self.entity_store is None:
+            self.entity_store = EntityStore()
+        try:
+            job = MatchLayerJob(layer, self.entity_store, candidate_ids,
+                                selected_only=bool(layer.selectedFeatureCount()))
+        except ValueError as e:
+            QgsMessageLog.logMessage(str(e), OSMWD_TOOLS_LOG, Qgis.Warning)
+            return
+        self.matches[layer.id()] = job.results
+        self.perform_query_in_background_thread('Match {} to Wikidata'.format(layer.name()), [job])
+
+    def preview_cleanup_rule(self, key):
+        """
+        Invoked on every edit of a cleanup rule, the preview is only worked out once typing pauses
+        """
+        self.preview_key = key
+        self.preview_timer.start()
+
+    def start_cleanup_preview(self):
+        """
+        Applies the rule being edited to a sample of the names of the active layer, in a background thread
+        """
+        key = self.preview_key
+        if key not in self.text_edit:
+            return
+        source, flags = self.text_edit[key].pattern()
+        macros = self.cleanup_macros
+        if key in self.cleanup_positions:
+            # tried out on a copy, the engines of the other actions only change when the rules are saved
+            edited_rules = self.compiled_rules.copy()
+            try:
+                # only the rules using this one as a macro are compiled again
+                edited_rules.edit_cleanup_rule(self.cleanup_positions[key], self.line_edit[key].text(),
+                                               source, flags)
+            except (re.error, ValueError):
+                # the preview tells what is wrong
+                pass
+            else:
+                macros = edited_rules.macros
+        if self.preview_task is not None:
+            try:
+                self.preview_task.cancel()
+            except RuntimeError:
+                # the task already finished and got deleted
+                pass
+            self.preview_task = None
+        self.preview_job = None
+        label = self.dockwidget.cleanup_preview_label
+        label.setStyleSheet('')
+        layer = self.iface.activeLayer()
+        if not layer or layer.type() != QgsMapLayer.VectorLayer:
+            label.setText('Select a vector layer to preview "{}" on'.format(self.line_edit[key].text()))
+            return
+        try:
+            job = RulePreviewJob(layer, self.line_edit[key].text(), source, flags, macros,
+                                 self.show_cleanup_preview)
+        except ValueError as e:
+            label.setText(str(e))
+            return
+        label.setText('Previewing "{}" on {}...'.format(self.line_edit[key].text(), layer.name()))
+        self.preview_job = job
+        self.preview_task = PerformQueriesTask('Preview cleanup rule', [job], self, verbose=False)
+        QgsApplication.taskManager().addTask(self.preview_task)
+
+    def save_cleanup_rules(self):
+        """
+        Writes the edited cleanup rules to cleanup.json, from then on Cleanup and Interpret use them
+        """
+        edits = {}
+        for key, position in self.cleanup_positions.items():
+            replacement = self.line_edit[key].text()
+            if (replacement,) + self.text_edit[key].pattern() != self.compiled_rules.cleanup_patterns[position]:
+                edits[position] = (replacement, self.text_edit[key].contents())
+        if not edits:
+            QgsMessageLog.logMessage('No cleanup rules were changed', OSMWD_TOOLS_LOG, Qgis.Info)
+            return
+        try:
+            with PROFILER.stage('rule compile', 'save'):
+                self.compiled_rules = save_rules(self.compiled_rules, edits)
+        except (re.error, ValueError, OSError) as e:
+            QgsMessageLog.logMessage('Cleanup rules not saved: {}'.format(e), OSMWD_TOOLS_LOG, Qgis.Critical,
+                                     notifyUser=True)
+            return
+        self.cleanup_data = self.compiled_rules.data
+        self.cleanup_macros = self.compiled_rules.macros
+        self.cleanup_engine = None
+        self.interpret_engine = None
+        QgsMessageLog.logMessage('Saved {} cleanup rules'.format(len(edits)), OSMWD_TOOLS_LOG, Qgis.Info)
+
+    def show_cleanup_preview(self, job):
+        """Invoked in the main thread when a preview is ready"""
+        if job is not self.preview_job:
+            # the rule was edited again in the meantime
+            return
+        self.preview_task = None
+        label = self.dockwidget.cleanup_preview_label
+        table = self.dockwidget.cleanup_preview_table
+        table.setRowCount(0)
+        if job.error:
+            label.setStyleSheet('color: red;')
+            label.setText(job.error)
+            return
+        label.setText('{} names change in a sample of {} features of {}{}'.format(
+            len(job.rows), job.sampled_count, job.layer.name(),
+            '' if job.complete else ', the preview stopped early'))
+        table.setRowCount(len(job.rows))
+        for row, (before, after, count) in enumerate(job.rows):
+            table.setItem(row, 0, QTableWidgetItem(before))
+            table.setItem(row, 1, QTableWidgetItem(after))
+            table.setItem(row, 2, QTableWidgetItem(str(count)))
+
+    def interpret_active_layer(self):
+        """
+        Works out the OSM tags and Wikidata statements for the features of the active layer,
+        only for the selected features if there is a selection
+        """
+        layer = self.iface.activeLayer()
+        if not layer or layer.type() != QgsMapLayer.VectorLayer:
+            QgsMessageLog.logMessage('Select a vector layer to interpret', OSMWD_TOOLS_LOG, Qgis.Warning)
+            return
+        if self.interpret_engine is None:
+            self.interpret_engine = self.compiled_rules.interpret_engine
+        job = InterpretLayerJob(layer, self.interpret_engine, selected_only=bool(layer.selectedFeatureCount()))
+        self.interpretations[layer.id()] = job.results
+        self.perform_query_in_background_thread('Interpret {}'.format(layer.name()), [job])
+
+    def export_osmchange(self):
+        """
+        Writes the OSM tags the interpretation of the active layer adds to an osmChange file
+        """
+        layer = self.iface.activeLayer()
+        if not layer or layer.type() != QgsMapLayer.VectorLayer:
+            QgsMessageLog.logMessage('Select a vector layer to export', OSMWD_TOOLS_LOG, Qgis.Warning)
+            return
+        interpretations = self.interpretations.get(layer.id())
+        if not interpretations:
+            QgsMessageLog.logMessage('Interpret {} first'.format(layer.name()), OSMWD_TOOLS_LOG, Qgis.Warning)
+            return
+        path, file_filter = QFileDialog.getSaveFileName(self.dockwidget, 'Export osmChange',
+                                                        layer.name() + '.osc', 'osmChange (*.osc)')
+        if not path:
+            return
+        job = OsmChangeExportJob(layer, interpretations, path)
+        self.perform_query_in_background_thread('Export osmChange for {}'.format(layer.name()), [job])
 
     def clear_selection_on_all_layers(self):
         for layer in self.iface.layerTreeView().selectedLayers():
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+ Headless benchmarks of the cleanup rules, the property catalog, the combo boxes and the dock
+
+ python -m OSM_Wikidata.benchmark [--sizes 10000,100000,1000000] [--repeat 3] [--output results.json]
+                                  [--compare earlier.json]
+
+ Run it from the folder that holds the plugin folder. Qt gets the offscreen platform and the dock
+ a stub iface, so no display is needed. Without qgis and PyQt5 the widget benchmarks are skipped,
+ the others still run. The results go to benchmark_results/ as JSON, together with the commit and
+ the versions they were measured with; --compare prints how every timing changed since an earlier run.
+ It exits with 1 when a latency is over its budget, e.g. a property search over SEARCH_BUDGET_MS.
+ The names are generated from a fixed seed, so every run cleans the same ones.
+ Not part of the plugin zip
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from .cleanup_engine import CLEANUP_FILE, load_cleanup_data
+from .property_catalog import CATALOG_FILE, JSON_FILE, PropertyCatalog, build_catalog
+from .property_search import PropertySearchIndex
+from .rule_cache import CompiledRules, load_rules
+
+parent_dir = Path(__file__).resolve().parent
+
+RESULTS_DIR = parent_dir / 'benchmark_results'
+SIZES = (10000, 100000, 1000000)
+REPEAT = 3
+SEED = 2020
+# queries typed in a PropertiesComboBox, ids, prefixes, words of aliases and descriptions and typos
+SEARCH_QUERIES = ('P31', '625', 'inst', 'instance of', 'coord', 'population', 'located in', 'operator', 'oprator',
+                  'head', 'country', 'isced', 'denomination', 'religion', 'start time', 'official website',
+                  'poplation', 'wikimedia', 'x', 'number of students')
+# milliseconds the 95th percentile of the searches may take, the index is built before anybody types
+SEARCH_BUDGET_MS = 5.0
+COMBO_BOXES = 20
+COMBO_ITEMS = 10000
+
+# Parts of synthetic school names, with the spellings the cleanup rules are for
+SAINTS = ('St.', 'St', 'ST', 'Saint', 'Saintt', 'St. Micheal', 'St Magdalane', 'St. Lawrance', 'St Domnic',
+          'Stelizabeth', 'St. Aloysious', 'St Mary', "St. Peter's", 'Secret Heart', 'Sacred Heart', 'Devine')
+KINDS = ('P/S', 'P.S', 'Primary School', 'Pr. Sch', 'Prim Sch.', 'Primary Sch', 'PS', 'S.S', 'SS', 'S.S.S',
+         'Secondary School', 'N/P', 'Nursery/Primary', 'Nur/Pr', 'ECD', 'E.C.D Centre', 'Early Child Dev. Cntr',
+         'Modern Academy', 'Mordern Acadamy', 'Junior School', 'Juniour School', 'Prep School', 'Preparatory',
+         'International School', 'Intergrated School', 'Business Coolege', 'Technical Institute', 'Chool')
+FOUNDERS = ('', '', '', ' RC', ' R.C', ' R.C.C', ' SDA', ' S.D.A', ' Seventh Day Adventist', ' C/U', ' C.O.U',
+            ' COU', ' Muslim', ' Quaran', ' Islamic', ' Boarding', ' Bourding')
+SYLLABLES = ('ka', 'ki', 'mu', 'mba', 'nya', 'la', 'bu', 'ga', 'ru', 'ko', 'we', 'ndi', 'se', 'to', 'li', 'ma')
+
+
+def school_names(count, seed=SEED):
+    """
+    count names like 'St. Micheal Kabuga P/S RC', from seed. Place names repeat, but between
+    70 and 90 % of the names are distinct, so clean_many can't get by on its cache of cleaned names
+    """
+    chooser = random.Random(seed)
+    places = [''.join(chooser.choice(SYLLABLES) for i in range(chooser.randint(2, 4))).capitalize()
+              for j in range(max(count // 400, 50))]
+    names = []
+    for i in range(count):
+        parts = []
+        if chooser.random() < 0.3:
+            parts.append(chooser.choice(SAINTS))
+        parts.append(chooser.choice(places))
+        parts.append(chooser.choice(KINDS))
+        names.append(' '.join(parts) + chooser.choice(FOUNDERS))
+    return names
+
+
+def best_of(repeat, function, *args):
+    """:returns: (the shortest wall time of repeat calls in seconds, what the last call returned)"""
+    best = None
+    result = None
+    for i in range(repeat):
+        started = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - started
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def latencies(seconds):
+    """Summary of a list of timings, in milliseconds"""
+    seconds = sorted(seconds)
+    return {'median_ms': 1000 * statistics.median(seconds),
+            'p95_ms': 1000 * seconds[min(len(seconds) - 1, int(0.95 * len(seconds)))],
+            'max_ms': 1000 * seconds[-1]}
+
+
+def bench_rules(repeat, scratch_dir):
+    results = {}
+    data = load_cleanup_data()
+    results['rule compile'] = {'seconds': best_of(repeat, CompiledRules, data)[0]}
+    cache_file = Path(scratch_dir) / 'rules.cache'
+    load_rules(CLEANUP_FILE, cache_file)
+    results['rule cache load'] = {'seconds': best_of(repeat, load_rules, CLEANUP_FILE, cache_file)[0]}
+    return results
+
+
+def bench_cleanup(sizes, repeat):
+    engine = CompiledRules(load_cleanup_data()).cleanup_engine
+    results = {}
+    for size in sizes:
+        names = school_names(size)
+
+        def clean_all():
+            return sum(1 for name, cleaned in zip(names, engine.clean_many(names)) if cleaned != name)
+
+        seconds, changed = best_of(repeat, clean_all)
+        results['cleanup {}'.format(size)] = {'seconds': seconds, 'names': size, 'distinct': len(set(names)),
+                                              'changed': changed, 'names_per_second': size / seconds}
+    return results
+
+
+def bench_catalog(repeat, scratch_dir):
+    results = {}
+    if JSON_FILE.exists():
+        catalog_file = Path(scratch_dir) / 'wd_properties.catalog'
+        results['catalog build'] = {'seconds': best_of(repeat, build_catalog, JSON_FILE, catalog_file)[0]}
+    else:
+        catalog_file = CATALOG_FILE
+
+    def load():
+        catalog = PropertyCatalog(catalog_file, json_file=None)
+        labels = [catalog[wd_property] for wd_property in catalog]
+        catalog.close()
+        return labels
+
+    seconds, labels = best_of(repeat, load)
+    results['catalog load'] = {'seconds': seconds, 'properties': len(labels)}
+    catalog = PropertyCatalog(catalog_file, json_file=None)
+    seconds, index = best_of(repeat, PropertySearchIndex.from_catalog, catalog)
+    results['catalog index'] = {'seconds': seconds, 'properties': len(index)}
+    timings = []
+    for i in range(repeat):
+        for query in SEARCH_QUERIES:
+            started = time.perf_counter()
+            index.search_ids(query)
+            timings.append(time.perf_counter() - started)
+    # seconds for one round of the queries, whatever repeat is
+    results['catalog search'] = dict(latencies(timings), seconds=sum(timings) / repeat, queries=len(SEARCH_QUERIES),
+                                     budget_ms=SEARCH_BUDGET_MS)
+    catalog.close()
+    return results
+
+
+class StubIface:
+    """
+    Just enough of QgisInterface for the dock: a main window and a toolbar,
+    everything else does nothing and returns None
+    """
+    def __init__(self):
+        from PyQt5.QtWidgets import QMainWindow
+        self.main_window = QMainWindow()
+        self.dock_widgets = []
+
+    def mainWindow(self):
+        return self.main_window
+
+    def addToolBar(self, name):
+        return self.main_window.addToolBar(name)
+
+    def addDockWidget(self, area, dock_widget):
+        self.dock_widgets.append(dock_widget)
+        self.main_window.addDockWidget(area, dock_widget)
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def start_qgis():
+    """:returns: the QgsApplication, offscreen"""
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from qgis.core import QgsApplication
+    application = QgsApplication([], True)
+    application.initQgis()
+    return application
+
+
+def bench_widgets(repeat, application):
+    from PyQt5.QtWidgets import QApplication
+    from qgis.core import Qgis
+    from .OSM_Wikidata import OSMWikidataDock, OSMWDComboBox, PropertiesComboBox, PropertyListModel
+
+    results = {'qgis': Qgis.QGIS_VERSION}
+
+    # What the user waits for: the toolbar click up to the dock being painted, then every tab the first time
+    iface = StubIface()
+    dock = OSMWikidataDock(iface)
+    dock.initGui()
+    started = time.perf_counter()
+    dock.run()
+    QApplication.processEvents()
+    results['dock cold start'] = {'seconds': time.perf_counter() - started,
+                                  'rules_from_cache': dock.compiled_rules.cached}
+    tabs_widget = dock.dockwidget.tabs_widget
+    for index in range(tabs_widget.count()):
+        started = time.perf_counter()
+        tabs_widget.setCurrentIndex(index)
+        QApplication.processEvents()
+        results['tab {}'.format(tabs_widget.tabText(index))] = {'seconds': time.perf_counter() - started}
+
+    catalog = PropertyCatalog()
+    seconds, model = best_of(repeat, PropertyListModel, catalog)
+    results['property model'] = {'seconds': seconds, 'properties': len(model.ids)}
+    seconds, boxes = best_of(repeat, lambda: [PropertiesComboBox(model) for i in range(COMBO_BOXES)])
+    results['PropertiesComboBox x{}'.format(COMBO_BOXES)] = {'seconds': seconds,
+                                                             'per_box_ms': 1000 * seconds / len(boxes)}
+
+    texts = sorted(set(school_names(COMBO_ITEMS)))
+
+    def add_items():
+        box = OSMWDComboBox('benchmark', 'name')
+        box.add_items(texts)
+        return box
+
+    def add_item():
+        box = OSMWDComboBox('benchmark', 'name')
+        for text in texts:
+            box.add_item(text, text)
+        return box
+
+    seconds, box = best_of(repeat, add_items)
+    results['OSMWDComboBox add_items'] = {'seconds': seconds, 'items': box.count()}
+    seconds, box = best_of(repeat, add_item)
+    results['OSMWDComboBox add_item'] = {'seconds': seconds, 'items': box.count()}
+    seconds, rows = best_of(repeat, lambda: [box.find_row(text) for text in texts])
+    results['OSMWDComboBox find_row'] = {'seconds': seconds, 'lookups': len(rows)}
+    dock.dockwidget.close()
+    catalog.close()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=str(parent_dir), capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(sizes=SIZES, repeat=REPEAT):
+    """:returns: the results of all benchmarks, as they are written to JSON"""
+    report = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(),
+              'python': platform.python_version(), 'platform': platform.platform(), 'repeat': repeat,
+              'benchmarks': {}, 'skipped': {}}
+    benchmarks = report['benchmarks']
+    scratch_dir = tempfile.mkdtemp(prefix='osmwd_benchmark_')
+    try:
+        benchmarks.update(bench_rules(repeat, scratch_dir))
+        benchmarks.update(bench_cleanup(sizes, repeat))
+        benchmarks.update(bench_catalog(repeat, scratch_dir))
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    try:
+        application = start_qgis()
+    except ImportError as e:
+        report['skipped']['widgets'] = 'qgis and PyQt5 are needed: {}'.format(e)
+    else:
+        widget_results = bench_widgets(repeat, application)
+        report['qgis'] = widget_results.pop('qgis')
+        benchmarks.update(widget_results)
+        application.exitQgis()
+    return report
+
+
+def over_budget(report):
+    """Lines for the benchmarks whose 95th percentile is over their budget_ms"""
+    return ['{} over budget: p95 {:.1f} ms, budget {:.1f} ms'.format(name, result['p95_ms'], result['budget_ms'])
+            for name, result in report['benchmarks'].items()
+            if 'budget_ms' in result and result['p95_ms'] > result['budget_ms']]
+
+
+def compare(report, earlier):
+    """Lines with the timings of report against those of earlier, slower first"""
+    rows = []
+    for name, result in report['benchmarks'].items():
+        before = earlier.get('benchmarks', {}).get(name)
+        if before and before.get('seconds') and result.get('seconds') is not None:
+            rows.append((result['seconds'] / before['seconds'], name, before['seconds'], result['seconds']))
+    return ['{:<32} {:>10.1f} ms -> {:>10.1f} ms  {:+.0%}'.format(name, 1000 * before, 1000 * after, ratio - 1)
+            for ratio, name, before, after in sorted(rows, reverse=True)]
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Headless benchmarks of the OSM_Wikidata plugin')
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help='numbers of names to clean up, comma separated')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='the best of this many runs counts')
+    parser.add_argument('--output', help='JSON file for the results, by default in benchmark_results/')
+    parser.add_argument('--compare', help='JSON file of an earlier run')
+    options = parser.parse_args(arguments)
+
+    report = run([int(size) for size in options.sizes.split(',')], options.repeat)
+    if options.output:
+        output = Path(options.output)
+    else:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        output = RESULTS_DIR / 'benchmark_{}.json'.format(report['started'].replace(':', '').replace('-', ''))
+    with open(output, 'w', encoding='utf-8') as handle:
+        json.dump(report, handle, indent=1)
+
+    for name, result in report['benchmarks'].items():
+        print('{:<32} {:>10.1f} ms'.format(name, 1000 * result['seconds']))
+    for name, reason in report['skipped'].items():
+        print('{} skipped, {}'.format(name, reason))
+    if options.compare:
+        with open(options.compare, encoding='utf-8') as handle:
+            print('\n'.join(['', 'Compared to {}:'.format(options.compare)] + compare(report, json.load(handle))))
+    print('Results written to {}'.format(output))
+    over = over_budget(report)
+    for line in over:
+        print(line)
+    return 1 if over else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
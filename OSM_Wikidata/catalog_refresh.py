@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+ Refreshes "WD properties.json" and the property catalog from the Wikidata Query Service
+
+ "WD properties.rq" is a template for one page of properties, ordered by numeric id, with
+ $after and $limit filled in. The pages follow each other by id, starting after the highest id
+ already in the catalog, so later runs only fetch the properties that were created since.
+ The bindings of every page are decoded one at a time while the response comes in.
+
+ python catalog_refresh.py [--full]
+"""
+import codecs
+import json
+import sys
+from itertools import chain
+from pathlib import Path
+from string import Template
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+try:
+    from .property_catalog import CATALOG_FILE, JSON_FILE, PropertyCatalog, numeric_id, property_id, write_catalog
+except ImportError:
+    # run as a script from the plugin folder, like deploy.py
+    from property_catalog import CATALOG_FILE, JSON_FILE, PropertyCatalog, numeric_id, property_id, write_catalog
+
+parent_dir = Path(__file__).resolve().parent
+
+QUERY_FILE = parent_dir / 'WD properties.rq'
+SPARQL_ENDPOINT = 'https://query.wikidata.org/sparql'
+USER_AGENT = 'OSM_Wikidata QGIS plugin (https://github.com/thjack/QGIS-plugins)'
+PAGE_SIZE = 1000
+TIMEOUT = 120
+CHUNK_SIZE = 1 << 16
+
+COLUMNS = ('propertyLabel', 'propertyDescription', 'altLabel_list')
+
+
+def stream_bindings(handle, chunk_size=CHUNK_SIZE):
+    """
+    Generator yielding the bindings of a SPARQL JSON result one by one, as {variable: value},
+    without reading the whole response first
+
+    :param handle: binary file-like object, e.g. an HTTP response
+    """
+    decoder = json.JSONDecoder()
+    # characters can be split over chunks
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    text = ''
+    position = 0
+    at_end = False
+
+    def read_more():
+        nonlocal text, position, at_end
+        chunk = handle.read(chunk_size)
+        at_end = not chunk
+        text = text[position:] + utf8.decode(chunk, final=at_end)
+        position = 0
+
+    while text.find('"bindings"') < 0:
+        if at_end:
+            raise ValueError('No bindings in the SPARQL result')
+        read_more()
+    position = text.find('"bindings"') + len('"bindings"')
+    while text.find('[', position) < 0:
+        if at_end:
+            raise ValueError('SPARQL result ends before its bindings')
+        read_more()
+    position = text.find('[', position) + 1
+
+    while True:
+        while position < len(text) and text[position] in ' \t\r\n,':
+            position += 1
+        if position == len(text):
+            if at_end:
+                raise ValueError('SPARQL result ends in the middle of its bindings')
+            read_more()
+            continue
+        if text[position] == ']':
+            return
+        try:
+            binding, end = decoder.raw_decode(text, position)
+        except ValueError:
+            if at_end:
+                raise
+            # the binding isn't complete yet
+            read_more()
+            continue
+        position = end
+        yield {variable: value['value'] for variable, value in binding.items()}
+
+
+def page_query(after, limit, query_file=QUERY_FILE):
+    with open(query_file, encoding='utf-8') as handle:
+        return Template(handle.read()).substitute(after=after, limit=limit)
+
+
+def fetch_page(after, limit, endpoint=SPARQL_ENDPOINT):
+    """Generator of the (at most limit) properties with a numeric id above after, in the format of the JSON file"""
+    request = Request(endpoint, data=urlencode({'query': page_query(after, limit)}).encode('utf-8'),
+                      headers={'User-Agent': USER_AGENT, 'Accept': 'application/sparql-results+json'})
+    with urlopen(request, timeout=TIMEOUT) as response:
+        for binding in stream_bindings(response):
+            entry = {'property': property_id(binding['property'])}
+            for column in COLUMNS:
+                entry[column] = binding.get(column, '')
+            yield entry
+
+
+def fetch_properties(after=0, endpoint=SPARQL_ENDPOINT, page_size=PAGE_SIZE):
+    """Generator of all the properties with a numeric id above after, one page after another"""
+    while True:
+        count = 0
+        for entry in fetch_page(after, page_size, endpoint):
+            count += 1
+            after = numeric_id(entry['property'])
+            yield entry
+        if count < page_size:
+            return
+
+
+def catalog_entries(catalog_file=CATALOG_FILE):
+    """Generator of the properties in the catalog, in the format of the JSON file"""
+    catalog = PropertyCatalog(catalog_file, json_file=None)
+    try:
+        for wd_property, label, description, aliases in catalog.entries():
+            yield {'property': wd_property, 'propertyLabel': label, 'propertyDescription': description,
+                   'altLabel_list': ', '.join(aliases)}
+    finally:
+        catalog.close()
+
+
+def written_to_json(entries, json_file):
+    """
+    Passes the entries on, writing them to json_file on the way.
+    The file is only replaced once the last entry went by
+    """
+    tmp_file = Path(str(json_file) + '.tmp')
+    with open(tmp_file, 'w', encoding='utf-8') as handle:
+        handle.write('[')
+        for number, entry in enumerate(entries):
+            handle.write(',\n  ' if number else '\n  ')
+            json.dump(entry, handle, ensure_ascii=False)
+            yield entry
+        handle.write('\n]\n')
+    tmp_file.replace(json_file)
+
+
+def refresh(json_file=JSON_FILE, catalog_file=CATALOG_FILE, endpoint=SPARQL_ENDPOINT, page_size=PAGE_SIZE,
+            full=False):
+    """
+    Adds the properties created since the last refresh to the JSON file and the catalog,
+    or fetches all of them again when full
+
+    :returns: the number of properties that were fetched
+    """
+    after = 0
+    known = ()
+    if not full and (Path(catalog_file).exists() or Path(json_file).exists()):
+        # (re)builds the catalog from the JSON file if needed
+        catalog = PropertyCatalog(catalog_file, json_file)
+        if len(catalog):
+            after = catalog.max_id
+            known = catalog_entries(catalog_file)
+        catalog.close()
+    fetched = 0
+
+    def counted(entries):
+        nonlocal fetched
+        for entry in entries:
+            fetched += 1
+            yield entry
+
+    new = counted(fetch_properties(after, endpoint, page_size))
+    write_catalog(written_to_json(chain(known, new), json_file), catalog_file)
+    return fetched
+
+
+if __name__ == '__main__':
+    print('{} properties fetched'.format(refresh(full='--full' in sys.argv)))
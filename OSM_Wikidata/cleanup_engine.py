@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+ Headless engine that applies the "cleanup" rules from cleanup.json to names
+
+ It doesn't import Qt or QGIS, so it can be used from batch jobs as well as from the dock
+"""
+import json
+import re
+import time
+from pathlib import Path
+
+from .literal_index import LiteralIndex, required_literals
+
+CLEANUP_FILE = Path(__file__).resolve().parent / 'cleanup.json'
+
+MACRO = re.compile(r'<<(.+?)>>')
+INLINE_FLAGS = re.compile(r'^\(\?([aiLmsux]+)\)')
+
+FLAG_LETTERS = {
+    'a': re.ASCII,
+    'i': re.IGNORECASE,
+    'L': re.LOCALE,
+    'm': re.MULTILINE,
+    's': re.DOTALL,
+    'u': re.UNICODE,
+    'x': re.VERBOSE,
+}
+
+# Only these flags can be switched on and off for part of a pattern
+SCOPED_FLAGS = 'imsx'
+
+# A preview shows at most this many changed names, worked out in at most this many seconds
+PREVIEW_ROWS = 200
+PREVIEW_TIME_BUDGET = 0.25
+
+
+def load_cleanup_data(cleanup_file=CLEANUP_FILE):
+    with open(cleanup_file, encoding='utf-8') as data_file:
+        return json.load(data_file)
+
+
+def join_fragments(contents):
+    """
+    A rule is stored either as a single string or as a list of lines.
+    A list of lines is a verbose pattern, with a comment explaining every line
+
+    :returns: (pattern source, flags)
+    """
+    if isinstance(contents, str):
+        source = contents
+        flags = 0
+    else:
+        source = '\n'.join(contents)
+        flags = re.VERBOSE if len(contents) > 1 else 0
+    inline = INLINE_FLAGS.match(source)
+    if inline:
+        for letter in inline.group(1):
+            flags |= FLAG_LETTERS[letter]
+        source = source[inline.end():]
+    return source, flags
+
+
+def scoped_group(source, flags):
+    """
+    Wraps a pattern in a group that carries its own flags,
+    so it can be embedded in a pattern that was compiled with other flags
+    """
+    on = ''.join(letter for letter in SCOPED_FLAGS if flags & FLAG_LETTERS[letter])
+    off = ''.join(letter for letter in SCOPED_FLAGS if not flags & FLAG_LETTERS[letter])
+    if flags & re.VERBOSE:
+        # a trailing comment would otherwise swallow the closing parenthesis
+        source += '\n'
+    return '(?{}-{}:{})'.format(on, off, source) if off else '(?{}:{})'.format(on, source)
+
+
+def macro_sources(data):
+    """
+    All the cleanup rules, by name, that can be referred to as <<name>>
+
+    The names are stripped, so " Nursery and Primary School" can be used as <<Nursery and Primary School>>.
+    When a name occurs more than once, the first rule wins.
+    """
+    macros = {}
+    for tag in data.get('cleanup', {}):
+        for entry in data['cleanup'][tag]:
+            for key, contents in entry.items():
+                macros.setdefault(key.strip(), join_fragments(contents))
+    return macros
+
+
+def cleanup_patterns(data, tag='name'):
+    """Generator of the (replacement, source, flags) of the cleanup rules for tag, in order, macros not expanded"""
+    for entry in data['cleanup'][tag]:
+        for replacement, contents in entry.items():
+            source, flags = join_fragments(contents)
+            yield replacement, source, flags
+
+
+def expand_macros(source, macros, _seen=()):
+    """
+    Replaces every <<name>> in source with the pattern of the rule called name.
+    A name without a rule stands for its literal text, e.g. <<Primary School>>
+    """
+    def replace(match):
+        name = match.group(1)
+        if name not in macros:
+            return re.escape(name)
+        if name in _seen:
+            raise ValueError('Macro <<{}>> refers to itself: {}'.format(name, ' -> '.join(_seen + (name,))))
+        macro_source, macro_flags = macros[name]
+        return scoped_group(expand_macros(macro_source, macros, _seen + (name,)), macro_flags)
+
+    if '<<' not in source:
+        return source
+    return MACRO.sub(replace, source)
+
+
+def name_or_rule(name, expanded):
+    """
+    What <<name>> stands for in an interpret key when it is a cleanup rule. Interpret rules see
+    the names after cleanup, when the rule has put its name in place of what it matched,
+    e.g. "Secondary School" for "S.S.", so either matches
+    """
+    return '(?:{}|{})'.format(expanded, re.escape(name))
+
+
+def expand_key(source, macros):
+    """Like expand_macros, for the pattern of an interpret key, see name_or_rule"""
+    def replace(match):
+        name = match.group(1)
+        if name not in macros:
+            return re.escape(name)
+        return name_or_rule(name, expand_macros(match.group(0), macros))
+
+    if '<<' not in source:
+        return source
+    return MACRO.sub(replace, source)
+
+
+def weak_literal(literal):
+    """Single letters are in nearly every name, rules that only require one are always tried"""
+    return len(literal) < 2 and (not literal or literal.isalnum())
+
+
+def overlap(replacement, literal):
+    """Whether inserting replacement into a name can make literal appear where it wasn't before"""
+    if not replacement:
+        # removing text joins what was on either side
+        return True
+    if literal in replacement or replacement in literal:
+        return True
+    for length in range(1, min(len(replacement), len(literal))):
+        if replacement.endswith(literal[:length]) or replacement.startswith(literal[-length:]):
+            return True
+    return False
+
+
+class CleanupRule:
+    """
+    One compiled cleanup rule: every match of regex gets replaced by replacement
+
+    literals holds the (casefolded) strings of which at least one has to be in a name
+    for the rule to match, None if the rule can match any name
+    """
+    __slots__ = ('replacement', 'source', 'flags', '_regex', 'template', 'literals')
+
+    def __init__(self, replacement, source, flags=0):
+        self.replacement = replacement
+        self.source = source
+        self.flags = flags
+        self._regex = re.compile(source, flags)
+        # The replacement is literal text, re.sub would interpret backslashes in it
+        self.template = replacement.replace('\\', r'\\')
+        self.literals = required_literals(source, flags)
+
+    def __repr__(self):
+        return 'CleanupRule({!r}, {!r})'.format(self.replacement, self.source)
+
+    @property
+    def regex(self):
+        """Compiled when first used after unpickling, see rule_cache"""
+        if self._regex is None:
+            self._regex = re.compile(self.source, self.flags)
+        return self._regex
+
+    def __getstate__(self):
+        return {slot: None if slot == '_regex' else getattr(self, slot) for slot in self.__slots__}
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+
+def preview_rule(rule, names, limit=PREVIEW_ROWS, time_budget=PREVIEW_TIME_BUDGET):
+    """
+    Applies a single rule to a sample of names, to show its effect while it is being edited
+
+    :param rule: CleanupRule
+    :param names: mapping of name: number of features with that name
+    :returns: (list of (name, cleaned up name, number of features), whether every name was tried)
+    """
+    deadline = time.perf_counter() + time_budget
+    substitute = rule.regex.sub
+    template = rule.template
+    rows = []
+    for name, count in names.items():
+        if len(rows) >= limit or time.perf_counter() > deadline:
+            return rows, False
+        result = substitute(template, name)
+        if result != name:
+            rows.append((name, result, count))
+    return rows, True
+
+
+class CleanupEngine:
+    """
+    Applies a list of cleanup rules, in order, to names
+
+    The rules are compiled once, when the engine is created. Their required literals go
+    into a LiteralIndex, so for every name only the rules that can match are tried
+    """
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.index = LiteralIndex()
+        self.always = 0
+        indexed = []
+        for position, rule in enumerate(self.rules):
+            if rule.literals and not any(weak_literal(literal) for literal in rule.literals):
+                for literal in rule.literals:
+                    self.index.add(literal, 1 << position)
+                indexed.append((position, rule.literals))
+            else:
+                self.always |= 1 << position
+        self.index.build()
+
+        # For every rule, the later indexed rules whose literal its replacement can bring in
+        self.introduces = []
+        for position, rule in enumerate(self.rules):
+            replacement = rule.replacement.casefold()
+            mask = 0
+            for later, literals in indexed:
+                if later > position and any(overlap(replacement, literal) for literal in literals):
+                    mask |= 1 << later
+            self.introduces.append(mask)
+
+        self._plans = {}
+
+    def __getstate__(self):
+        # the plans hold the compiled rules, they are made again as names come in
+        state = dict(self.__dict__)
+        state['_plans'] = {}
+        return state
+
+    def _plan(self, mask):
+        """The rules of a candidates mask, in order, ready to be applied"""
+        plan = []
+        remaining = mask
+        while remaining:
+            lowest = remaining & -remaining
+            position = lowest.bit_length() - 1
+            plan.append((position, self.rules[position].regex.subn, self.rules[position].template))
+            remaining ^= lowest
+        plan = self._plans[mask] = tuple(plan)
+        return plan
+
+    @classmethod
+    def from_data(cls, data, tag='name', expand=None):
+        """:param expand: callable expanding the macros in a pattern, e.g. MacroGraph.expand"""
+        if expand is None:
+            macros = macro_sources(data)
+            expand = lambda source: expand_macros(source, macros)
+        return cls([CleanupRule(replacement, expand(source), flags)
+                    for replacement, source, flags in cleanup_patterns(data, tag)])
+
+    @classmethod
+    def from_file(cls, cleanup_file=CLEANUP_FILE, tag='name'):
+        return cls.from_data(load_cleanup_data(cleanup_file), tag)
+
+    def candidates(self, name):
+        """Bit mask of the rules that can match name, bit n stands for self.rules[n]"""
+        return self.index.scan(name.casefold()) | self.always
+
+    def clean(self, name):
+        plans = self._plans
+        mask = self.candidates(name)
+        while True:
+            plan = plans.get(mask) or self._plan(mask)
+            for position, substitute, template in plan:
+                result, count = substitute(template, name)
+                if count and result != name:
+                    name = result
+                    later = mask >> (position + 1) << (position + 1)
+                    if self.introduces[position]:
+                        later |= self.candidates(name) & self.introduces[position]
+                    mask = later
+                    break
+            else:
+                return name
+
+    def clean_many(self, names):
+        """
+        Generator yielding the cleaned version of every name
+
+        Names of schools repeat a lot, so every distinct name is only cleaned once.
+        Values that are not strings (NULL attributes) are passed through unchanged
+        """
+        clean = self.clean
+        cleaned = {}
+        for name in names:
+            if not isinstance(name, str):
+                yield name
+                continue
+            if name in cleaned:
+                yield cleaned[name]
+                continue
+            result = clean(name)
+            cleaned[name] = result
+            yield result
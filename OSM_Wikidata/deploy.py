@@ -36,10 +36,32 @@ if __name__=="__main__":
             else:
                 fh.write(line)
 
+    from property_catalog import build_catalog
+    build_catalog()
+
     zf = zipfile.ZipFile(grandparent_dir / ('ActualizarMedidas' + version + '.zip'), mode='w')
 
     try:
         for f in ["OSM_Wikidata.py",
+                  "cleanup_engine.py",
+                  "entity_search.py",
+                  "entity_store.py",
+                  "interpret_engine.py",
+                  "layer_jobs.py",
+                  "literal_index.py",
+                  "macro_graph.py",
+                  "osm_import.py",
+                  "osmchange.py",
+                  "overpass.py",
+                  "profiling.py",
+                  "property_catalog.py",
+                  "property_search.py",
+                  "regex_guard.py",
+                  "rule_cache.py",
+                  "spatial_matcher.py",
+                  "statement_writer.py",
+                  "task_scheduler.py",
+                  "wd_properties.catalog",
                   "__init__.py",
                   "metadata.txt",
                   "deploy.py",
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+ Bulk wbsearchentities lookups, to find the Wikidata items for the names of OSM features
+
+ The searches run concurrently on an asyncio event loop, at most concurrency at a time and
+ no more than rate per second. The HTTP requests themselves are done by urllib in a thread pool,
+ so nothing outside of the standard library is needed. Failed requests are retried with
+ exponential backoff, a search the API turns down for good fails on its own without stopping the others.
+ Every distinct name is only searched for once and the results are kept in SQLite, next to the entities of EntityStore
+"""
+import asyncio
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from .entity_store import API_URL, BACKOFF, DB_FILE, MAXLAG, RETRIES, TIMEOUT, USER_AGENT, retry_delay
+
+CONCURRENCY = 8
+# requests per second
+RATE = 10
+# seconds the results of a search are reused
+MAX_AGE = 30 * 24 * 3600
+LIMIT = 7
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS searches (
+    query TEXT NOT NULL,
+    language TEXT NOT NULL,
+    type TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    results TEXT NOT NULL,
+    PRIMARY KEY (query, language, type)
+)
+'''
+
+
+class RetryableError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def normalize(query):
+    """Searches that only differ in white space are the same search"""
+    return ' '.join(query.split())
+
+
+class TokenBucket:
+    """Lets through rate acquisitions per second on average, and bursts of up to capacity"""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class EntitySearch:
+    """
+    search_many(['Kampala SDA Primary School', ...]) returns, per name, the list of
+    search results, dicts with id, label and description, best match first
+    """
+    def __init__(self, db_file=DB_FILE, api_url=API_URL, language='en', entity_type='item',
+                 concurrency=CONCURRENCY, rate=RATE, retries=RETRIES, backoff=BACKOFF, max_age=MAX_AGE,
+                 limit=LIMIT):
+        self.db_file = db_file
+        self.api_url = api_url
+        self.language = language
+        self.entity_type = entity_type
+        self.concurrency = concurrency
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.max_age = max_age
+        self.limit = limit
+        self.request_count = 0
+        self.failed = {}
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(str(self.db_file), check_same_thread=False)
+            self._connection.execute(SCHEMA)
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+        self._connection = None
+
+    def cached(self, queries):
+        """:returns: dict of query: results, for the queries searched for less than max_age ago"""
+        oldest = time.time() - self.max_age
+        results = {}
+        queries = list(queries)
+        for start in range(0, len(queries), 500):
+            batch = queries[start:start + 500]
+            cursor = self.connection.execute(
+                'SELECT query, results FROM searches WHERE language = ? AND type = ? AND fetched > ? '
+                'AND query IN ({})'.format(', '.join('?' * len(batch))),
+                [self.language, self.entity_type, oldest] + batch)
+            for query, found in cursor:
+                results[query] = json.loads(found)
+        return results
+
+    def _store(self, query, results):
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO searches (query, language, type, fetched, results) VALUES (?, ?, ?, ?, ?)',
+                (query, self.language, self.entity_type, time.time(), json.dumps(results)))
+
+    def _request(self, query):
+        """One blocking wbsearchentities request, run in the thread pool"""
+        parameters = {
+            'action': 'wbsearchentities',
+            'format': 'json',
+            'language': self.language,
+            'type': self.entity_type,
+            'limit': self.limit,
+            'search': query,
+            'maxlag': MAXLAG,
+        }
+        request = Request('{}?{}'.format(self.api_url, urlencode(parameters)), headers={'User-Agent': USER_AGENT})
+        try:
+            with urlopen(request, timeout=TIMEOUT) as response:
+                result = json.load(response)
+        except HTTPError as e:
+            if e.code == 429 or e.code >= 500:
+                raise RetryableError('HTTP {}'.format(e.code), e.headers.get('Retry-After'))
+            raise
+        except (URLError, TimeoutError, ConnectionError) as e:
+            raise RetryableError(str(e))
+        if 'error' in result:
+            if result['error'].get('code') == 'maxlag':
+                raise RetryableError('maxlag', MAXLAG)
+            raise RuntimeError('wbsearchentities failed for {!r}: {}'.format(query, result['error'].get('info')))
+        return [{'id': found['id'], 'label': found.get('label', ''), 'description': found.get('description', '')}
+                for found in result.get('search', [])]
+
+    async def _search(self, query, executor, bucket, semaphore):
+        """:returns: (query, results), results is None if the search kept failing"""
+        loop = asyncio.get_running_loop()
+        async with semaphore:
+            for attempt in range(self.retries + 1):
+                await bucket.acquire()
+                self.request_count += 1
+                try:
+                    results = await loop.run_in_executor(executor, self._request, query)
+                except RetryableError as e:
+                    if attempt == self.retries:
+                        self.failed[query] = 'failed {} times, last with {}'.format(attempt + 1, e)
+                        return query, None
+                    await asyncio.sleep(retry_delay(attempt, self.backoff, e.retry_after))
+                except (HTTPError, RuntimeError) as e:
+                    # not worth retrying, like a 400 for a search the API refuses
+                    self.failed[query] = str(e)
+                    return query, None
+                else:
+                    self._store(query, results)
+                    return query, results
+
+    async def search_many_async(self, queries, progress=None, cancelled=None):
+        """
+        :param progress: callable receiving the percentage of searches done
+        :param cancelled: callable, when it returns True no new requests are started
+        :returns: dict of normalized query: results, the queries that kept failing end up in failed
+        """
+        self.failed = {}
+        wanted = {normalize(query) for query in queries if isinstance(query, str) and query.strip()}
+        found = self.cached(wanted)
+        missing = sorted(wanted - set(found))
+        if not missing:
+            return found
+        bucket = TokenBucket(self.rate)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            searches = [asyncio.ensure_future(self._search(query, executor, bucket, semaphore))
+                        for query in missing]
+            try:
+                for done_count, future in enumerate(asyncio.as_completed(searches), 1):
+                    query, results = await future
+                    if results is not None:
+                        found[query] = results
+                    if progress is not None:
+                        progress(100.0 * done_count / len(missing))
+                    if cancelled is not None and cancelled():
+                        break
+            finally:
+                for future in searches:
+                    future.cancel()
+                await asyncio.gather(*searches, return_exceptions=True)
+        return found
+
+    def search_many(self, queries, progress=None, cancelled=None):
+        """Blocking version of search_many_async, runs its own event loop, e.g. in the thread of a QgsTask"""
+        return asyncio.run(self.search_many_async(queries, progress, cancelled))
+
+    def search(self, query):
+        return self.search_many([query]).get(normalize(query), [])
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+ Local cache of Wikidata entities in SQLite
+
+ Entities are fetched with wbgetentities, up to 50 per request, and stored with their
+ revision id. Once an entry is older than max_age only its revision id is asked for,
+ again 50 per request, and the entity is only fetched again when it was edited since.
+ Requests the API turns down because it is busy or lagging are retried with exponential backoff
+"""
+import json
+import re
+import sqlite3
+import time
+from pathlib import Path
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from .cleanup_engine import load_cleanup_data
+
+parent_dir = Path(__file__).resolve().parent
+
+DB_FILE = parent_dir / 'wd_entities.sqlite'
+API_URL = 'https://www.wikidata.org/w/api.php'
+USER_AGENT = 'OSM_Wikidata QGIS plugin (https://github.com/thjack/QGIS-plugins)'
+
+# The most ids wbgetentities accepts in one request
+BATCH_SIZE = 50
+# Seconds before a cached entity gets revalidated
+MAX_AGE = 7 * 24 * 3600
+TIMEOUT = 60
+# the API answers with an error when its replication lag is above this many seconds
+MAXLAG = 5
+RETRIES = 4
+# seconds before the first retry, doubled for every next one
+BACKOFF = 1.0
+
+ENTITY_ID = re.compile(r'^[QPL][1-9][0-9]*$')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entities (
+    id TEXT PRIMARY KEY,
+    revision INTEGER NOT NULL,
+    checked REAL NOT NULL,
+    missing INTEGER NOT NULL DEFAULT 0,
+    labels TEXT NOT NULL DEFAULT '{}',
+    claims TEXT NOT NULL DEFAULT '{}',
+    sitelinks TEXT NOT NULL DEFAULT '{}'
+)
+'''
+
+
+def collect_ids(value, ids=None):
+    """
+    The entity ids in value, which can be a tag value like 'Q104319;Q1723759'
+    or anything loaded from JSON, like the contents of cleanup.json
+
+    :returns: set of ids
+    """
+    if ids is None:
+        ids = set()
+    if isinstance(value, str):
+        for part in value.split(';'):
+            part = part.strip()
+            if ENTITY_ID.match(part):
+                ids.add(part)
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            collect_ids(key, ids)
+            collect_ids(item, ids)
+    elif isinstance(value, (list, tuple, set)):
+        for item in value:
+            collect_ids(item, ids)
+    return ids
+
+
+def retry_delay(attempt, backoff=BACKOFF, retry_after=None):
+    """
+    Seconds to wait before the next attempt: backoff doubled for every earlier attempt,
+    or the Retry-After the API sent, whichever is longer
+    """
+    delay = backoff * 2 ** attempt
+    if retry_after is not None:
+        try:
+            delay = max(delay, float(retry_after))
+        except ValueError:
+            pass
+    return delay
+
+
+def batches(items, size=BATCH_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class EntityStore:
+    """
+    get_many() returns entities as dicts with id, revision, labels (language: text), claims and sitelinks,
+    like wbgetentities has them. Ids that don't exist on Wikidata are left out.
+
+    The connection may be used from a background thread, but from one thread at a time
+    """
+    def __init__(self, db_file=DB_FILE, api_url=API_URL, languages=('en',), max_age=MAX_AGE,
+                 batch_size=BATCH_SIZE, retries=RETRIES, backoff=BACKOFF):
+        self.db_file = db_file
+        self.api_url = api_url
+        self.languages = languages
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.request_count = 0
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(str(self.db_file), check_same_thread=False)
+            self._connection.execute(SCHEMA)
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+        self._connection = None
+
+    def _request(self, ids, props):
+        """
+        One wbgetentities request, retried when the API is lagging, busy or out of reach
+
+        :returns: the entities by id
+        """
+        parameters = {
+            'action': 'wbgetentities',
+            'format': 'json',
+            'formatversion': 2,
+            'ids': '|'.join(ids),
+            'props': props,
+            'maxlag': MAXLAG,
+        }
+        if 'labels' in props:
+            parameters['languages'] = '|'.join(self.languages)
+        data = urlencode(parameters).encode('ascii')
+        for attempt in range(self.retries + 1):
+            request = Request(self.api_url, data=data, headers={'User-Agent': USER_AGENT})
+            self.request_count += 1
+            try:
+                with urlopen(request, timeout=TIMEOUT) as response:
+                    retry_after = response.headers.get('Retry-After')
+                    result = json.load(response)
+            except HTTPError as e:
+                if not (e.code == 429 or e.code >= 500) or attempt == self.retries:
+                    raise
+                retry_after = e.headers.get('Retry-After')
+            except (URLError, TimeoutError, ConnectionError):
+                if attempt == self.retries:
+                    raise
+                retry_after = None
+            else:
+                error = result.get('error')
+                if error is None:
+                    break
+                if error.get('code') != 'maxlag' or attempt == self.retries:
+                    raise RuntimeError('wbgetentities failed: {}'.format(error.get('info', error)))
+                # the API sends Retry-After with a maxlag error, MAXLAG seconds if it doesn't
+                retry_after = retry_after or MAXLAG
+            time.sleep(retry_delay(attempt, self.backoff, retry_after))
+        entities = {}
+        for entity_id, entity in result.get('entities', {}).items():
+            entities[entity_id] = entity
+            # the entity of a redirected id comes back under the id it redirects to
+            redirect = entity.get('redirects')
+            if redirect:
+                entities[redirect['from']] = entity
+        return entities
+
+    def _store(self, rows):
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO entities (id, revision, checked, missing, labels, claims, sitelinks) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def _fetch(self, ids, now):
+        for batch in batches(ids, self.batch_size):
+            entities = self._request(batch, 'info|labels|claims|sitelinks')
+            rows = []
+            for entity_id in batch:
+                entity = entities.get(entity_id, {'missing': True})
+                if entity.get('missing'):
+                    rows.append((entity_id, 0, now, 1, '{}', '{}', '{}'))
+                    continue
+                labels = {language: label['value'] for language, label in entity.get('labels', {}).items()}
+                rows.append((entity_id, entity.get('lastrevid', 0), now, 0, json.dumps(labels),
+                             json.dumps(entity.get('claims', {})), json.dumps(entity.get('sitelinks', {}))))
+            self._store(rows)
+
+    def _revalidate(self, revisions, now):
+        """
+        :param revisions: dict of id: cached revision
+        :returns: the ids that were edited since, or are gone
+        """
+        changed = []
+        for batch in batches(revisions, self.batch_size):
+            entities = self._request(batch, 'info')
+            unchanged = []
+            for entity_id in batch:
+                entity = entities.get(entity_id, {'missing': True})
+                revision = 0 if entity.get('missing') else entity.get('lastrevid', 0)
+                if revision == revisions[entity_id]:
+                    unchanged.append((now, entity_id))
+                else:
+                    changed.append(entity_id)
+            with self.connection:
+                self.connection.executemany('UPDATE entities SET checked = ? WHERE id = ?', unchanged)
+        return changed
+
+    def _cached(self, ids):
+        """:returns: dict of id: row for the ids in the cache"""
+        rows = {}
+        for batch in batches(ids, 500):
+            cursor = self.connection.execute(
+                'SELECT id, revision, checked, missing, labels, claims, sitelinks FROM entities WHERE id IN ({})'.format(
+                    ', '.join('?' * len(batch))), batch)
+            for row in cursor:
+                rows[row[0]] = row
+        return rows
+
+    def invalidate(self, ids):
+        """Forgets the ids, e.g. after editing them, they are fetched again on the next lookup"""
+        with self.connection:
+            for batch in batches(ids, 500):
+                self.connection.execute('DELETE FROM entities WHERE id IN ({})'.format(', '.join('?' * len(batch))),
+                                        batch)
+
+    def refresh(self, ids):
+        """Makes sure the ids are in the cache and not older than max_age"""
+        ids = sorted(set(ids))
+        now = time.time()
+        cached = self._cached(ids)
+        absent = [entity_id for entity_id in ids if entity_id not in cached]
+        stale = {entity_id: row[1] for entity_id, row in cached.items() if now - row[2] > self.max_age}
+        if stale:
+            absent.extend(self._revalidate(stale, now))
+        if absent:
+            self._fetch(absent, now)
+
+    def get_many(self, ids):
+        """
+        :param ids: iterable of ids like 'Q1036', anything else is ignored
+        :returns: dict of id: entity
+        """
+        ids = [entity_id for entity_id in set(ids) if isinstance(entity_id, str) and ENTITY_ID.match(entity_id)]
+        self.refresh(ids)
+        entities = {}
+        for entity_id, revision, checked, missing, labels, claims, sitelinks in self._cached(ids).values():
+            if not missing:
+                entities[entity_id] = {'id': entity_id, 'revision': revision, 'labels': json.loads(labels),
+                                       'claims': json.loads(claims), 'sitelinks': json.loads(sitelinks)}
+        return entities
+
+    def get(self, entity_id):
+        """:returns: the entity, or None if it doesn't exist"""
+        return self.get_many([entity_id]).get(entity_id)
+
+    def labels(self, ids, language='en'):
+        """:returns: dict of id: label, ids without a label in language are left out"""
+        return {entity_id: entity['labels'][language] for entity_id, entity in self.get_many(ids).items()
+                if language in entity['labels']}
+
+
+if __name__ == '__main__':
+    store = EntityStore()
+    labels = store.labels(collect_ids(load_cleanup_data()))
+    for entity_id in sorted(labels, key=lambda entity_id: int(entity_id[1:])):
+        print(entity_id, labels[entity_id])
+    print('{} requests'.format(store.request_count))
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+ Headless engine for the "Interpret" rules from cleanup.json
+
+ The value of a tag (usually name) is matched against the rules, every rule that matches
+ contributes OSM tags and labels of Wikidata statements. Rules under "*" apply to every feature
+"""
+import re
+
+from .cleanup_engine import (CLEANUP_FILE, expand_key, join_fragments, load_cleanup_data, macro_sources,
+                             weak_literal)
+from .literal_index import LiteralIndex, required_literals
+
+ALL = '*'
+
+
+def merge_tag(tags, key, value):
+    """
+    Adds a tag, when the key is already there the values are combined
+    the way OSM does it, separated by ;
+    """
+    if key not in tags or tags[key] == value:
+        tags[key] = value
+        return
+    values = tags[key].split(';')
+    for extra in value.split(';'):
+        if extra not in values:
+            values.append(extra)
+    tags[key] = ';'.join(sorted(values))
+
+
+class InterpretRule:
+    __slots__ = ('key', 'source', 'flags', '_regex', 'tags', 'statements', 'literals')
+
+    def __init__(self, key, source, flags, tags, statements):
+        self.key = key
+        self.source = source
+        self.flags = flags
+        self._regex = re.compile(source, flags)
+        self.tags = tags
+        self.statements = statements
+        self.literals = required_literals(source, flags)
+
+    def __repr__(self):
+        return 'InterpretRule({!r})'.format(self.key)
+
+    @property
+    def regex(self):
+        """Compiled when first used after unpickling, see rule_cache"""
+        if self._regex is None:
+            self._regex = re.compile(self.source, self.flags)
+        return self._regex
+
+    def __getstate__(self):
+        return {slot: None if slot == '_regex' else getattr(self, slot) for slot in self.__slots__}
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+
+class InterpretEngine:
+    """
+    Evaluates all the interpret rules against a feature
+
+    The rules for every tag are indexed by the literals they require,
+    so a value is only matched against the rules that stand a chance
+    """
+    def __init__(self, rules, general=None):
+        """
+        :param rules: dict of tag: list of InterpretRule
+        :param general: list of (tags, statements) that apply to every feature
+        """
+        self.rules = rules
+        self.general = general or []
+        self.indexes = {}
+        self.always = {}
+        for tag, tag_rules in rules.items():
+            index = LiteralIndex()
+            always = 0
+            for position, rule in enumerate(tag_rules):
+                if rule.literals and not any(weak_literal(literal) for literal in rule.literals):
+                    for literal in rule.literals:
+                        index.add(literal, 1 << position)
+                else:
+                    always |= 1 << position
+            index.build()
+            self.indexes[tag] = index
+            self.always[tag] = always
+
+    @classmethod
+    def from_data(cls, data, expand=None):
+        """:param expand: callable expanding the macros in the pattern of a key, e.g. MacroGraph.expand_key"""
+        if expand is None:
+            macros = macro_sources(data)
+            expand = lambda source: expand_key(source, macros)
+        rules = {}
+        general = []
+        for tag, entries in data.get('Interpret', {}).items():
+            for entry in entries:
+                for key, contents in entry.items():
+                    tags = {}
+                    for osm_tag in contents.get('OSM', []):
+                        for osm_key, osm_value in osm_tag.items():
+                            merge_tag(tags, osm_key, osm_value)
+                    statements = list(contents.get('WD', []))
+                    if tag == ALL or key == ALL:
+                        general.append((tags, statements))
+                        continue
+                    source, flags = join_fragments(key)
+                    rules.setdefault(tag, []).append(
+                        InterpretRule(key, expand(source), flags, tags, statements))
+        return cls(rules, general)
+
+    @classmethod
+    def from_file(cls, cleanup_file=CLEANUP_FILE):
+        return cls.from_data(load_cleanup_data(cleanup_file))
+
+    @property
+    def tags(self):
+        """The tags whose values the rules look at"""
+        return list(self.rules)
+
+    def matching_rules(self, tag, value):
+        tag_rules = self.rules[tag]
+        mask = self.indexes[tag].scan(value.casefold()) | self.always[tag]
+        matching = []
+        while mask:
+            lowest = mask & -mask
+            rule = tag_rules[lowest.bit_length() - 1]
+            if rule.regex.search(value):
+                matching.append(rule)
+            mask ^= lowest
+        return matching
+
+    def interpret(self, attributes):
+        """
+        :param attributes: mapping of tag: value, e.g. {'name': 'Kampala SDA Primary School'}
+        :returns: (dict of OSM tags, list of labels of Wikidata statements)
+        """
+        tags = {}
+        statements = []
+        contributions = list(self.general)
+        for tag in self.rules:
+            value = attributes.get(tag)
+            if isinstance(value, str) and value:
+                contributions.extend((rule.tags, rule.statements) for rule in self.matching_rules(tag, value))
+        for rule_tags, rule_statements in contributions:
+            for key, value in rule_tags.items():
+                merge_tag(tags, key, value)
+            for statement in rule_statements:
+                if statement not in statements:
+                    statements.append(statement)
+        return tags, statements
+
+    def interpret_many(self, features):
+        """
+        Generator yielding interpret() for every mapping of attributes
+
+        Features with the same values for the tags the rules look at get the same
+        interpretation, it's only worked out once. Don't modify what it yields
+        """
+        rule_tags = self.tags
+        interpreted = {}
+        for attributes in features:
+            key = tuple(attributes.get(tag) for tag in rule_tags)
+            try:
+                result = interpreted.get(key)
+            except TypeError:
+                # unhashable values
+                yield self.interpret(attributes)
+                continue
+            if result is None:
+                result = interpreted[key] = self.interpret(attributes)
+            yield result
@@ -0,0 +1,650 @@
+# -*- coding: utf-8 -*-
+"""
+ The jobs PerformQueriesTask performs on vector layers, one per action of the dock:
+
+   CleanupLayerJob      cleanup engine over a field, cleaned up names written back in batches
+   InterpretLayerJob    interpret engine over the cleaned up names, tags added as fields
+   SearchLayerJob       Wikidata search for the names, see entity_search
+   MatchLayerJob        nearest Wikidata item with a matching label, see spatial_matcher
+   OsmChangeExportJob   the proposed tags as osmChange, see osmchange
+   OsmImportJob         the objects the rules are for from an OSM extract, see osm_import
+   OverpassLayerJob     the same from an Overpass API endpoint, see overpass
+   RulePreviewJob       what one edited cleanup rule does to a sample of the names
+"""
+import math
+import re
+from collections import Counter, deque
+from pathlib import Path
+
+from PyQt5.QtCore import QVariant
+from qgis.core import (QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsExpression, QgsFeature,
+                       QgsFeatureRequest, QgsField, QgsFields, QgsGeometry, QgsPointXY, QgsProject,
+                       QgsVectorDataProvider, QgsVectorFileWriter, QgsVectorLayer, QgsVectorLayerFeatureSource,
+                       QgsWkbTypes)
+
+from .cleanup_engine import PREVIEW_TIME_BUDGET, CleanupRule, expand_macros, preview_rule
+from .entity_search import normalize
+from .osm_import import import_points
+from .osmchange import (CONFLICTS, ID_FIELDS, MISSING, OSM_API_URL, UNCHANGED, WRITTEN, OsmChangeWriter,
+                        changed_elements, element_of, export_batches, layer_element_type, layer_tags, tag_diff)
+from .overpass import OverpassClient
+from .profiling import PROFILER
+from .regex_guard import GuardedCleanupEngine
+from .spatial_matcher import RADIUS, SpatialMatcher
+
+BATCH_SIZE = 10000
+
+# A preview looks at the names of at most this many features
+PREVIEW_SAMPLE = 5000
+
+
+class CleanupLayerJob:
+    """
+    Runs a CleanupEngine over one field of a vector layer, to be performed by PerformQueriesTask
+
+    chunks() reads the names through a QgsVectorLayerFeatureSource, which is safe to use
+    outside of the main thread, a batch at a time, so a cancel takes effect after the batch being read.
+
+    PostGIS and GeoPackage layers get the changes written through the data provider,
+    one changeAttributeValues call per batch. For all other layers every batch is applied
+    to the edit buffer in chunk_finished(), in the main thread, so QGIS stays responsive
+    in between. The batches make up a single edit command, so they can be reviewed and undone
+    in one step, which finished() ends, or takes back if the task was cancelled or failed.
+    Editing is then switched off again, if the job switched it on
+    """
+    def __init__(self, layer, engine, field_name='name', selected_only=False, batch_size=BATCH_SIZE):
+        self.layer = layer
+        self.engine = engine
+        # what this job quarantines stays with the job, the engine is shared
+        self.guard = engine.guard() if isinstance(engine, GuardedCleanupEngine) else None
+        self.field_name = field_name
+        self.field_index = layer.fields().indexOf(field_name)
+        if self.field_index < 0:
+            raise ValueError('Layer "{}" has no field "{}"'.format(layer.name(), field_name))
+        self.batch_size = batch_size
+        self.through_provider = self.writes_through_provider(layer)
+
+        self.request = QgsFeatureRequest()
+        self.request.setFlags(QgsFeatureRequest.NoGeometry)
+        self.request.setSubsetOfAttributes([self.field_index])
+        if selected_only:
+            self.request.setFilterFids(layer.selectedFeatureIds())
+            self.feature_count = layer.selectedFeatureCount()
+        else:
+            self.feature_count = layer.featureCount()
+        # Has to be created in the main thread
+        self.source = QgsVectorLayerFeatureSource(layer)
+
+        self.cleaned = {}
+        self.editing = False
+        self.started_editing = False
+        self.changed_count = 0
+
+    @staticmethod
+    def writes_through_provider(layer):
+        provider = layer.dataProvider()
+        if layer.isEditable():
+            # writing to the provider directly would bypass the edits already in the buffer
+            return False
+        if not provider.capabilities() & QgsVectorDataProvider.ChangeAttributeValues:
+            return False
+        if provider.name() == 'postgres':
+            return True
+        return provider.name() == 'ogr' and provider.storageType() == 'GPKG'
+
+    def chunks(self):
+        """Generator of batches of (fid, name) of the features that have a name, read as they are needed"""
+        features = self.source.getFeatures(self.request)
+        field_index = self.field_index
+        while True:
+            batch = []
+            with PROFILER.stage('layer scan', self.layer.name()) as stage:
+                for feature in features:
+                    name = feature.attribute(field_index)
+                    if isinstance(name, str):
+                        batch.append((feature.id(), name))
+                        if len(batch) == self.batch_size:
+                            break
+                stage.count(len(batch))
+            if not batch:
+                return
+            yield batch
+
+    def chunk_count(self):
+        """At most this many batches, features without a name aren't in any"""
+        return math.ceil(self.feature_count / self.batch_size)
+
+    def run_chunk(self, chunk, task):
+        """:returns: dict of fid: {field index: cleaned up name} of the names the engine changed"""
+        clean = (self.guard or self.engine).clean
+        field_index = self.field_index
+        # names repeat a lot, and a batch doesn't run at the same time as another one
+        cleaned = self.cleaned
+        changes = {}
+        with PROFILER.stage('cleanup', self.layer.name(), len(chunk)):
+            for fid, name in chunk:
+                if name not in cleaned:
+                    cleaned[name] = clean(name)
+                if cleaned[name] != name:
+                    changes[fid] = {field_index: cleaned[name]}
+        return changes
+
+    def collect(self, chunk, result):
+        if self.through_provider and result:
+            provider = self.layer.dataProvider()
+            with PROFILER.stage('write-back', self.layer.name(), len(result)):
+                written = provider.changeAttributeValues(result)
+            if not written:
+                raise RuntimeError('Writing cleaned up {} values to "{}" failed: {}'.format(
+                    self.field_name, self.layer.name(), '\n'.join(provider.errors())))
+            self.changed_count += len(result)
+
+    def chunk_finished(self, result):
+        """Invoked in the main thread, for every batch"""
+        if self.through_provider or not result:
+            return
+        if not self.editing:
+            if not self.layer.isEditable():
+                self.layer.startEditing()
+                self.started_editing = True
+            self.layer.beginEditCommand('Cleanup {}'.format(self.field_name))
+            self.editing = True
+        with PROFILER.stage('write-back', self.layer.name(), len(result)):
+            for fid, attributes in result.items():
+                self.layer.changeAttributeValues(fid, attributes)
+        self.changed_count += len(result)
+
+    def finished(self, task_result):
+        """
+        Invoked in the main thread
+
+        :returns: a summary for the message log
+        """
+        if self.through_provider:
+            self.layer.reload()
+        elif self.editing:
+            if task_result:
+                self.layer.endEditCommand()
+            else:
+                self.layer.destroyEditCommand()
+                self.changed_count = 0
+                if self.started_editing:
+                    # the layer wasn't being edited before the job
+                    self.layer.rollBack()
+            self.editing = False
+        self.layer.triggerRepaint()
+        summary = 'Cleaned up {} of {} {} values on "{}"'.format(
+            self.changed_count, self.feature_count, self.field_name, self.layer.name())
+        if self.guard is not None and self.guard.quarantined:
+            summary += '\n' + '\n'.join(self.guard.report())
+        return summary
+
+
+class InterpretLayerJob:
+    """
+    Runs an InterpretEngine over the features of a vector layer, to be performed by PerformQueriesTask
+
+    The OSM tags and Wikidata statements for every feature end up in results, by feature id.
+    Features with the same values share their interpretation
+    """
+    def __init__(self, layer, engine, selected_only=False, batch_size=BATCH_SIZE):
+        self.layer = layer
+        self.engine = engine
+        self.batch_size = batch_size
+        fields = layer.fields()
+        self.field_indexes = [(tag, fields.indexOf(tag)) for tag in engine.tags if fields.indexOf(tag) >= 0]
+
+        self.request = QgsFeatureRequest()
+        self.request.setFlags(QgsFeatureRequest.NoGeometry)
+        self.request.setSubsetOfAttributes([index for tag, index in self.field_indexes])
+        if selected_only:
+            self.request.setFilterFids(layer.selectedFeatureIds())
+            self.feature_count = layer.selectedFeatureCount()
+        else:
+            self.feature_count = layer.featureCount()
+        # Has to be created in the main thread
+        self.source = QgsVectorLayerFeatureSource(layer)
+
+        self.results = {}
+
+    def run(self, task):
+        field_indexes = self.field_indexes
+        fids = deque()
+
+        def attribute_maps():
+            for feature in self.source.getFeatures(self.request):
+                fids.append(feature.id())
+                attributes = {}
+                for tag, index in field_indexes:
+                    value = feature.attribute(index)
+                    # NULL comes through as a QVariant
+                    attributes[tag] = value if isinstance(value, str) else None
+                yield attributes
+
+        with PROFILER.stage('layer scan', self.layer.name(), self.feature_count):
+            for count, interpretation in enumerate(self.engine.interpret_many(attribute_maps()), 1):
+                self.results[fids.popleft()] = interpretation
+                if count % self.batch_size == 0:
+                    if task.isCancelled():
+                        return False
+                    task.setProgress(100.0 * count / max(self.feature_count, 1))
+        return True
+
+    def finished(self, task_result):
+        """
+        Invoked in the main thread
+
+        :returns: a summary for the message log
+        """
+        interpreted = sum(1 for tags, statements in self.results.values() if tags or statements)
+        return 'Interpreted {} of {} features on "{}"'.format(interpreted, self.feature_count, self.layer.name())
+
+
+class SearchLayerJob:
+    """
+    Searches Wikidata for the names of the features of a vector layer, to be performed by PerformQueriesTask
+
+    Every distinct name is searched for once, by an EntitySearch on its own event loop
+    in the background thread. The search results for every feature end up in results, by feature id
+    """
+    def __init__(self, layer, search, field_name='name', selected_only=False):
+        self.layer = layer
+        self.search = search
+        self.field_name = field_name
+        self.field_index = layer.fields().indexOf(field_name)
+        if self.field_index < 0:
+            raise ValueError('Layer "{}" has no field "{}"'.format(layer.name(), field_name))
+
+        self.request = QgsFeatureRequest()
+        self.request.setFlags(QgsFeatureRequest.NoGeometry)
+        self.request.setSubsetOfAttributes([self.field_index])
+        if selected_only:
+            self.request.setFilterFids(layer.selectedFeatureIds())
+            self.feature_count = layer.selectedFeatureCount()
+        else:
+            self.feature_count = layer.featureCount()
+        # Has to be created in the main thread
+        self.source = QgsVectorLayerFeatureSource(layer)
+
+        self.name_count = 0
+        self.results = {}
+
+    def run(self, task):
+        fids_by_name = {}
+        with PROFILER.stage('layer scan', self.layer.name(), self.feature_count):
+            for feature in self.source.getFeatures(self.request):
+                name = feature.attribute(self.field_index)
+                if isinstance(name, str) and name.strip():
+                    fids_by_name.setdefault(normalize(name), []).append(feature.id())
+        if task.isCancelled():
+            return False
+        self.name_count = len(fids_by_name)
+        found = self.search.search_many(fids_by_name, progress=task.setProgress, cancelled=task.isCancelled)
+        for name, fids in fids_by_name.items():
+            if name in found:
+                for fid in fids:
+                    self.results[fid] = found[name]
+        return not task.isCancelled()
+
+    def finished(self, task_result):
+        """
+        Invoked in the main thread
+
+        :returns: a summary for the message log
+        """
+        matched = sum(1 for results in self.results.values() if results)
+        summary = 'Searched Wikidata for {} names on "{}", {} of {} features have candidates'.format(
+            self.name_count, self.layer.name(), matched, self.feature_count)
+        if self.search.failed:
+            summary += '\n' + '\n'.join('{!r} {}'.format(name, error) for name, error in self.search.failed.items())
+        return summary
+
+
+class MatchLayerJob:
+    """
+    Matches the features of a vector layer to Wikidata items by location and name,
+    to be performed by PerformQueriesTask
+
+    The candidate items are fetched through an EntityStore, those with coordinates (P625)
+    go into a SpatialMatcher. The matches for every feature end up in results, by feature id
+    """
+    def __init__(self, layer, store, candidate_ids, field_name='name', radius=RADIUS, selected_only=False):
+        self.layer = layer
+        self.store = store
+        self.candidate_ids = candidate_ids
+        self.radius = radius
+        self.field_index = layer.fields().indexOf(field_name)
+        if self.field_index < 0:
+            raise ValueError('Layer "{}" has no field "{}"'.format(layer.name(), field_name))
+
+        self.request = QgsFeatureRequest()
+        self.request.setSubsetOfAttributes([self.field_index])
+        if selected_only:
+            self.request.setFilterFids(layer.selectedFeatureIds())
+            self.feature_count = layer.selectedFeatureCount()
+        else:
+            self.feature_count = layer.featureCount()
+        # Have to be created in the main thread
+        self.source = QgsVectorLayerFeatureSource(layer)
+        self.transform = QgsCoordinateTransform(layer.crs(), QgsCoordinateReferenceSystem('EPSG:4326'),
+                                                QgsProject.instance())
+
+        self.candidate_count = 0
+        self.results = {}
+
+    def run(self, task):
+        entities = self.store.get_many(self.candidate_ids)
+        matcher = SpatialMatcher.from_entities(entities, radius=self.radius)
+        self.candidate_count = len(matcher)
+        if task.isCancelled():
+            return False
+        features = []
+        with PROFILER.stage('layer scan', self.layer.name(), self.feature_count):
+            for feature in self.source.getFeatures(self.request):
+                geometry = feature.geometry()
+                if geometry.isNull():
+                    continue
+                geometry.transform(self.transform)
+                point = geometry.centroid().asPoint()
+                name = feature.attribute(self.field_index)
+                features.append((feature.id(), name if isinstance(name, str) else '', point.x(), point.y()))
+        if task.isCancelled():
+            return False
+        self.results.update(matcher.match(features))
+        return True
+
+    def finished(self, task_result):
+        """
+        Invoked in the main thread
+
+        :returns: a summary for the message log
+        """
+        matched = sum(1 for matches in self.results.values() if matches)
+        return 'Matched {} of {} features on "{}" to {} Wikidata items with coordinates within {} m'.format(
+            matched, self.feature_count, self.layer.name(), self.candidate_count, self.radius)
+
+
+class OsmChangeExportJob:
+    """
+    Writes the OSM tags the interpretation of the features of a layer adds as an osmChange file,
+    to be performed by PerformQueriesTask
+
+    Only the tags a feature doesn't have yet are kept, per OSM element. The elements themselves
+    are fetched from the OSM API, a batch per chunk, and written to the file as the batches come in
+    """
+    # api.openstreetmap.org is shared by everyone, and an export only takes a few requests of 100 ids
+    parallel = False
+
+    def __init__(self, layer, interpretations, path, api_url=OSM_API_URL):
+        """:param interpretations: dict of fid: (tags, statement labels), as InterpretLayerJob has them"""
+        self.layer = layer
+        self.interpretations = interpretations
+        self.path = path
+        self.api_url = api_url
+        self.field_names = layer.fields().names()
+        geometry = {QgsWkbTypes.PointGeometry: 'point', QgsWkbTypes.LineGeometry: 'line',
+                    QgsWkbTypes.PolygonGeometry: 'polygon'}.get(layer.geometryType())
+        # for the layers of the OGR OSM driver, that only have osm_id
+        self.element_type = layer_element_type(geometry, QgsWkbTypes.isMultiType(layer.wkbType()))
+
+        self.request = QgsFeatureRequest()
+        self.request.setFlags(QgsFeatureRequest.NoGeometry)
+        self.request.setFilterFids([fid for fid, (tags, statements) in interpretations.items() if tags])
+        # Has to be created in the main thread
+        self.source = QgsVectorLayerFeatureSource(layer)
+
+        self.deltas = {}
+        self.writer = None
+        self.without_id = 0
+        # (fid, the OSM id fields) of the features whose id doesn't parse
+        self.bad_ids = []
+        self.layer_conflicts = 0
+        self.counts = {WRITTEN: 0, UNCHANGED: 0, CONFLICTS: 0, MISSING: 0}
+
+    def chunks(self):
+        with PROFILER.stage('layer scan', self.layer.name(), len(self.interpretations)):
+            for feature in self.source.getFeatures(self.request):
+                # NULL comes through as a QVariant
+                attributes = {name: value for name, value in zip(self.field_names, feature.attributes())
+                              if isinstance(value, (str, int, float))}
+                try:
+                    element = element_of(attributes, self.element_type)
+                except ValueError:
+                    self.bad_ids.append((feature.id(), {name: attributes[name] for name in ID_FIELDS
+                                                        if name in attributes}))
+                    continue
+                if element is None:
+                    self.without_id += 1
+                    continue
+                added, conflicts = tag_diff(layer_tags(attributes), self.interpretations[feature.id()][0])
+                self.layer_conflicts += len(conflicts)
+                if added:
+                    self.deltas.setdefault(element, {}).update(added)
+        self.writer = OsmChangeWriter(self.path)
+        return export_batches(self.deltas)
+
+    def run_chunk(self, chunk, task):
+        element_type, ids = chunk
+        return changed_elements(element_type, ids, self.deltas, self.api_url)
+
+    def collect(self, chunk, result):
+        changed, counts = result
+        for element in changed:
+            self.writer.modify(element)
+        self.counts[WRITTEN] += len(changed)
+        for key, count in counts.items():
+            self.counts[key] += count
+
+    def finished(self, task_result):
+        """
+        Invoked in the main thread
+
+        :returns: a summary for the message log
+        """
+        if self.writer is not None:
+            if task_result:
+                self.writer.close()
+            else:
+                # cancelled or failed, no file is written
+                self.writer.abort()
+        if not task_result:
+            return None
+        summary = 'Wrote {} OSM elements of "{}" to {}'.format(self.counts[WRITTEN], self.layer.name(), self.path)
+        details = [(self.counts[UNCHANGED], 'elements that have the tags in OSM by now'),
+                   (self.counts[MISSING], 'elements that are no longer in OSM'),
+                   (self.without_id, 'features without an OSM id'),
+                   (len(self.bad_ids), "features whose OSM id isn't a number"),
+                   (self.counts[CONFLICTS] + self.layer_conflicts, 'tags that have another value already')]
+        skipped = ['{} {}'.format(count, description) for count, description in details if count]
+        if skipped:
+            summary += ', left out {}'.format(', '.join(skipped))
+        return summary
+
+    def warnings(self):
+        """:returns: a message for the log per feature that was left out because its OSM id doesn't parse"""
+        return ['Feature {} of "{}" left out of the osmChange file, its OSM id doesn\'t parse: {}'.format(
+            fid, self.layer.name(), ', '.join('{}={!r}'.format(name, value) for name, value in fields.items()))
+            for fid, fields in self.bad_ids]
+
+
+class OsmImportJob:
+    """
+    Imports the objects of an OSM extract that match a tag filter as points, to be performed by PerformQueriesTask
+
+    Only the tags the rules need become fields, next to full_id, osm_id and osm_type, so the
+    features can be exported as osmChange later. The features go into a memory layer, or into
+    a GeoPackage when gpkg_path is given, batch_size at a time
+    """
+    def __init__(self, path, filters, keys, gpkg_path=None, batch_size=BATCH_SIZE, name=None):
+        """:param filters: dict of key: set of values, see tag_filter"""
+        self.path = path
+        self.filters = filters
+        self.keys = list(keys)
+        self.gpkg_path = gpkg_path
+        self.batch_size = batch_size
+        self.name = name or Path(path).name.split('.')[0]
+        self.fields = QgsFields()
+        self.fields.append(QgsField('full_id', QVariant.String))
+        self.fields.append(QgsField('osm_id', QVariant.LongLong))
+        self.fields.append(QgsField('osm_type', QVariant.String))
+        for key in self.keys:
+            self.fields.append(QgsField(key, QVariant.String))
+        self.crs = QgsCoordinateReferenceSystem('EPSG:4326')
+        if gpkg_path is None:
+            # Created in the main thread, it is only added to the project once it is filled
+            self.layer = QgsVectorLayer('Point?crs=EPSG:4326', self.name, 'memory')
+            self.layer.dataProvider().addAttributes(self.fields.toList())
+            self.layer.updateFields()
+        else:
+            self.layer = None
+        self.transform_context = QgsProject.instance().transformContext()
+
+        self.count = 0
+        self.without_location = 0
+        self.error = None
+
+    @property
+    def source_name(self):
+        return Path(self.path).name
+
+    def points(self, task):
+        """Iterable of (element type, id, tags, longitude, latitude), see import_points"""
+        return import_points(self.path, self.filters, self.keys, progress=task.setProgress,
+                             cancelled=task.isCancelled)
+
+    def run(self, task):
+        if self.gpkg_path is None:
+            sink = self.layer.dataProvider()
+        else:
+            options = QgsVectorFileWriter.SaveVectorOptions()
+            options.driverName = 'GPKG'
+            options.layerName = self.name
+            sink = QgsVectorFileWriter.create(str(self.gpkg_path), self.fields, QgsWkbTypes.Point, self.crs,
+                                              self.transform_context, options)
+            if sink.hasError() != QgsVectorFileWriter.NoError:
+                self.error = sink.errorMessage()
+                return False
+        batch = []
+        for element_type, element_id, tags, longitude, latitude in self.points(task):
+            feature = QgsFeature(self.fields)
+            feature.setAttributes([element_type[0] + str(element_id), element_id, element_type] +
+                                  [tags.get(key) for key in self.keys])
+            if longitude is None:
+                self.without_location += 1
+            else:
+                feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(longitude, latitude)))
+            batch.append(feature)
+            if len(batch) == self.batch_size:
+                sink.addFeatures(batch)
+                self.count += len(batch)
+                batch = []
+        if batch:
+            sink.addFeatures(batch)
+            self.count += len(batch)
+        # the GeoPackage is complete once the writer is gone
+        del sink
+        return not task.isCancelled()
+
+    def finished(self, task_result):
+        """
+        Invoked in the main thread
+
+        :returns: a summary for the message log
+        """
+        if self.error:
+            return 'Importing {} failed: {}'.format(self.source_name, self.error)
+        if not task_result:
+            return None
+        if self.gpkg_path is None:
+            self.layer.updateExtents()
+        else:
+            self.layer = QgsVectorLayer('{}|layername={}'.format(self.gpkg_path, self.name), self.name, 'ogr')
+        QgsProject.instance().addMapLayer(self.layer)
+        tags = ' or '.join('{}={}'.format(key, '|'.join(sorted(values))) for key, values in self.filters.items())
+        summary = 'Imported {} objects with {} from {}'.format(self.count, tags, self.source_name)
+        if self.without_location:
+            summary += ', {} of them without a location, their nodes are outside of the extract'.format(
+                self.without_location)
+        return summary
+
+
+class OverpassLayerJob(OsmImportJob):
+    """
+    Like OsmImportJob, with the objects in bbox coming from an Overpass API endpoint.
+    Tiles that were fetched before come out of the response cache of the client
+    """
+    def __init__(self, bbox, filters, keys, client=None, gpkg_path=None, batch_size=BATCH_SIZE, name='overpass'):
+        """:param bbox: (south, west, north, east) in degrees"""
+        self.bbox = bbox
+        self.client = client if client is not None else OverpassClient()
+        super().__init__(self.client.endpoint, filters, keys, gpkg_path, batch_size, name)
+
+    @property
+    def source_name(self):
+        return '{} ({} requests, {} tiles from the cache)'.format(self.client.endpoint, self.client.request_count,
+                                                                  self.client.cache_hits)
+
+    def points(self, task):
+        return self.client.points(self.filters, self.keys, self.bbox, progress=task.setProgress,
+                                  cancelled=task.isCancelled)
+
+
+class RulePreviewJob:
+    """
+    Shows what a single cleanup rule, as it is being edited, does to a sample of the names of a layer,
+    to be performed by PerformQueriesTask
+
+    The rule is compiled and applied in the background thread, the rows end up in
+    callback(job) in the main thread. A job that got cancelled because the rule was edited again
+    doesn't call back
+    """
+    def __init__(self, layer, replacement, source, flags, macros, callback, field_name='name',
+                 sample_size=PREVIEW_SAMPLE, time_budget=PREVIEW_TIME_BUDGET):
+        self.layer = layer
+        self.replacement = replacement
+        self.pattern = (source, flags)
+        self.macros = macros
+        self.callback = callback
+        self.time_budget = time_budget
+        self.field_index = layer.fields().indexOf(field_name)
+        if self.field_index < 0:
+            raise ValueError('Layer "{}" has no field "{}"'.format(layer.name(), field_name))
+
+        self.request = QgsFeatureRequest()
+        self.request.setFlags(QgsFeatureRequest.NoGeometry)
+        self.request.setSubsetOfAttributes([self.field_index])
+        if layer.selectedFeatureCount():
+            self.request.setFilterFids(layer.selectedFeatureIds())
+        else:
+            # a request has only one filter, with fids the NULL names are skipped in run()
+            self.request.setFilterExpression('{} IS NOT NULL'.format(QgsExpression.quotedColumnRef(field_name)))
+        self.request.setLimit(sample_size)
+        # Has to be created in the main thread
+        self.source = QgsVectorLayerFeatureSource(layer)
+
+        self.rows = []
+        self.complete = False
+        self.sampled_count = 0
+        self.error = None
+
+    def run(self, task):
+        try:
+            rule = CleanupRule(self.replacement, expand_macros(self.pattern[0], self.macros), self.pattern[1])
+        except (re.error, ValueError) as e:
+            self.error = str(e)
+            return True
+        names = Counter()
+        for feature in self.source.getFeatures(self.request):
+            name = feature.attribute(self.field_index)
+            if isinstance(name, str):
+                names[name] += 1
+        if task.isCancelled():
+            return False
+        self.sampled_count = sum(names.values())
+        self.rows, self.complete = preview_rule(rule, names, time_budget=self.time_budget)
+        return True
+
+    def finished(self, task_result):
+        """Invoked in the main thread"""
+        if task_result:
+            self.callback(self)
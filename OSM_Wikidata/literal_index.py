@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+ Prefilter for regular expressions
+
+ required_literals() finds the literal strings a pattern can't match without,
+ LiteralIndex finds all of those literals in a text in a single pass,
+ so only the patterns that stand a chance have to be tried
+"""
+import re
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+LITERAL = sre_constants.LITERAL
+IN = sre_constants.IN
+AT = sre_constants.AT
+BRANCH = sre_constants.BRANCH
+SUBPATTERN = sre_constants.SUBPATTERN
+GROUPS = {SUBPATTERN, getattr(sre_constants, 'ATOMIC_GROUP', SUBPATTERN)}
+REPEATS = {sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT,
+           getattr(sre_constants, 'POSSESSIVE_REPEAT', sre_constants.MAX_REPEAT)}
+
+# Character classes like [Ss] and [dt] are expanded into alternatives up to this many
+MAX_ALTERNATIVES = 16
+
+
+def required_literals(source, flags=0):
+    """
+    A set of strings of which at least one occurs in every text the pattern matches.
+    The strings are casefolded, so they have to be looked up in the casefolded text
+
+    :returns: frozenset, or None if the pattern doesn't need any literal text
+    """
+    parsed = sre_parse.parse(source, flags)
+    state = getattr(parsed, 'state', None) or parsed.pattern
+    return _sequence(parsed.data, bool(state.flags & re.IGNORECASE))
+
+
+def _char(code, ignorecase):
+    ch = chr(code)
+    if ignorecase and not (ch.isascii() and ch not in 'iI'):
+        # case insensitive matching of these has equivalents that casefold differently (ı, İ)
+        return None
+    return ch.casefold()
+
+
+def _char_set(items, ignorecase):
+    chars = set()
+    for op, av in items:
+        if op is not LITERAL:
+            return None
+        ch = _char(av, ignorecase)
+        if ch is None:
+            return None
+        chars.add(ch)
+    return chars
+
+
+def _minimal(strings):
+    """Drops the strings that contain one of the others, finding the shorter one suffices"""
+    return frozenset(s for s in strings if not any(other != s and other in s for other in strings))
+
+
+def _group(op, av, ignorecase):
+    if op is SUBPATTERN:
+        group, add_flags, del_flags, sub_items = av
+        return sub_items, bool((ignorecase or add_flags & re.IGNORECASE) and not del_flags & re.IGNORECASE)
+    return av, ignorecase
+
+
+def _product(prefixes, suffixes):
+    if len(prefixes) * len(suffixes) > MAX_ALTERNATIVES:
+        return None
+    return {prefix + suffix for prefix in prefixes for suffix in suffixes}
+
+
+def _exact(items, ignorecase):
+    """
+    The complete set of strings the items match, e.g. {'school', 'sch', 'sc'} for [Ss](chool|ch|c)
+
+    :returns: None if the items match anything else than a small number of literal strings
+    """
+    strings = {''}
+    for op, av in items:
+        if op is LITERAL:
+            ch = _char(av, ignorecase)
+            suffixes = {ch} if ch is not None else None
+        elif op is IN:
+            suffixes = _char_set(av, ignorecase)
+        elif op is AT:
+            continue
+        elif op in GROUPS:
+            suffixes = _exact(*_group(op, av, ignorecase))
+        elif op is BRANCH:
+            alternatives = [_exact(branch, ignorecase) for branch in av[1]]
+            suffixes = None if None in alternatives else set().union(*alternatives)
+        else:
+            return None
+        if not suffixes:
+            return None
+        strings = _product(strings, suffixes)
+        if strings is None:
+            return None
+    return strings
+
+
+def _sequence(items, ignorecase):
+    """
+    Walks the items, extending runs of literal text and collecting what each group requires.
+    The most selective of those candidates is what the whole sequence requires
+    """
+    candidates = []
+    run = {''}
+
+    def end_run():
+        if '' not in run:
+            candidates.append(run)
+        return {''}
+
+    for op, av in items:
+        if op is AT:
+            # anchors and word boundaries don't consume any characters
+            continue
+        if op is LITERAL or op is IN or op in GROUPS or op is BRANCH:
+            exact = _exact([(op, av)], ignorecase)
+            extended = _product(run, exact) if exact else None
+            if extended is not None:
+                run = extended
+                continue
+        run = end_run()
+        if op in GROUPS:
+            required = _sequence(*_group(op, av, ignorecase))
+        elif op is BRANCH:
+            alternatives = [_sequence(branch, ignorecase) for branch in av[1]]
+            required = set().union(*alternatives) if all(alternatives) else None
+        elif op in REPEATS and av[0]:
+            required = _sequence(av[2], ignorecase)
+        elif op is IN:
+            required = _char_set(av, ignorecase)
+        else:
+            # optional repeats, any character, negated literals, categories like \s, lookarounds
+            required = None
+        if required:
+            candidates.append(required)
+    end_run()
+
+    if not candidates:
+        return None
+    # The shortest string decides how selective a set of alternatives is
+    best = max(candidates, key=lambda strings: (min(len(s) for s in strings), -len(strings)))
+    return _minimal(best)
+
+
+class LiteralIndex:
+    """
+    Multi-pattern index over literal strings
+
+    Every literal is added with a bit mask, scan() returns the masks of all literals
+    present in a text or'ed together.
+
+    The literals are searched for with one alternation, longest first, so the regex engine
+    does the scanning in C. At every position where a literal starts it finds the longest one,
+    the masks of the literals that are a prefix of it are folded into its mask beforehand
+    """
+    def __init__(self):
+        self.masks = {}
+        self.regex = None
+
+    def __len__(self):
+        return len(self.masks)
+
+    def add(self, literal, mask):
+        self.masks[literal] = self.masks.get(literal, 0) | mask
+        self.regex = None
+
+    def __getstate__(self):
+        # the alternation is compiled again on the first scan after unpickling, see rule_cache
+        state = dict(self.__dict__)
+        state['regex'] = None
+        return state
+
+    def build(self):
+        literals = sorted(self.masks, key=lambda literal: (-len(literal), literal))
+        self.found_masks = {}
+        for literal in literals:
+            mask = 0
+            for length in range(1, len(literal) + 1):
+                mask |= self.masks.get(literal[:length], 0)
+            self.found_masks[literal] = mask
+        # a pattern that never matches when there are no literals
+        self.regex = re.compile('|'.join(re.escape(literal) for literal in literals) or '(?!)')
+
+    def scan(self, text):
+        if self.regex is None:
+            self.build()
+        search = self.regex.search
+        found_masks = self.found_masks
+        found = 0
+        match = search(text)
+        while match:
+            found |= found_masks[match.group()]
+            # literals may overlap, so continue right after where this one started
+            match = search(text, match.start() + 1)
+        return found
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+ Dependency graph of the <<name>> macros in the cleanup and interpret rules
+
+ Every macro is expanded once, its expansion is kept until the macro or one of the macros it
+ refers to, directly or through others, changes. set() and remove() return exactly those names,
+ so only the rules that use one of them have to be compiled again
+"""
+import re
+
+from .cleanup_engine import MACRO, macro_sources, name_or_rule, scoped_group
+
+
+def references_in(source):
+    """The names of the macros a pattern refers to, as a frozenset"""
+    return frozenset(MACRO.findall(source)) if '<<' in source else frozenset()
+
+
+class MacroGraph:
+    """
+    graph = MacroGraph(macro_sources(data))
+    graph.expand(source) gives the same pattern as expand_macros(source, macros),
+    graph.expand_key(source) the same as expand_key(source, macros)
+    graph.set(name, source, flags) returns the names whose expansion changed
+    """
+    def __init__(self, macros=None):
+        # name: (source, flags), as macro_sources has them
+        self.macros = {}
+        # name: the names its pattern refers to
+        self.references = {}
+        # name: the macros whose pattern refers to it, names that aren't a macro (yet) included
+        self.dependents = {}
+        self._expanded = {}
+        for name, (source, flags) in (macros or {}).items():
+            self.set(name, source, flags)
+
+    @classmethod
+    def from_data(cls, data):
+        return cls(macro_sources(data))
+
+    def copy(self):
+        graph = MacroGraph()
+        graph.macros = dict(self.macros)
+        graph.references = dict(self.references)
+        graph.dependents = {name: set(dependents) for name, dependents in self.dependents.items()}
+        graph._expanded = dict(self._expanded)
+        return graph
+
+    def affected(self, name):
+        """name and every macro that refers to it, directly or through other macros"""
+        found = {name}
+        stack = [name]
+        while stack:
+            for dependent in self.dependents.get(stack.pop(), ()):
+                if dependent not in found:
+                    found.add(dependent)
+                    stack.append(dependent)
+        return found
+
+    def _unlink(self, name):
+        for referred in self.references.pop(name, ()):
+            self.dependents[referred].discard(name)
+            if not self.dependents[referred]:
+                del self.dependents[referred]
+
+    def set(self, name, source, flags=0):
+        """
+        Adds or changes a macro
+        :returns: the names whose expansion changed, name included
+        """
+        affected = self.affected(name)
+        self._unlink(name)
+        self.macros[name] = (source, flags)
+        self.references[name] = references_in(source)
+        for referred in self.references[name]:
+            self.dependents.setdefault(referred, set()).add(name)
+        for changed in affected:
+            self._expanded.pop(changed, None)
+        return affected
+
+    def remove(self, name):
+        """
+        From now on <<name>> stands for its literal text again
+        :returns: the names whose expansion changed, name included
+        """
+        if name not in self.macros:
+            return set()
+        affected = self.affected(name)
+        self._unlink(name)
+        del self.macros[name]
+        for changed in affected:
+            self._expanded.pop(changed, None)
+        return affected
+
+    def expanded(self, name, _path=()):
+        """The pattern of the macro, expanded and wrapped in a group with its own flags"""
+        if name in self._expanded:
+            return self._expanded[name]
+        if name in _path:
+            raise ValueError('Macro <<{}>> refers to itself: {}'.format(name, ' -> '.join(_path + (name,))))
+        source, flags = self.macros[name]
+        expanded = self._expanded[name] = scoped_group(self._expand(source, _path + (name,)), flags)
+        return expanded
+
+    def _expand(self, source, path):
+        if '<<' not in source:
+            return source
+
+        def replace(match):
+            name = match.group(1)
+            if name not in self.macros:
+                return re.escape(name)
+            return self.expanded(name, path)
+
+        return MACRO.sub(replace, source)
+
+    def expand(self, source):
+        """Replaces every <<name>> in source, a name without a macro stands for its literal text"""
+        return self._expand(source, ())
+
+    def expand_key(self, source):
+        """Like expand(), for the pattern of an interpret key, see cleanup_engine.name_or_rule"""
+        if '<<' not in source:
+            return source
+
+        def replace(match):
+            name = match.group(1)
+            if name not in self.macros:
+                return re.escape(name)
+            return name_or_rule(name, self.expanded(name))
+
+        return MACRO.sub(replace, source)
+
+    def cycles(self):
+        """:returns: for every macro that can't be expanded because it refers to itself, the message why"""
+        problems = {}
+        for name in self.macros:
+            try:
+                self.expanded(name)
+            except ValueError as e:
+                problems[name] = str(e)
+        return problems
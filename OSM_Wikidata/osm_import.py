@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+"""
+ Streams OpenStreetMap extracts, .osm or .osm.pbf, keeping only the objects that match a tag filter
+
+ The filter comes from the rules under "*" in "Interpret", e.g. amenity=school. Every object
+ comes out as a point: a node where it is, a way at the mean of its nodes and a relation at the mean
+ of the nodes of its members. To get those with little memory the file is read up to three times:
+
+   1. everything, keeping the matching objects with only the tags the rules need
+   2. the ways, up to the first relation, for the members of the matching relations
+   3. the nodes, up to the first way, for the coordinates of just the nodes that are needed
+
+ Like osmium and osmosis write them, the file has to have its nodes first, then its ways, then its
+ relations. In a .pbf the blocks whose string table doesn't have any of the keys of the filter are
+ skipped without decoding their objects, the packed arrays are decoded with NumPy
+"""
+import struct
+import xml.etree.ElementTree as ElementTree
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+from .osmchange import ELEMENT_TYPES, NODE, RELATION, WAY
+
+ORDER = {element_type: number for number, element_type in enumerate(ELEMENT_TYPES)}
+# Elements between progress reports in an .osm file
+XML_REPORT_INTERVAL = 10000
+
+
+def tag_filter(engine):
+    """
+    :param engine: InterpretEngine
+    :returns: dict of key: set of values, the tags of the rules that apply to every feature
+    """
+    filters = {}
+    for tags, statements in engine.general:
+        for key, value in tags.items():
+            filters.setdefault(key, set()).update(value.split(';'))
+    return filters
+
+
+def wanted_keys(engine, filters, extra=('name',)):
+    """The tags the rules read or write, the keys of the filter and extra, in that order"""
+    keys = list(engine.tags)
+    for tag_rules in engine.rules.values():
+        for rule in tag_rules:
+            keys.extend(rule.tags)
+    for tags, statements in engine.general:
+        keys.extend(tags)
+    keys.extend(filters)
+    keys.extend(extra)
+    return list(dict.fromkeys(keys))
+
+
+def matches(tags, filters):
+    """Whether the tags have one of the values of the filter for one of its keys"""
+    for key, values in filters.items():
+        value = tags.get(key)
+        if value is not None and any(part in values for part in value.split(';')):
+            return True
+    return False
+
+
+def varint(buffer, position):
+    """:returns: (value, position after it)"""
+    result = shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+
+def fields(buffer):
+    """Generator of the (field number, value) of a protobuf message, value is an int or a memoryview"""
+    position = 0
+    end = len(buffer)
+    while position < end:
+        key, position = varint(buffer, position)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, position = varint(buffer, position)
+        elif wire_type == 2:
+            length, position = varint(buffer, position)
+            value = buffer[position:position + length]
+            position += length
+        elif wire_type == 1:
+            value = buffer[position:position + 8]
+            position += 8
+        elif wire_type == 5:
+            value = buffer[position:position + 4]
+            position += 4
+        else:
+            raise ValueError('Unsupported protobuf wire type {}'.format(wire_type))
+        yield key >> 3, value
+
+
+def packed_list(buffer):
+    """The varints of a short packed field"""
+    values = []
+    position = 0
+    while position < len(buffer):
+        value, position = varint(buffer, position)
+        values.append(value)
+    return values
+
+
+def packed_array(buffer):
+    """The varints of a packed field as an array of uint64, decoded all at once"""
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    # the position of every byte in its varint
+    offsets = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    values = (data & 0x7f).astype(np.uint64) << (7 * offsets).astype(np.uint64)
+    return np.add.reduceat(values, starts)
+
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def delta_array(buffer):
+    """The values of a packed, delta coded sint64 field"""
+    values = packed_array(buffer)
+    return np.cumsum((values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64))
+
+
+def delta_list(buffer):
+    total = 0
+    values = []
+    for value in packed_list(buffer):
+        total += unzigzag(value)
+        values.append(total)
+    return values
+
+
+def signed(value):
+    """int64 fields are varints in two's complement"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+class OsmReader:
+    """
+    reader = OsmReader('uganda-latest.osm.pbf')
+    for element_type, element_id, tags, payload in reader.elements((NODE, WAY), keys={'amenity'}): ...
+
+    The payload of a node is (latitude, longitude), of a way the ids of its nodes and of a relation
+    its members as (type, id). Reading stops once the file gets past the last type asked for
+    """
+    def __init__(self, path, progress=None, cancelled=None):
+        """
+        :param progress: callable receiving the share of the file read in the current pass, 0 to 1
+        :param cancelled: callable, when it returns True reading stops and cancelled is set
+        """
+        self.path = Path(path)
+        self.size = max(self.path.stat().st_size, 1)
+        self.progress = progress
+        self.is_cancelled = cancelled
+        self.cancelled = False
+
+    @property
+    def is_pbf(self):
+        return self.path.suffix.lower() == '.pbf'
+
+    def _report(self, handle):
+        """:returns: whether to stop"""
+        if self.progress is not None:
+            self.progress(handle.tell() / self.size)
+        if self.is_cancelled is not None and self.is_cancelled():
+            self.cancelled = True
+        return self.cancelled
+
+    def elements(self, element_types, keys=None, ids=None):
+        """
+        Generator of (element type, id, tags, payload)
+
+        :param keys: only the elements with one of these tags, else all of them without their tags
+        :param ids: only the elements with these ids, a set or a sorted array
+        """
+        if self.is_pbf:
+            return self._pbf_elements(element_types, keys, ids)
+        return self._xml_elements(element_types, keys, ids)
+
+    def _xml_elements(self, element_types, keys, ids):
+        last = max(ORDER[element_type] for element_type in element_types)
+        if ids is not None and not isinstance(ids, (set, frozenset)):
+            ids = set(ids.tolist())
+        with open(self.path, 'rb') as handle:
+            context = ElementTree.iterparse(handle, events=('start', 'end'))
+            root = None
+            count = 0
+            for event, element in context:
+                if root is None:
+                    root = element
+                if event != 'end' or element.tag not in ORDER:
+                    continue
+                element_type = element.tag
+                if ORDER[element_type] > last:
+                    break
+                count += 1
+                if count % XML_REPORT_INTERVAL == 0 and self._report(handle):
+                    break
+                if element_type in element_types:
+                    element_id = int(element.get('id'))
+                    if ids is None or element_id in ids:
+                        tags = {}
+                        if keys is not None:
+                            tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+                        if keys is None or not keys.isdisjoint(tags):
+                            if element_type == NODE:
+                                payload = (float(element.get('lat')), float(element.get('lon')))
+                            elif element_type == WAY:
+                                payload = [int(nd.get('ref')) for nd in element.iter('nd')]
+                            else:
+                                payload = [(member.get('type'), int(member.get('ref')))
+                                           for member in element.iter('member')]
+                            yield element_type, element_id, tags, payload
+                # the elements that were read would otherwise stay in the tree
+                root.clear()
+
+    def _blocks(self, handle):
+        """Generator of the decompressed OSMData blocks"""
+        while True:
+            size = handle.read(4)
+            if len(size) < 4:
+                return
+            header = dict(fields(memoryview(handle.read(struct.unpack('>I', size)[0]))))
+            blob = handle.read(header[3])
+            if bytes(header[1]) != b'OSMData':
+                continue
+            blob = dict(fields(memoryview(blob)))
+            if 1 in blob:
+                yield memoryview(bytes(blob[1]))
+            elif 3 in blob:
+                yield memoryview(zlib.decompress(blob[3]))
+            else:
+                raise ValueError('{}: only uncompressed and zlib blobs are supported'.format(self.path.name))
+
+    def _pbf_elements(self, element_types, keys, ids):
+        last = max(ORDER[element_type] for element_type in element_types)
+        node_ids = id_set = ids
+        if ids is not None and NODE in element_types and isinstance(ids, (set, frozenset)):
+            node_ids = np.array(sorted(ids), dtype=np.int64)
+        elif ids is not None and not isinstance(ids, (set, frozenset)):
+            id_set = set(ids.tolist())
+        wanted_keys = {key.encode('utf-8') for key in keys} if keys is not None else None
+        with open(self.path, 'rb') as handle:
+            for block in self._blocks(handle):
+                if self._report(handle):
+                    return
+                strings = []
+                groups = []
+                granularity = 100
+                lat_offset = lon_offset = 0
+                for field, value in fields(block):
+                    if field == 1:
+                        strings = [bytes(string) for number, string in fields(value)]
+                    elif field == 2:
+                        groups.append(value)
+                    elif field == 17:
+                        granularity = value
+                    elif field == 19:
+                        lat_offset = signed(value)
+                    elif field == 20:
+                        lon_offset = signed(value)
+                key_numbers = None
+                if wanted_keys is not None:
+                    key_numbers = {number for number, string in enumerate(strings) if string in wanted_keys}
+                    if not key_numbers:
+                        # nothing in this block has one of the keys
+                        continue
+                decoded = {}
+
+                def string(number):
+                    if number not in decoded:
+                        decoded[number] = strings[number].decode('utf-8')
+                    return decoded[number]
+
+                def tags_of(key_list, value_list):
+                    return {string(key): string(value) for key, value in zip(key_list, value_list)}
+
+                for group in groups:
+                    for field, value in fields(group):
+                        element_type = (NODE, NODE, WAY, RELATION)[field - 1] if 1 <= field <= 4 else None
+                        if element_type is None:
+                            continue
+                        if ORDER[element_type] > last:
+                            return
+                        if element_type not in element_types:
+                            continue
+                        if field == 2:
+                            yield from self._dense_nodes(value, key_numbers, node_ids, tags_of, granularity,
+                                                         lat_offset, lon_offset)
+                            continue
+                        element = {}
+                        for element_field, element_value in fields(value):
+                            element[element_field] = element_value
+                        element_id = unzigzag(element[1]) if field == 1 else element[1]
+                        if ids is not None and element_id not in id_set:
+                            continue
+                        key_list = packed_list(element.get(2, b''))
+                        if key_numbers is not None and key_numbers.isdisjoint(key_list):
+                            continue
+                        tags = tags_of(key_list, packed_list(element.get(3, b''))) if keys is not None else {}
+                        if field == 1:
+                            payload = (1e-9 * (lat_offset + granularity * unzigzag(element.get(8, 0))),
+                                       1e-9 * (lon_offset + granularity * unzigzag(element.get(9, 0))))
+                        elif field == 3:
+                            payload = delta_list(element.get(8, b''))
+                        else:
+                            payload = list(zip((ELEMENT_TYPES[member_type] for member_type in
+                                                packed_list(element.get(10, b''))),
+                                               delta_list(element.get(9, b''))))
+                        yield element_type, element_id, tags, payload
+
+    @staticmethod
+    def _dense_nodes(dense, key_numbers, ids, tags_of, granularity, lat_offset, lon_offset):
+        parts = dict(fields(dense))
+        node_ids = delta_array(parts.get(1, b''))
+        if not len(node_ids) or ids is not None and not len(ids):
+            return
+        if key_numbers is not None:
+            keys_vals = packed_array(parts.get(10, b'')).astype(np.int64)
+            if not len(keys_vals):
+                return
+            # keys_vals is key, value, key, value, ..., 0 for every node
+            delimiters = np.flatnonzero(keys_vals == 0)
+            starts = np.empty_like(delimiters)
+            starts[0] = 0
+            starts[1:] = delimiters[:-1] + 1
+            node_numbers = np.repeat(np.arange(len(delimiters)), delimiters - starts + 1)
+            is_key = ((np.arange(len(keys_vals)) - starts[node_numbers]) % 2 == 0) & (keys_vals != 0)
+            wanted = is_key & np.isin(keys_vals, np.fromiter(key_numbers, dtype=np.int64))
+            selected = np.unique(node_numbers[wanted])
+        else:
+            selected = np.arange(len(node_ids))
+        if ids is not None:
+            # ids is sorted, looking the nodes up in it beats hashing all of it for every block
+            candidates = node_ids[selected]
+            positions = np.minimum(np.searchsorted(ids, candidates), len(ids) - 1)
+            selected = selected[ids[positions] == candidates]
+        if not len(selected):
+            return
+        lats = delta_array(parts[8])
+        lons = delta_array(parts[9])
+        for number in selected.tolist():
+            tags = {}
+            if key_numbers is not None:
+                pairs = keys_vals[starts[number]:delimiters[number]].tolist()
+                tags = tags_of(pairs[0::2], pairs[1::2])
+            yield (NODE, int(node_ids[number]), tags,
+                   (1e-9 * (lat_offset + granularity * int(lats[number])),
+                    1e-9 * (lon_offset + granularity * int(lons[number]))))
+
+
+def mean_point(node_ids, coordinates):
+    """(longitude, latitude) of the mean of the nodes that have coordinates, or None"""
+    points = [coordinates[node_id] for node_id in node_ids if node_id in coordinates]
+    if not points:
+        return None
+    return sum(point[0] for point in points) / len(points), sum(point[1] for point in points) / len(points)
+
+
+def import_points(path, filters, keys, progress=None, cancelled=None):
+    """
+    Generator of (element type, id, tags, longitude, latitude) for the objects in an extract that match filters.
+    Longitude and latitude are None when none of the nodes of an object are in the extract
+
+    :param filters: dict of key: set of values, see tag_filter
+    :param keys: the tags to keep
+    :param progress: callable receiving the percentage done
+    :param cancelled: callable, when it returns True the import stops
+    """
+    stage = [0, 3]
+
+    def report(share):
+        if progress is not None:
+            progress(100.0 * (stage[0] + share) / stage[1])
+
+    reader = OsmReader(path, report, cancelled)
+    keys = set(keys)
+    ways = {}
+    relations = {}
+    for element_type, element_id, tags, payload in reader.elements(ELEMENT_TYPES, keys=set(filters)):
+        if not matches(tags, filters):
+            continue
+        kept = {key: value for key, value in tags.items() if key in keys}
+        if element_type == NODE:
+            yield NODE, element_id, kept, payload[1], payload[0]
+        elif element_type == WAY:
+            ways[element_id] = (kept, payload)
+        else:
+            relations[element_id] = (kept, payload)
+    if reader.cancelled:
+        return
+
+    stage[0] = 1
+    # a closed way would count its first node twice
+    way_nodes = {way_id: refs[:-1] if len(refs) > 1 and refs[0] == refs[-1] else refs
+                 for way_id, (tags, refs) in ways.items()}
+    member_ways = {member_id for tags, members in relations.values()
+                   for member_type, member_id in members if member_type == WAY} - set(way_nodes)
+    if member_ways:
+        for element_type, way_id, tags, refs in reader.elements((WAY,), ids=member_ways):
+            way_nodes[way_id] = refs
+        if reader.cancelled:
+            return
+
+    stage[0] = 2
+    needed = set()
+    for refs in way_nodes.values():
+        needed.update(refs)
+    relation_nodes = {}
+    for relation_id, (tags, members) in relations.items():
+        nodes = set()
+        for member_type, member_id in members:
+            if member_type == NODE:
+                nodes.add(member_id)
+            elif member_type == WAY:
+                nodes.update(way_nodes.get(member_id, ()))
+        relation_nodes[relation_id] = nodes
+        needed.update(nodes)
+    coordinates = {}
+    if needed:
+        for element_type, node_id, tags, (latitude, longitude) in reader.elements(
+                (NODE,), ids=np.array(sorted(needed), dtype=np.int64)):
+            coordinates[node_id] = (longitude, latitude)
+        if reader.cancelled:
+            return
+
+    for way_id, (tags, refs) in ways.items():
+        yield (WAY, way_id, tags) + (mean_point(way_nodes[way_id], coordinates) or (None, None))
+    for relation_id, (tags, members) in relations.items():
+        yield (RELATION, relation_id, tags) + (mean_point(relation_nodes[relation_id], coordinates) or (None, None))
+    report(1.0)
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+ Exports the OSM tags the "Interpret" rules propose as an osmChange file
+
+ Per OSM element only the delta is kept: the tags the interpretation adds to what the layer
+ already has. A <modify> has to carry the whole element, so on export the current versions of
+ the elements are fetched from the OSM API, 100 per request, and every element is written
+ to the file as soon as its batch comes in. Proposed tags that OSM has another value for by now
+ are left out and counted as conflicts
+"""
+import json
+import re
+from pathlib import Path
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+from xml.sax.saxutils import XMLGenerator
+
+from .entity_store import TIMEOUT, USER_AGENT, batches
+
+OSM_API_URL = 'https://api.openstreetmap.org/api/0.6'
+GENERATOR = 'OSM_Wikidata QGIS plugin'
+# elements per multi-fetch request, the ids have to fit in the URL
+BATCH_SIZE = 100
+
+NODE, WAY, RELATION = 'node', 'way', 'relation'
+ELEMENT_TYPES = (NODE, WAY, RELATION)
+TYPE_LETTERS = {'n': NODE, 'w': WAY, 'r': RELATION}
+
+# Fields of QuickOSM and the OGR OSM driver that aren't tags
+METADATA_FIELDS = {'full_id', 'osm_id', 'osm_type', 'osm_way_id', 'osm_version', 'osm_timestamp', 'osm_uid',
+                   'osm_user', 'osm_changeset', 'other_tags'}
+# The fields element_of takes the element from
+ID_FIELDS = ('full_id', 'osm_type', 'osm_id', 'osm_way_id')
+# other_tags of the OGR OSM driver, "key"=>"value",...
+HSTORE_PAIR = re.compile(r'"((?:[^"\\]|\\.)*)"=>"((?:[^"\\]|\\.)*)"')
+
+WRITTEN, UNCHANGED, CONFLICTS, MISSING = 'written', 'unchanged', 'conflicts', 'missing'
+
+
+def parse_id(value):
+    """
+    An OSM id as a field has it, a string or a number. Strings are parsed with int(), as float()
+    would round ids above 2 ** 53
+
+    :raises ValueError: if it isn't a positive whole number
+    """
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError('Not an OSM id: {!r}'.format(value))
+        value = int(value)
+    element_id = int(value)
+    if element_id <= 0:
+        raise ValueError('Not an OSM id: {!r}'.format(value))
+    return element_id
+
+
+def element_of(attributes, element_type=None):
+    """
+    The OSM element a feature stands for, from the full_id ('n123', 'w45') of QuickOSM, or from
+    osm_type and osm_id, or from osm_id and osm_way_id of the OGR OSM driver
+
+    The layers of the OGR OSM driver only have osm_id, the type of element it is the id of comes
+    with the layer: nodes for points, ways for lines, relations for multilinestrings and for the
+    multipolygons that don't have an osm_way_id, see layer_element_type
+
+    :param element_type: the type of the elements of the layer, for an osm_id without osm_type
+    :returns: (element type, id) or None
+    :raises ValueError: for an id that doesn't parse, see parse_id
+    """
+    full_id = attributes.get('full_id')
+    if isinstance(full_id, str) and full_id[:1] in TYPE_LETTERS and full_id[1:].isdigit():
+        return TYPE_LETTERS[full_id[0]], int(full_id[1:])
+    osm_type = attributes.get('osm_type')
+    osm_id = attributes.get('osm_id')
+    if osm_type in ELEMENT_TYPES and osm_id is not None:
+        return osm_type, parse_id(osm_id)
+    # multipolygons of the OGR OSM driver come from a closed way or from a relation
+    if attributes.get('osm_way_id') is not None:
+        return WAY, parse_id(attributes['osm_way_id'])
+    if element_type is not None and osm_type is None and osm_id is not None:
+        return element_type, parse_id(osm_id)
+    return None
+
+
+def layer_element_type(geometry, multi):
+    """
+    The type of the elements the features of an OGR OSM driver layer stand for
+
+    :param geometry: 'point', 'line' or 'polygon'
+    :param multi: whether the geometries are multi-part, like the multilinestrings layer has them
+    """
+    if geometry == 'point':
+        return NODE
+    if geometry == 'line':
+        return RELATION if multi else WAY
+    if geometry == 'polygon':
+        # the multipolygons of closed ways have osm_way_id
+        return RELATION
+    return None
+
+
+def layer_tags(attributes):
+    """The OSM tags among the attributes of a feature, other_tags unpacked"""
+    tags = {key: str(value) for key, value in attributes.items()
+            if key not in METADATA_FIELDS and value is not None and value != ''}
+    other_tags = attributes.get('other_tags')
+    if isinstance(other_tags, str):
+        for key, value in HSTORE_PAIR.findall(other_tags):
+            tags.setdefault(key.replace('\\"', '"'), value.replace('\\"', '"'))
+    return tags
+
+
+def tag_diff(current, proposed):
+    """
+    :returns: (the proposed tags that current doesn't have yet, dict of key: (current, proposed) for the
+        keys current has another value for). A value that lists all proposed values, like 'school;college'
+        for 'school', counts as the same
+    """
+    added = {}
+    conflicts = {}
+    for key, value in proposed.items():
+        if key not in current:
+            added[key] = value
+        elif not set(value.split(';')) <= set(current[key].split(';')):
+            conflicts[key] = (current[key], value)
+    return added, conflicts
+
+
+class OsmChangeWriter:
+    """
+    Streams an osmChange document to a file, one element at a time
+
+    with OsmChangeWriter('schools.osc') as writer:
+        writer.modify(element)
+
+    Elements are dicts like the OSM API has them in JSON: type, id, version, tags,
+    lat and lon for a node, nodes for a way and members for a relation.
+    The file only appears once the writer is closed, a failed export leaves nothing behind
+    """
+    def __init__(self, path, generator=GENERATOR):
+        self.path = Path(path)
+        self.tmp_file = Path(str(self.path) + '.tmp')
+        self.handle = open(self.tmp_file, 'w', encoding='utf-8')
+        self.xml = XMLGenerator(self.handle, 'utf-8', short_empty_elements=True)
+        self.xml.startDocument()
+        self.xml.startElement('osmChange', {'version': '0.6', 'generator': generator})
+        self.xml.ignorableWhitespace('\n  ')
+        self.xml.startElement('modify', {})
+        self.count = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _child(self, name, attributes):
+        self.xml.ignorableWhitespace('\n      ')
+        self.xml.startElement(name, attributes)
+        self.xml.endElement(name)
+
+    def modify(self, element):
+        attributes = {'id': str(element['id']), 'version': str(element['version'])}
+        if element['type'] == NODE:
+            attributes['lat'] = repr(element['lat'])
+            attributes['lon'] = repr(element['lon'])
+        self.xml.ignorableWhitespace('\n    ')
+        self.xml.startElement(element['type'], attributes)
+        for node_id in element.get('nodes', ()):
+            self._child('nd', {'ref': str(node_id)})
+        for member in element.get('members', ()):
+            self._child('member', {'type': member['type'], 'ref': str(member['ref']), 'role': member['role']})
+        for key, value in sorted(element.get('tags', {}).items()):
+            self._child('tag', {'k': key, 'v': value})
+        self.xml.ignorableWhitespace('\n    ')
+        self.xml.endElement(element['type'])
+        self.count += 1
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.xml.ignorableWhitespace('\n  ')
+        self.xml.endElement('modify')
+        self.xml.ignorableWhitespace('\n')
+        self.xml.endElement('osmChange')
+        self.xml.ignorableWhitespace('\n')
+        self.xml.endDocument()
+        self.handle.close()
+        self.tmp_file.replace(self.path)
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.handle.close()
+        self.tmp_file.unlink()
+
+
+def fetch_elements(element_type, ids, api_url=OSM_API_URL):
+    """
+    The current versions of the elements, as the OSM API has them in JSON.
+    Elements that were deleted, or never existed, are left out
+    """
+    if not ids:
+        return []
+    request = Request('{}/{}s.json?{}'.format(api_url, element_type,
+                                              urlencode({element_type + 's': ','.join(map(str, ids))})),
+                      headers={'User-Agent': USER_AGENT})
+    try:
+        with urlopen(request, timeout=TIMEOUT) as response:
+            elements = json.load(response).get('elements', [])
+    except HTTPError as e:
+        # a multi-fetch fails as a whole when one of the ids doesn't exist, or is gone for a single id
+        if e.code not in (404, 410):
+            raise
+        if len(ids) == 1:
+            return []
+        middle = len(ids) // 2
+        return fetch_elements(element_type, ids[:middle], api_url) + fetch_elements(element_type, ids[middle:],
+                                                                                    api_url)
+    return [element for element in elements if element.get('visible', True)]
+
+
+def export_batches(deltas, batch_size=BATCH_SIZE):
+    """:returns: list of (element type, ids), the elements of deltas by batch_size at a time"""
+    found = []
+    for element_type in ELEMENT_TYPES:
+        ids = sorted(element_id for delta_type, element_id in deltas if delta_type == element_type)
+        found.extend((element_type, batch) for batch in batches(ids, batch_size))
+    return found
+
+
+def changed_elements(element_type, ids, deltas, api_url=OSM_API_URL):
+    """
+    Fetches a batch of elements and adds the tags of their delta
+
+    :returns: (the elements that changed, counts of the elements unchanged and missing, and of the conflicting tags)
+    """
+    counts = {UNCHANGED: 0, CONFLICTS: 0, MISSING: 0}
+    elements = fetch_elements(element_type, ids, api_url)
+    counts[MISSING] = len(ids) - len(elements)
+    changed = []
+    for element in elements:
+        tags = element.setdefault('tags', {})
+        added, conflicts = tag_diff(tags, deltas[(element_type, element['id'])])
+        counts[CONFLICTS] += len(conflicts)
+        if not added:
+            counts[UNCHANGED] += 1
+            continue
+        tags.update(added)
+        changed.append(element)
+    return changed, counts
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+ Fetches the objects the "Interpret" rules are for from an Overpass API endpoint
+
+ The query is built from the tags of the rules under "*", e.g. amenity=school, and asked for per tile
+ of a fixed grid, so the tiles two overlapping bounding boxes share are only fetched once.
+ Every response is kept on disk under the SHA-256 of the endpoint and the query for its tile,
+ gzipped, and reused until it is older than the time to live
+"""
+import gzip
+import hashlib
+import json
+import math
+import os
+import time
+from pathlib import Path
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from .entity_store import USER_AGENT
+
+parent_dir = Path(__file__).resolve().parent
+
+OVERPASS_URL = 'https://overpass-api.de/api/interpreter'
+CACHE_DIR = parent_dir / 'overpass_cache'
+# degrees, tiles start at multiples of this
+TILE_SIZE = 0.25
+# seconds a response is reused
+TTL = 7 * 24 * 3600
+# seconds Overpass may take for one tile
+QUERY_TIMEOUT = 180
+RETRIES = 4
+# seconds before the first retry, doubled for every next one
+BACKOFF = 5.0
+BBOX = '{{bbox}}'
+
+
+def build_query(filters, timeout=QUERY_TIMEOUT):
+    """
+    Overpass QL for the nodes, ways and relations with one of the tags of the filter,
+    with {{bbox}} for the bounding box like overpass turbo has it
+
+    :param filters: dict of key: set of values, see osm_import.tag_filter
+    """
+    statements = []
+    for key, values in sorted(filters.items()):
+        for value in sorted(values):
+            statements.append('  nwr[{}={}]({});'.format(json.dumps(key), json.dumps(value), BBOX))
+    return '[out:json][timeout:{}];\n(\n{}\n);\nout tags center;\n'.format(timeout, '\n'.join(statements))
+
+
+def tiles(bbox, tile_size=TILE_SIZE):
+    """
+    :param bbox: (south, west, north, east) in degrees
+    :returns: list of the (south, west, north, east) of the tiles of the grid that cover bbox
+    """
+    south, west, north, east = bbox
+    found = []
+    for row in range(math.floor(south / tile_size), math.ceil(north / tile_size)):
+        for column in range(math.floor(west / tile_size), math.ceil(east / tile_size)):
+            found.append((round(row * tile_size, 9), round(column * tile_size, 9),
+                          round((row + 1) * tile_size, 9), round((column + 1) * tile_size, 9)))
+    return found
+
+
+def location(element):
+    """(longitude, latitude) of a node, or of the center Overpass gives for a way or relation, or None"""
+    if 'lat' in element:
+        return element['lon'], element['lat']
+    center = element.get('center')
+    if center:
+        return center['lon'], center['lat']
+    return None
+
+
+class ResponseCache:
+    """Overpass responses on disk, by the SHA-256 of endpoint and query, see key()"""
+    def __init__(self, cache_dir=CACHE_DIR, ttl=TTL):
+        self.cache_dir = Path(cache_dir)
+        self.ttl = ttl
+
+    @staticmethod
+    def key(endpoint, query):
+        return hashlib.sha256('{}\n{}'.format(endpoint, query).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return self.cache_dir / key[:2] / (key + '.json.gz')
+
+    def get(self, key):
+        """:returns: the response, or None if there is none that is younger than ttl"""
+        path = self.path(key)
+        try:
+            if time.time() - path.stat().st_mtime > self.ttl:
+                return None
+            with gzip.open(path, 'rt', encoding='utf-8') as handle:
+                return json.load(handle)
+        except (OSError, ValueError):
+            # absent, or cut short
+            return None
+
+    def put(self, key, response):
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = path.with_name(path.name + '.tmp')
+        with gzip.open(tmp_file, 'wt', encoding='utf-8') as handle:
+            json.dump(response, handle)
+        tmp_file.replace(path)
+
+    def prune(self):
+        """Deletes the responses that are older than ttl, :returns: how many"""
+        oldest = time.time() - self.ttl
+        count = 0
+        for path in self.cache_dir.glob('*/*.json.gz'):
+            if path.stat().st_mtime < oldest:
+                path.unlink()
+                count += 1
+        return count
+
+
+class OverpassClient:
+    """
+    client = OverpassClient()
+    client.elements(build_query(filters), (south, west, north, east)) returns the elements
+    in the bounding box by (type, id), fetching only the tiles that aren't in the cache
+    """
+    def __init__(self, endpoint=OVERPASS_URL, cache=None, tile_size=TILE_SIZE, retries=RETRIES, backoff=BACKOFF):
+        self.endpoint = endpoint
+        self.cache = cache if cache is not None else ResponseCache()
+        self.tile_size = tile_size
+        self.retries = retries
+        self.backoff = backoff
+        self.request_count = 0
+        self.cache_hits = 0
+
+    def _request(self, query):
+        request = Request(self.endpoint, data=urlencode({'data': query}).encode('utf-8'),
+                          headers={'User-Agent': USER_AGENT})
+        for attempt in range(self.retries + 1):
+            self.request_count += 1
+            try:
+                with urlopen(request, timeout=QUERY_TIMEOUT + 30) as response:
+                    return json.load(response)
+            except HTTPError as e:
+                # too many requests, or the server is busy
+                if e.code not in (429, 504) or attempt == self.retries:
+                    raise
+                delay = e.headers.get('Retry-After')
+            except (URLError, TimeoutError, ConnectionError):
+                if attempt == self.retries:
+                    raise
+                delay = None
+            try:
+                delay = max(self.backoff * 2 ** attempt, float(delay or 0))
+            except ValueError:
+                delay = self.backoff * 2 ** attempt
+            time.sleep(delay)
+
+    def tile_elements(self, query, tile):
+        """The elements of one tile, from the cache if it has them"""
+        tile_query = query.replace(BBOX, ','.join(repr(degrees) for degrees in tile))
+        key = self.cache.key(self.endpoint, tile_query)
+        response = self.cache.get(key)
+        if response is None:
+            response = self._request(tile_query)
+            remark = response.get('remark', '')
+            # a query that ran out of time or memory gives a partial result, that shouldn't stick
+            if 'runtime error' not in remark:
+                self.cache.put(key, response)
+        else:
+            self.cache_hits += 1
+        return response.get('elements', [])
+
+    def elements(self, query, bbox, progress=None, cancelled=None):
+        """
+        :param query: Overpass QL with {{bbox}}, see build_query
+        :param bbox: (south, west, north, east) in degrees
+        :param progress: callable receiving the percentage of tiles done
+        :param cancelled: callable, when it returns True no further tiles are fetched
+        :returns: dict of (type, id): element, for the elements whose location is in bbox
+        """
+        south, west, north, east = bbox
+        found = {}
+        covering = tiles(bbox, self.tile_size)
+        for number, tile in enumerate(covering, 1):
+            if cancelled is not None and cancelled():
+                break
+            for element in self.tile_elements(query, tile):
+                point = location(element)
+                if point and west <= point[0] <= east and south <= point[1] <= north:
+                    found[(element['type'], element['id'])] = element
+            if progress is not None:
+                progress(100.0 * number / len(covering))
+        return found
+
+    def points(self, filters, keys, bbox, progress=None, cancelled=None):
+        """
+        Generator of (element type, id, tags, longitude, latitude) like osm_import.import_points,
+        for the elements with the tags of the filter in bbox
+        """
+        keys = set(keys)
+        elements = self.elements(build_query(filters), bbox, progress, cancelled)
+        for (element_type, element_id), element in sorted(elements.items()):
+            tags = {key: value for key, value in element.get('tags', {}).items() if key in keys}
+            yield (element_type, element_id, tags) + location(element)
+
+
+if __name__ == '__main__':
+    # python -m OSM_Wikidata.overpass prunes the expired responses
+    print('{} expired responses deleted from {}'.format(ResponseCache().prune(), os.path.relpath(CACHE_DIR)))
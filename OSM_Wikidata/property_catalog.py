@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+ Compact on-disk catalog of Wikidata properties, generated from "WD properties.json"
+
+ The file is opened memory-mapped, only the strings that are looked up get decoded.
+ Layout, all integers little endian:
+
+   header   magic, format version, number of records, highest numeric P-id,
+            offsets of the id table, the records and the strings
+   id table one uint32 per numeric P-id up to the highest, 1 + record number or 0 if absent
+   records  per property: numeric P-id, then (offset, length) of label, description and aliases
+   strings  UTF-8, every distinct string stored once
+"""
+import json
+import mmap
+import struct
+import threading
+from collections.abc import Mapping
+from pathlib import Path
+
+parent_dir = Path(__file__).resolve().parent
+
+JSON_FILE = parent_dir / 'WD properties.json'
+CATALOG_FILE = parent_dir / 'wd_properties.catalog'
+
+MAGIC = b'OSMWDPC\0'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sIIIQQQ')
+ID_ENTRY = struct.Struct('<I')
+RECORD = struct.Struct('<IIIIIII')
+
+LABEL, DESCRIPTION, ALIASES = range(3)
+
+
+def property_id(value):
+    """'P31' for 'P31', '31' or 'http://www.wikidata.org/entity/P31'"""
+    value = str(value).rsplit('/', 1)[-1]
+    return value if value.startswith('P') else 'P' + value
+
+
+def numeric_id(wd_property):
+    return int(property_id(wd_property)[1:])
+
+
+def write_catalog(entries, catalog_file=CATALOG_FILE):
+    """
+    :param entries: iterable of dicts with the columns of "WD properties.rq":
+        property, propertyLabel, propertyDescription and altLabel_list
+    """
+    properties = {}
+    for entry in entries:
+        properties[numeric_id(entry['property'])] = (entry.get('propertyLabel', ''),
+                                                     entry.get('propertyDescription', ''),
+                                                     entry.get('altLabel_list', ''))
+    strings = bytearray()
+    interned = {}
+
+    def intern(text):
+        if text not in interned:
+            encoded = text.encode('utf-8')
+            interned[text] = (len(strings), len(encoded))
+            strings.extend(encoded)
+        return interned[text]
+
+    max_id = max(properties, default=0)
+    id_table = [0] * (max_id + 1)
+    records = bytearray()
+    for number, numeric in enumerate(sorted(properties), 1):
+        id_table[numeric] = number
+        label, description, aliases = (intern(text or '') for text in properties[numeric])
+        records.extend(RECORD.pack(numeric, *label, *description, *aliases))
+
+    id_table_offset = HEADER.size
+    records_offset = id_table_offset + ID_ENTRY.size * len(id_table)
+    strings_offset = records_offset + len(records)
+    tmp_file = Path(str(catalog_file) + '.tmp')
+    with open(tmp_file, 'wb') as handle:
+        handle.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(properties), max_id,
+                                 id_table_offset, records_offset, strings_offset))
+        handle.write(struct.pack('<{}I'.format(len(id_table)), *id_table))
+        handle.write(records)
+        handle.write(strings)
+    # Replace in one go, the old catalog may still be mapped by a running plugin
+    tmp_file.replace(catalog_file)
+
+
+def build_catalog(json_file=JSON_FILE, catalog_file=CATALOG_FILE):
+    with open(json_file, encoding='utf-8') as data_file:
+        write_catalog(json.load(data_file), catalog_file)
+
+
+class PropertyCatalog(Mapping):
+    """
+    Read-only mapping of P-id to the label of the property, e.g. catalog['P31'] == 'instance of'
+
+    Nothing is read until the first lookup. If the catalog is missing or older than
+    "WD properties.json" it gets (re)built from the JSON at that moment. Lookups can come from
+    more than one thread, the dock builds the search index in the background
+    """
+    def __init__(self, catalog_file=CATALOG_FILE, json_file=JSON_FILE):
+        self.catalog_file = Path(catalog_file)
+        self.json_file = Path(json_file) if json_file else None
+        self._handle = None
+        self._map = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._map is not None:
+            return self._map
+        with self._lock:
+            if self._map is None:
+                self._open_locked()
+        return self._map
+
+    def _open_locked(self):
+        if self.json_file and self.json_file.exists() and (
+                not self.catalog_file.exists() or
+                self.catalog_file.stat().st_mtime < self.json_file.stat().st_mtime):
+            build_catalog(self.json_file, self.catalog_file)
+        handle = open(self.catalog_file, 'rb')
+        data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.count, self.max_id,
+         self.id_table_offset, self.records_offset, self.strings_offset) = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            data.close()
+            handle.close()
+            raise ValueError('{} is not a property catalog of version {}'.format(self.catalog_file, FORMAT_VERSION))
+        # last, other threads take a map as the sign the header is read
+        self._handle = handle
+        self._map = data
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._handle.close()
+        self._map = None
+        self._handle = None
+
+    def _record(self, wd_property):
+        """The unpacked record, or None"""
+        data = self._open()
+        try:
+            numeric = numeric_id(wd_property)
+        except ValueError:
+            return None
+        if not 0 <= numeric <= self.max_id:
+            return None
+        number, = ID_ENTRY.unpack_from(data, self.id_table_offset + ID_ENTRY.size * numeric)
+        if not number:
+            return None
+        return RECORD.unpack_from(data, self.records_offset + RECORD.size * (number - 1))
+
+    def _string(self, record, field):
+        offset, length = record[1 + 2 * field], record[2 + 2 * field]
+        start = self.strings_offset + offset
+        return self._map[start:start + length].decode('utf-8')
+
+    def __getitem__(self, wd_property):
+        record = self._record(wd_property)
+        if record is None:
+            raise KeyError(wd_property)
+        return self._string(record, LABEL)
+
+    def __contains__(self, wd_property):
+        return self._record(wd_property) is not None
+
+    def __len__(self):
+        self._open()
+        return self.count
+
+    def __iter__(self):
+        data = self._open()
+        for number in range(self.count):
+            numeric, = ID_ENTRY.unpack_from(data, self.records_offset + RECORD.size * number)
+            yield 'P{}'.format(numeric)
+
+    def description(self, wd_property):
+        record = self._record(wd_property)
+        return self._string(record, DESCRIPTION) if record else ''
+
+    def aliases(self, wd_property):
+        record = self._record(wd_property)
+        aliases = self._string(record, ALIASES) if record else ''
+        return aliases.split(', ') if aliases else []
+
+    def entries(self):
+        """Generator of (P-id, label, description, aliases), ordered by numeric id"""
+        data = self._open()
+        for number in range(self.count):
+            record = RECORD.unpack_from(data, self.records_offset + RECORD.size * number)
+            aliases = self._string(record, ALIASES)
+            yield ('P{}'.format(record[0]), self._string(record, LABEL), self._string(record, DESCRIPTION),
+                   aliases.split(', ') if aliases else [])
+
+
+if __name__ == '__main__':
+    build_catalog()
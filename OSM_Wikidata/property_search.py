@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+ Ranked search over the labels, aliases and descriptions of Wikidata properties
+
+ Labels, aliases and the words in them are kept in sorted lists for prefix lookups with bisect,
+ fuzzy matches come from an index of the trigrams of the labels and aliases. finish() builds all of it,
+ building takes a few hundred milliseconds for the whole catalog, so the dock does it in the background
+ with SearchIndexJob and a search itself stays within a few milliseconds
+"""
+import re
+from bisect import bisect_left
+from collections import Counter
+
+from .profiling import PROFILER
+
+# Ranks, lower is better
+EXACT_ID, EXACT_LABEL, LABEL_PREFIX, EXACT_ALIAS, LABEL_WORD, ALIAS_PREFIX, ALIAS_WORD, DESCRIPTION_WORD, FUZZY = range(9)
+
+ID_QUERY = re.compile(r'^\s*[Pp]?(\d+)\s*$')
+WORD = re.compile(r'\w+')
+
+# fuzzy matches need at least this share of the trigrams of the query
+FUZZY_THRESHOLD = 0.5
+
+
+def trigrams(text):
+    padded = '  {} '.format(text)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class PropertySearchIndex:
+    """
+    search('operat') ranks 'operator' (label prefix) above properties that only have
+    'operated by' as alias, above properties with 'operating' in their description,
+    above fuzzy matches like 'oprator'
+    """
+    def __init__(self):
+        self.ids = []
+        self.labels = []
+        self._by_id = {}
+        self._labels = []
+        self._aliases = []
+        self._words = {LABEL_WORD: [], ALIAS_WORD: [], DESCRIPTION_WORD: []}
+        self._trigrams = {}
+        self._sorted = True
+
+    @classmethod
+    def from_catalog(cls, catalog):
+        index = cls()
+        for wd_property, label, description, aliases in catalog.entries():
+            index.add(wd_property, label, description, aliases)
+        index.finish()
+        return index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, wd_property, label, description='', aliases=()):
+        """
+        A property can be added more than once, e.g. with its label in another language
+
+        :returns: the row of the property
+        """
+        numeric = int(wd_property.lstrip('Pp'))
+        if numeric in self._by_id:
+            row = self._by_id[numeric]
+        else:
+            row = self._by_id[numeric] = len(self.ids)
+            self.ids.append('P{}'.format(numeric))
+            self.labels.append(label)
+        folded_label = label.casefold()
+        self._labels.append((folded_label, row))
+        for word in WORD.findall(folded_label)[1:]:
+            self._words[LABEL_WORD].append((word, row))
+        for alias in aliases:
+            folded_alias = alias.casefold()
+            self._aliases.append((folded_alias, row))
+            for word in WORD.findall(folded_alias)[1:]:
+                self._words[ALIAS_WORD].append((word, row))
+        for word in set(WORD.findall((description or '').casefold())):
+            self._words[DESCRIPTION_WORD].append((word, row))
+        self._sorted = False
+        return row
+
+    def finish(self):
+        """
+        Sorts the lists for bisecting and indexes the trigrams,
+        done automatically on the first search after adding
+        """
+        self._labels.sort()
+        self._aliases.sort()
+        for words in self._words.values():
+            words.sort()
+        self._trigrams = {}
+        for text, row in self._labels + self._aliases:
+            for trigram in trigrams(text):
+                self._trigrams.setdefault(trigram, set()).add(row)
+        self._sorted = True
+
+    @staticmethod
+    def _prefixed(pairs, prefix):
+        """Rows of the (text, row) pairs where text starts with prefix"""
+        start = bisect_left(pairs, (prefix,))
+        for position in range(start, len(pairs)):
+            text, row = pairs[position]
+            if not text.startswith(prefix):
+                break
+            yield text, row
+
+    def search(self, query, limit=50):
+        """
+        :returns: list of (rank, row), best first. Within a rank shorter labels come first
+        """
+        if not self._sorted:
+            self.finish()
+        query = query.strip().casefold()
+        if not query:
+            return []
+        ranks = {}
+
+        def found(row, rank, score=0):
+            if row not in ranks or ranks[row] > (rank, -score):
+                ranks[row] = (rank, -score)
+
+        id_query = ID_QUERY.match(query)
+        if id_query and int(id_query.group(1)) in self._by_id:
+            found(self._by_id[int(id_query.group(1))], EXACT_ID)
+
+        for text, row in self._prefixed(self._labels, query):
+            found(row, EXACT_LABEL if text == query else LABEL_PREFIX)
+        for text, row in self._prefixed(self._aliases, query):
+            found(row, EXACT_ALIAS if text == query else ALIAS_PREFIX)
+        words = WORD.findall(query)
+        if len(words) == 1:
+            for rank in (LABEL_WORD, ALIAS_WORD, DESCRIPTION_WORD):
+                for text, row in self._prefixed(self._words[rank], words[0]):
+                    if len(ranks) >= limit:
+                        break
+                    found(row, rank)
+
+        if len(ranks) < limit and len(query) >= 3:
+            query_trigrams = trigrams(query)
+            trigram_index = self._trigrams
+            shared = Counter()
+            for trigram in query_trigrams:
+                shared.update(trigram_index.get(trigram, ()))
+            needed = FUZZY_THRESHOLD * len(query_trigrams)
+            for row, count in shared.most_common():
+                if count < needed or len(ranks) >= limit:
+                    break
+                found(row, FUZZY, count)
+
+        labels = self.labels
+        ranked = sorted(ranks.items(), key=lambda item: (item[1], len(labels[item[0]]), item[0]))
+        return [(rank, row) for row, (rank, score) in ranked[:limit]]
+
+    def search_ids(self, query, limit=50):
+        return [self.ids[row] for rank, row in self.search(query, limit)]
+
+
+class SearchIndexJob:
+    """
+    Builds the PropertySearchIndex of a catalog, to be performed by PerformQueriesTask
+    when the dock opens, so nobody waits for it when typing in a PropertiesComboBox
+
+    :param done: invoked with the index in the main thread
+    """
+    def __init__(self, catalog, done):
+        self.catalog = catalog
+        self.done = done
+        self.index = None
+
+    def run(self, task):
+        with PROFILER.stage('catalog index') as stage:
+            self.index = PropertySearchIndex.from_catalog(self.catalog)
+            stage.count(len(self.index))
+        return True
+
+    def finished(self, task_result):
+        if task_result:
+            self.done(self.index)
@@ -0,0 +1,485 @@
+# -*- coding: utf-8 -*-
+"""
+ Guards against cleanup patterns that backtrack catastrophically
+
+ analyze() looks for the shapes of pattern that make the regex engine try exponentially
+ or polynomially many ways to match a name: nested quantifiers like (a+)+, alternatives under
+ a quantifier that can match the same text and quantifiers next to each other that compete
+ for the same characters, like \s*\s* or \w+\s*\w+.
+
+ The RuleGuard of a job times every rule on every name and quarantines the rules that keep going
+ over the time budget, GuardedCleanupProcess does the cleaning in a child process that gets killed
+ when a rule doesn't finish at all
+"""
+import multiprocessing
+import re
+import time
+
+from .cleanup_engine import CleanupEngine, CleanupRule
+from .literal_index import BRANCH, GROUPS, IN, LITERAL, REPEATS, SUBPATTERN, sre_constants, sre_parse
+
+NOT_LITERAL = sre_constants.NOT_LITERAL
+ANY = sre_constants.ANY
+AT = sre_constants.AT
+RANGE = sre_constants.RANGE
+NEGATE = sre_constants.NEGATE
+CATEGORY = sre_constants.CATEGORY
+ASSERTIONS = {sre_constants.ASSERT, sre_constants.ASSERT_NOT}
+MAXREPEAT = sre_constants.MAXREPEAT
+
+# The characters that character sets are compared on, enough to tell the sets in names apart
+PROBE = frozenset(chr(code) for code in range(9, 0x250)) | frozenset('‐–—’“”')
+
+CATEGORY_ESCAPES = {getattr(sre_constants, 'CATEGORY_' + name): escape
+                    for name, escape in (('DIGIT', r'\d'), ('NOT_DIGIT', r'\D'), ('SPACE', r'\s'),
+                                         ('NOT_SPACE', r'\S'), ('WORD', r'\w'), ('NOT_WORD', r'\W'))}
+CATEGORIES = {category: frozenset(ch for ch in PROBE if re.match(escape, ch))
+              for category, escape in CATEGORY_ESCAPES.items()}
+
+NESTED, AMBIGUOUS_ALTERNATION, ADJACENT = 'nested quantifier', 'ambiguous alternation', 'adjacent quantifiers'
+
+# A rule goes over budget when it takes longer than this many seconds on one name, twice in a row
+TIME_BUDGET = 0.05
+# Overruns before a rule that analyze() finds nothing wrong with gets quarantined
+OVERRUNS = 3
+# A child process that is stuck on one name for this many seconds gets killed
+HARD_TIME_BUDGET = 2.0
+# Names sent to the child process at a time
+CHUNK_SIZE = 1000
+
+
+def _with_case(chars, ignorecase):
+    if not ignorecase:
+        return frozenset(chars)
+    return frozenset(chars) | frozenset(ch.swapcase() for ch in chars if len(ch.swapcase()) == 1)
+
+
+def _in_set(items, ignorecase):
+    chars = set()
+    negate = False
+    for op, av in items:
+        if op is NEGATE:
+            negate = True
+        elif op is LITERAL:
+            chars.add(chr(av))
+        elif op is RANGE:
+            chars.update(ch for ch in PROBE if av[0] <= ord(ch) <= av[1])
+        elif op is CATEGORY:
+            chars.update(CATEGORIES.get(av, PROBE))
+        else:
+            chars.update(PROBE)
+    chars = _with_case(chars, ignorecase)
+    return PROBE - chars if negate else chars
+
+
+def _flatten(items, ignorecase):
+    """The items with the groups around them left out, as (op, av, ignorecase)"""
+    for op, av in items:
+        if op is SUBPATTERN:
+            group, add_flags, del_flags, sub_items = av
+            yield from _flatten(sub_items, bool((ignorecase or add_flags & re.IGNORECASE)
+                                                and not del_flags & re.IGNORECASE))
+        elif op in GROUPS:
+            yield from _flatten(av, ignorecase)
+        else:
+            yield op, av, ignorecase
+
+
+def _first(items, ignorecase, reverse=False):
+    """
+    :returns: (the characters a match of the items can start with, or end with when reverse,
+               whether the items can match the empty string)
+    """
+    chars = set()
+    flat = list(_flatten(items, ignorecase))
+    for op, av, case in reversed(flat) if reverse else flat:
+        if op is LITERAL:
+            item_chars, empty = _with_case({chr(av)}, case), False
+        elif op is NOT_LITERAL:
+            item_chars, empty = PROBE - _with_case({chr(av)}, case), False
+        elif op is ANY:
+            item_chars, empty = PROBE - {'\n'}, False
+        elif op is IN:
+            item_chars, empty = _in_set(av, case), False
+        elif op is AT or op in ASSERTIONS:
+            item_chars, empty = (), True
+        elif op is BRANCH:
+            item_chars, empty = set(), False
+            for branch in av[1]:
+                branch_chars, branch_empty = _first(branch, case, reverse)
+                item_chars |= branch_chars
+                empty = empty or branch_empty
+        elif op in REPEATS:
+            item_chars, empty = _first(av[2], case, reverse)
+            empty = empty or av[0] == 0
+        else:
+            # back references and the like, assume the worst
+            item_chars, empty = PROBE, True
+        chars.update(item_chars)
+        if not empty:
+            return frozenset(chars), False
+    return frozenset(chars), True
+
+
+def describe(items):
+    """Approximates the source of parsed items, for the findings"""
+    text = ''
+    for op, av in items:
+        if op is LITERAL:
+            text += re.escape(chr(av))
+        elif op is NOT_LITERAL:
+            text += '[^{}]'.format(re.escape(chr(av)))
+        elif op is ANY:
+            text += '.'
+        elif op is IN:
+            if len(av) == 1 and av[0][0] is CATEGORY:
+                text += CATEGORY_ESCAPES.get(av[0][1], '[...]')
+            else:
+                text += '[...]'
+        elif op in GROUPS:
+            sub_items = av[3] if op is SUBPATTERN else av
+            text += '({})'.format(describe(sub_items))
+        elif op is BRANCH:
+            text += '|'.join(describe(branch) for branch in av[1])
+        elif op in REPEATS:
+            low, high, sub_items = av
+            body = describe(sub_items)
+            if len(sub_items) != 1 or sub_items[0][0] is BRANCH:
+                body = '({})'.format(body)
+            if (low, high) == (0, MAXREPEAT):
+                text += body + '*'
+            elif (low, high) == (1, MAXREPEAT):
+                text += body + '+'
+            elif (low, high) == (0, 1):
+                text += body + '?'
+            else:
+                text += '{}{{{},{}}}'.format(body, low, '' if high is MAXREPEAT else high)
+        elif op is AT:
+            continue
+        else:
+            text += '...'
+    return text
+
+
+def analyze(source, flags=0):
+    """
+    Looks for the shapes of pattern that can backtrack catastrophically
+
+    :returns: list of (kind, description), empty when nothing suspicious was found
+    """
+    parsed = sre_parse.parse(source, flags)
+    state = getattr(parsed, 'state', None) or parsed.pattern
+    findings = []
+    _analyze(list(parsed.data), bool(state.flags & re.IGNORECASE), findings)
+    return findings
+
+
+def _analyze(items, ignorecase, findings):
+    flat = list(_flatten(items, ignorecase))
+    for position, (op, av, case) in enumerate(flat):
+        if op in REPEATS:
+            low, high, sub_items = av
+            if high is MAXREPEAT:
+                _check_repeat(sub_items, case, findings)
+                _check_adjacent(flat, position, findings)
+            _analyze(list(sub_items), case, findings)
+        elif op is BRANCH:
+            for branch in av[1]:
+                _analyze(list(branch), case, findings)
+        elif op in ASSERTIONS:
+            _analyze(list(av[1]), case, findings)
+
+
+def _contains_unbounded(items):
+    for op, av, case in _flatten(items, False):
+        if op in REPEATS and (av[1] is MAXREPEAT or _contains_unbounded(av[2])):
+            return True
+        if op is BRANCH and any(_contains_unbounded(branch) for branch in av[1]):
+            return True
+    return False
+
+
+def _check_repeat(sub_items, ignorecase, findings):
+    flat = list(_flatten(sub_items, ignorecase))
+    if _contains_unbounded(sub_items):
+        first, empty = _first(sub_items, ignorecase)
+        last, empty = _first(sub_items, ignorecase, reverse=True)
+        # when one repetition can end with what the next starts with, the text can be split over them in many ways
+        if first & last:
+            findings.append((NESTED, describe([(sre_constants.MAX_REPEAT, (1, MAXREPEAT, sub_items))])))
+    if len(flat) == 1 and flat[0][0] is BRANCH:
+        branches = [_first(branch, flat[0][2])[0] for branch in flat[0][1][1]]
+        for number, chars in enumerate(branches):
+            if any(chars & other for other in branches[number + 1:]):
+                findings.append((AMBIGUOUS_ALTERNATION,
+                                 describe([(sre_constants.MAX_REPEAT, (0, MAXREPEAT, sub_items))])))
+                break
+
+
+def _check_adjacent(flat, position, findings):
+    """Compares an unbounded repeat with the unbounded repeats after it that only optional items separate it from"""
+    op, av, case = flat[position]
+    chars = _first(av[2], case, reverse=True)[0]
+    for later_op, later_av, later_case in flat[position + 1:]:
+        if later_op in REPEATS and later_av[1] is MAXREPEAT:
+            if chars & _first(later_av[2], later_case)[0]:
+                findings.append((ADJACENT, '{} followed by {}'.format(describe([(op, av)]),
+                                                                      describe([(later_op, later_av)]))))
+                return
+        if not _first([(later_op, later_av)], later_case)[1]:
+            return
+
+
+def analyze_rules(rules):
+    """
+    :param rules: CleanupRules
+    :returns: list of (rule, kind, description)
+    """
+    return [(rule, kind, description) for rule in rules for kind, description in analyze(rule.source, rule.flags)]
+
+
+class GuardedCleanupEngine(CleanupEngine):
+    """
+    CleanupEngine whose rules can be guarded against going over time_budget on a name
+
+    clean() itself applies every rule, the engine is shared by the jobs of the dock. A job that
+    wants its rules timed cleans through its own guard(), so what one job runs into never takes
+    a rule away from another
+    """
+    def __init__(self, rules, time_budget=TIME_BUDGET):
+        super().__init__(rules)
+        self.time_budget = time_budget
+        self._suspects = None
+
+    @property
+    def suspects(self):
+        """The positions of the rules analyze() finds a shape of catastrophic backtracking in"""
+        if self._suspects is None:
+            self._suspects = frozenset(position for position, rule in enumerate(self.rules)
+                                       if analyze(rule.source, rule.flags))
+        return self._suspects
+
+    def guard(self, overruns=OVERRUNS):
+        """A RuleGuard for one job"""
+        return RuleGuard(self, overruns)
+
+
+class RuleGuard:
+    """
+    Cleans names with the rules of a GuardedCleanupEngine, timing every rule on every name
+
+    A rule that goes over the time budget is applied to the same name once more, a single slow
+    run can be another thread holding the GIL or the machine being busy. Only when it goes over
+    the budget again the overrun counts. A rule analyze() finds a suspect shape in is quarantined
+    on its first overrun, any other rule after overruns of them. A quarantined rule isn't applied
+    to the names after that, for as long as the guard is used, the engine keeps it.
+    quarantined holds rule position: (name, seconds) for the report.
+
+    The check is done after the rule returns, a rule that never returns needs GuardedCleanupProcess
+    """
+    def __init__(self, engine, overruns=OVERRUNS):
+        self.engine = engine
+        self.time_budget = engine.time_budget
+        self.overruns = overruns
+        self.suspects = engine.suspects
+        self.overrun_counts = {}
+        self.quarantined = {}
+        self.allowed = (1 << len(engine.rules)) - 1
+
+    def quarantine(self, position, name, seconds):
+        self.quarantined[position] = (name, seconds)
+        self.allowed &= ~(1 << position)
+
+    def overrun(self, position, name, seconds):
+        """:returns: whether the rule got quarantined"""
+        count = self.overrun_counts[position] = self.overrun_counts.get(position, 0) + 1
+        if position in self.suspects or count >= self.overruns:
+            self.quarantine(position, name, seconds)
+            return True
+        return False
+
+    def clean(self, name):
+        engine = self.engine
+        plans = engine._plans
+        introduces = engine.introduces
+        mask = engine.candidates(name) & self.allowed
+        timer = time.perf_counter
+        while True:
+            plan = plans.get(mask) or engine._plan(mask)
+            for position, substitute, template in plan:
+                started = timer()
+                result, count = substitute(template, name)
+                seconds = timer() - started
+                if seconds > self.time_budget:
+                    # timed once more, on the same name
+                    started = timer()
+                    result, count = substitute(template, name)
+                    seconds = timer() - started
+                    if seconds > self.time_budget and self.overrun(position, name, seconds):
+                        mask &= self.allowed
+                        break
+                if count and result != name:
+                    name = result
+                    later = mask >> (position + 1) << (position + 1)
+                    if introduces[position]:
+                        later |= engine.candidates(name) & introduces[position] & self.allowed
+                    mask = later
+                    break
+            else:
+                return name
+
+    def clean_many(self, names):
+        """Like CleanupEngine.clean_many"""
+        cleaned = {}
+        for name in names:
+            if not isinstance(name, str):
+                yield name
+                continue
+            if name not in cleaned:
+                cleaned[name] = self.clean(name)
+            yield cleaned[name]
+
+    def report(self):
+        """The quarantined rules, one line each"""
+        rules = self.engine.rules
+        return ['"{}" took {:.3f} s on {!r}, quarantined: {}'.format(
+            rules[position].replacement, seconds, name, rules[position].source.strip())
+            for position, (name, seconds) in sorted(self.quarantined.items())]
+
+
+def _clean_in_child(rule_sources, time_budget, connection, current):
+    """
+    Body of the child process, cleans the chunks of names it receives
+
+    current holds the position of the rule being applied, when it started and the number of the name
+    in the chunk, for the parent to find out which rule got stuck on what
+    """
+    engine = GuardedCleanupEngine([CleanupRule(*source) for source in rule_sources], time_budget)
+    guard = engine.guard()
+    for position in connection.recv():
+        guard.quarantine(position, '', 0.0)
+    # unlike perf_counter, the same clock in every process
+    timer = time.monotonic
+
+    def substitute_for(position, regex_subn):
+        def substitute(template, name):
+            current[0] = position
+            current[1] = timer()
+            return regex_subn(template, name)
+        return substitute
+
+    # report every rule application to the parent
+    original_plan = engine._plan
+
+    def plan(mask):
+        plan = tuple((position, substitute_for(position, substitute), template)
+                     for position, substitute, template in original_plan(mask))
+        engine._plans[mask] = plan
+        return plan
+
+    engine._plan = plan
+    while True:
+        names = connection.recv()
+        if names is None:
+            break
+        cleaned = []
+        for number, name in enumerate(names):
+            current[2] = number
+            cleaned.append(guard.clean(name) if isinstance(name, str) else name)
+        current[0] = -1
+        connection.send((cleaned, guard.quarantined))
+
+
+class GuardedCleanupProcess:
+    """
+    Cleans names in a child process, so a rule that backtracks forever can't hang a batch job
+
+    When the child spends more than hard_time_budget on a single rule application it's killed,
+    the rule is quarantined and the child restarted on the rest of the names.
+    Rules that are merely slow get quarantined by the RuleGuard in the child.
+
+    with GuardedCleanupProcess(engine.rules) as guarded:
+        cleaned = list(guarded.clean_many(names))
+    print('\\n'.join(guarded.report()))
+    """
+    def __init__(self, rules, time_budget=TIME_BUDGET, hard_time_budget=HARD_TIME_BUDGET,
+                 chunk_size=CHUNK_SIZE, context=None):
+        self.rules = list(rules)
+        self.time_budget = time_budget
+        self.hard_time_budget = hard_time_budget
+        self.chunk_size = chunk_size
+        self.context = context or multiprocessing.get_context('spawn')
+        self.quarantined = {}
+        self.process = None
+        self.connection = None
+        self.current = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        self.connection, child_connection = self.context.Pipe()
+        self.current = self.context.Array('d', [-1.0, 0.0, 0.0], lock=False)
+        self.process = self.context.Process(
+            target=_clean_in_child, daemon=True,
+            args=([(rule.replacement, rule.source, rule.flags) for rule in self.rules],
+                  self.time_budget, child_connection, self.current))
+        self.process.start()
+        child_connection.close()
+        self.connection.send(list(self.quarantined))
+
+    def close(self):
+        if self.process is not None:
+            if self.process.is_alive():
+                self.connection.send(None)
+                self.process.join(1)
+            if self.process.is_alive():
+                self.process.kill()
+            self.connection.close()
+        self.process = None
+
+    def _clean_chunk(self, names):
+        """Cleans a chunk, restarting the child for every rule that gets stuck"""
+        while True:
+            if self.process is None:
+                self.start()
+            self.connection.send(names)
+            while not self.connection.poll(self.hard_time_budget / 10):
+                position, started, number = int(self.current[0]), self.current[1], int(self.current[2])
+                if position >= 0 and time.monotonic() - started > self.hard_time_budget:
+                    break
+                if not self.process.is_alive():
+                    raise RuntimeError('Cleanup process died with exit code {}'.format(self.process.exitcode))
+            else:
+                cleaned, quarantined = self.connection.recv()
+                for position, found in quarantined.items():
+                    self.quarantined.setdefault(position, found)
+                return cleaned
+            # stuck, the names before the one it got stuck on are done again by the new process
+            self.process.kill()
+            self.process.join()
+            self.connection.close()
+            self.process = None
+            self.quarantined[position] = (names[number], time.monotonic() - started)
+
+    def clean_many(self, names):
+        """Generator yielding the cleaned version of every name, like CleanupEngine.clean_many"""
+        chunk = []
+        for name in names:
+            chunk.append(name)
+            if len(chunk) >= self.chunk_size:
+                yield from self._clean_chunk(chunk)
+                chunk = []
+        if chunk:
+            yield from self._clean_chunk(chunk)
+
+    def report(self):
+        return ['"{}" {}, quarantined: {}'.format(
+            self.rules[position].replacement,
+            'got stuck on {!r} for {:.1f} s'.format(name, seconds) if seconds > self.hard_time_budget
+            else 'took {:.3f} s on {!r}'.format(seconds, name),
+            self.rules[position].source.strip())
+            for position, (name, seconds) in sorted(self.quarantined.items())]
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+ On-disk cache of the rules compiled from cleanup.json
+
+ Building the engines means expanding the macros, parsing every pattern for its required
+ literals, indexing those and checking the patterns for catastrophic backtracking. The result
+ is pickled to rules.cache, under a key made of the SHA-256 of cleanup.json, ENGINE_VERSION and
+ the version of Python, so the next start only has to unpickle it as long as cleanup.json is unchanged.
+
+ Compiled regular expressions can't be stored as such, the rules compile their pattern again
+ the first time it is used. A cache that doesn't fit or can't be read is simply rebuilt.
+ save_rules() writes edited cleanup rules to cleanup.json and the cache together. cleanup.json
+ is kept up by hand, only the text of the edited rules is replaced, the rest keeps its layout
+"""
+import copy
+import hashlib
+import json
+import pickle
+import re
+import sys
+from json.decoder import scanstring
+from pathlib import Path
+
+from .cleanup_engine import CLEANUP_FILE, CleanupRule, cleanup_patterns, join_fragments
+from .interpret_engine import InterpretEngine, InterpretRule
+from .macro_graph import MacroGraph, references_in
+from .regex_guard import GuardedCleanupEngine, analyze_rules
+
+parent_dir = Path(__file__).resolve().parent
+
+CACHE_FILE = parent_dir / 'rules.cache'
+WHITESPACE = re.compile(r'\s*')
+# Bump when CleanupEngine, InterpretEngine, LiteralIndex or the rules change what they store
+ENGINE_VERSION = 3
+
+
+class CompiledRules:
+    """
+    Everything the plugin derives from cleanup.json: the data itself, its macros, both engines
+    and the findings of analyze_rules for the cleanup rules
+
+    edit_cleanup_rule() changes a cleanup rule of tag in the engines, cleanup.json itself
+    and data stay as they are. To try out an edit without touching the engines others use,
+    edit a copy()
+    """
+    def __init__(self, data, tag='name'):
+        self.data = data
+        self.tag = tag
+        self.graph = MacroGraph.from_data(data)
+        # as written in cleanup.json, to compile the rules again from when a macro they use changes
+        self.cleanup_patterns = list(cleanup_patterns(data, tag))
+        # macros defined by the rules of other tags, edits don't touch those
+        self.fixed_macros = {replacement.strip() for other_tag in data.get('cleanup', {}) if other_tag != tag
+                             for replacement, source, flags in cleanup_patterns(data, other_tag)}
+        self.cleanup_engine = GuardedCleanupEngine.from_data(data, tag, self.graph.expand)
+        self.interpret_engine = InterpretEngine.from_data(data, self.graph.expand_key)
+        self.findings = analyze_rules(self.cleanup_engine.rules)
+        # whether this came out of the cache, for the log
+        self.cached = False
+
+    @property
+    def macros(self):
+        return self.graph.macros
+
+    def copy(self):
+        """
+        edit_cleanup_rule() replaces the graph, the engines and the lists instead of changing them,
+        so edits of the copy leave this one as it is
+        """
+        rules = copy.copy(self)
+        rules.cached = False
+        return rules
+
+    def edit_cleanup_rule(self, position, replacement, source, flags):
+        """
+        Changes the cleanup rule at position. Besides the rule itself only the rules that use it
+        as a macro, directly or through other macros, are compiled again
+
+        :returns: the number of rules that were compiled
+        :raises re.error, ValueError: when one of those doesn't compile, nothing is changed then
+        """
+        graph = self.graph.copy()
+        patterns = list(self.cleanup_patterns)
+        old_name = patterns[position][0].strip()
+        patterns[position] = (replacement, source, flags)
+        changed = set()
+        for name in {old_name, replacement.strip()} - self.fixed_macros:
+            # like macro_sources, the first rule with the name is the macro
+            owner = next((pattern for pattern in patterns if pattern[0].strip() == name), None)
+            if owner is None:
+                changed |= graph.remove(name)
+            elif graph.macros.get(name) != owner[1:]:
+                changed |= graph.set(name, *owner[1:])
+
+        cleanup_rules = list(self.cleanup_engine.rules)
+        compiled = []
+        for number, (rule_replacement, rule_source, rule_flags) in enumerate(patterns):
+            if number == position or changed & references_in(rule_source):
+                cleanup_rules[number] = CleanupRule(rule_replacement, graph.expand(rule_source), rule_flags)
+                compiled.append(cleanup_rules[number])
+        interpret_rules = {}
+        for tag, tag_rules in self.interpret_engine.rules.items():
+            interpret_rules[tag] = list(tag_rules)
+            for number, rule in enumerate(tag_rules):
+                rule_source, rule_flags = join_fragments(rule.key)
+                if changed & references_in(rule_source):
+                    interpret_rules[tag][number] = InterpretRule(rule.key, graph.expand_key(rule_source), rule_flags,
+                                                                 rule.tags, rule.statements)
+                    compiled.append(interpret_rules[tag][number])
+
+        self.graph = graph
+        self.cleanup_patterns = patterns
+        kept = {id(rule) for rule in cleanup_rules}
+        self.findings = [finding for finding in self.findings if id(finding[0]) in kept] + analyze_rules(
+            [rule for rule in compiled if isinstance(rule, CleanupRule)])
+        self.cleanup_engine = GuardedCleanupEngine(cleanup_rules, self.cleanup_engine.time_budget)
+        if any(isinstance(rule, InterpretRule) for rule in compiled):
+            self.interpret_engine = InterpretEngine(interpret_rules, self.interpret_engine.general)
+        return len(compiled)
+
+
+def cache_key(content):
+    """:param content: the bytes of cleanup.json"""
+    key = hashlib.sha256(content)
+    key.update('{} {}.{}'.format(ENGINE_VERSION, *sys.version_info[:2]).encode('ascii'))
+    return key.hexdigest()
+
+
+def read_cache(key, cache_file=CACHE_FILE):
+    """:returns: the CompiledRules stored under key, or None"""
+    try:
+        with open(cache_file, 'rb') as handle:
+            if handle.readline().decode('ascii', 'replace').strip() != key:
+                return None
+            rules = pickle.load(handle)
+    except Exception:
+        # missing, cut short, or pickled by code that has changed since
+        return None
+    if not isinstance(rules, CompiledRules):
+        return None
+    rules.cached = True
+    return rules
+
+
+def write_cache(key, rules, cache_file=CACHE_FILE):
+    """Replaces the cache in one go, a crash halfway leaves the old one"""
+    tmp_file = Path(str(cache_file) + '.tmp')
+    try:
+        with open(tmp_file, 'wb') as handle:
+            handle.write(key.encode('ascii') + b'\n')
+            pickle.dump(rules, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp_file.replace(cache_file)
+    except OSError:
+        # e.g. a read-only plugin folder, the rules are built again next time
+        pass
+
+
+def replace_cleanup_rule(data, tag, position, replacement, contents):
+    """
+    Puts a rule in place of the cleanup rule of tag at position, counted like cleanup_patterns does
+
+    :param contents: a string or a list of lines, as cleanup.json has it
+    """
+    first = 0
+    for number, entry in enumerate(data['cleanup'][tag]):
+        if position < first + len(entry):
+            rules = list(entry.items())
+            rules[position - first] = (replacement, contents)
+            data['cleanup'][tag][number] = dict(rules)
+            return
+        first += len(entry)
+    raise IndexError('There is no cleanup rule {} for {}'.format(position, tag))
+
+
+def _skip(text, position, expected=None):
+    """:returns: the position of the next character that isn't white space, after checking it is expected"""
+    position = WHITESPACE.match(text, position).end()
+    if expected is not None and not text.startswith(expected, position):
+        raise ValueError('Expected {!r} at character {} of cleanup.json'.format(expected, position))
+    return position
+
+
+def _members(text, position):
+    """
+    :param position: of the '{' of a JSON object in text
+    :returns: list of (key, start of the key, start of the value, end of the value)
+    """
+    decoder = json.JSONDecoder()
+    members = []
+    position = _skip(text, position + 1)
+    while text[position] != '}':
+        if members:
+            position = _skip(text, _skip(text, position, ',') + 1)
+        key, value_start = scanstring(text, _skip(text, position, '"') + 1)
+        value_start = _skip(text, _skip(text, value_start, ':') + 1)
+        value, value_end = decoder.raw_decode(text, value_start)
+        members.append((key, position, value_start, value_end))
+        position = _skip(text, value_end)
+    return members
+
+
+def _items(text, position):
+    """
+    :param position: of the '[' of a JSON array in text
+    :returns: list of the start of every item
+    """
+    decoder = json.JSONDecoder()
+    items = []
+    position = _skip(text, position + 1)
+    while text[position] != ']':
+        if items:
+            position = _skip(text, _skip(text, position, ',') + 1)
+        items.append(position)
+        position = _skip(text, decoder.raw_decode(text, position)[1])
+    return items
+
+
+def _value_start(text, position, key):
+    """The start of the value of key, in the object at position"""
+    for member_key, key_start, value_start, value_end in _members(text, position):
+        if member_key == key:
+            return value_start
+    raise ValueError('There is no "{}" in cleanup.json'.format(key))
+
+
+def rule_text(contents, old_text):
+    """
+    contents as JSON, laid out like old_text: a list of lines goes one line per line if the old one did,
+    aligned with its first line
+    """
+    if isinstance(contents, str) or len(contents) < 2 or '\n' not in old_text:
+        return json.dumps(contents, ensure_ascii=False)
+    first_line = old_text.index('\n') + 1
+    indent = ' ' * (len(old_text[first_line:]) - len(old_text[first_line:].lstrip(' ')))
+    return '[\n{}]'.format(',\n'.join(indent + json.dumps(line, ensure_ascii=False) for line in contents))
+
+
+def splice_cleanup_rules(text, tag, edits):
+    """
+    Puts the edited cleanup rules of tag in the text of cleanup.json, everything else stays as it is
+
+    :param edits: dict of position: (replacement, contents), positions counted like cleanup_patterns does
+    """
+    tag_rules = _value_start(text, _value_start(text, _skip(text, 0, '{'), 'cleanup'), tag)
+    spans = []
+    for entry_start in _items(text, _skip(text, tag_rules, '[')):
+        spans.extend(_members(text, _skip(text, entry_start, '{')))
+    replaced = []
+    for position, (replacement, contents) in edits.items():
+        key, key_start, value_start, value_end = spans[position]
+        replaced.append((value_start, value_end, rule_text(contents, text[value_start:value_end])))
+        key_end = scanstring(text, key_start + 1)[1]
+        replaced.append((key_start, key_end, json.dumps(replacement, ensure_ascii=False)))
+    for start, end, new_text in sorted(replaced, reverse=True):
+        text = text[:start] + new_text + text[end:]
+    return text
+
+
+def save_rules(rules, edits, cleanup_file=CLEANUP_FILE, cache_file=CACHE_FILE):
+    """
+    Writes edited cleanup rules of rules.tag to cleanup_file, and the rules compiled with them to the cache
+
+    :param edits: dict of position: (replacement, contents), contents as cleanup.json has it
+    :returns: new CompiledRules, rules itself stays as it is
+    :raises re.error, ValueError: when one of the rules doesn't compile, or cleanup_file no longer holds
+        the rules, nothing is written then
+    """
+    saved = rules.copy()
+    saved.data = copy.deepcopy(rules.data)
+    for position, (replacement, contents) in sorted(edits.items()):
+        saved.edit_cleanup_rule(position, replacement, *join_fragments(contents))
+        replace_cleanup_rule(saved.data, rules.tag, position, replacement, contents)
+    with open(cleanup_file, encoding='utf-8', newline='') as handle:
+        text = handle.read()
+    if json.loads(text) != rules.data:
+        raise ValueError('{} was changed since the rules were loaded'.format(cleanup_file))
+    text = splice_cleanup_rules(text, rules.tag, edits)
+    if json.loads(text) != saved.data:
+        raise ValueError('The edited rules could not be put in {}'.format(cleanup_file))
+    content = text.encode('utf-8')
+    tmp_file = Path(str(cleanup_file) + '.tmp')
+    with open(tmp_file, 'wb') as handle:
+        handle.write(content)
+    tmp_file.replace(cleanup_file)
+    write_cache(cache_key(content), saved, cache_file)
+    return saved
+
+
+def load_rules(cleanup_file=CLEANUP_FILE, cache_file=CACHE_FILE):
+    """:returns: the CompiledRules for cleanup_file, from the cache when cleanup_file didn't change"""
+    with open(cleanup_file, 'rb') as handle:
+        content = handle.read()
+    key = cache_key(content)
+    rules = read_cache(key, cache_file)
+    if rules is None:
+        rules = CompiledRules(json.loads(content.decode('utf-8')))
+        write_cache(key, rules, cache_file)
+    return rules
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+ Matches OSM features to Wikidata items by location (P625 coordinates) and name
+
+ The candidate items go into a grid of cells as high as the search radius, and as wide as
+ the radius at the latitude of their row. A feature is only compared to the candidates in the
+ cells around it, the distances to all of those are calculated at once with NumPy,
+ for all the features in a block of cells together
+"""
+import numpy as np
+
+from .property_search import trigrams
+
+COORDINATES = 'P625'
+EARTH_RADIUS = 6371008.8
+# meters
+RADIUS = 500
+# share of the score that comes from the name, the rest from the distance
+NAME_WEIGHT = 0.5
+LIMIT = 5
+# Features are handled in blocks of this many by this many cells
+BLOCK = 4
+
+
+def coordinates(entity):
+    """:returns: (longitude, latitude) of the first P625 statement of an entity, or None"""
+    for claim in entity.get('claims', {}).get(COORDINATES, []):
+        value = claim.get('mainsnak', {}).get('datavalue', {}).get('value')
+        if value and value.get('globe', '').endswith('/Q2'):
+            return value['longitude'], value['latitude']
+    return None
+
+
+def name_trigrams(name):
+    return trigrams(name.casefold()) if name else frozenset()
+
+
+def name_similarity(first, second):
+    """Share of the trigrams of two names, see name_trigrams, they have in common"""
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+def haversine(longitudes, latitudes, other_longitudes, other_latitudes):
+    """Distances in meters, between every point of the first arrays and every point of the other arrays"""
+    lon1, lat1 = np.radians(longitudes)[:, None], np.radians(latitudes)[:, None]
+    lon2, lat2 = np.radians(other_longitudes)[None, :], np.radians(other_latitudes)[None, :]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class SpatialMatcher:
+    """
+    matcher = SpatialMatcher(radius=300)
+    matcher.add_candidates([('Q123', 'Kampala Primary School', 32.58, 0.31), ...])
+    matcher.match([(fid, name, longitude, latitude), ...]) returns per fid the
+    [(Q-id, meters, score), ...] of the candidates within the radius, best score first
+
+    Coordinates are WGS 84 degrees, longitudes between -180 and 180. Near the antimeridian
+    the cells on the other side are looked in as well
+    """
+    def __init__(self, radius=RADIUS, name_weight=NAME_WEIGHT, limit=LIMIT):
+        self.radius = radius
+        self.name_weight = name_weight
+        self.limit = limit
+        self.row_height = np.degrees(radius / EARTH_RADIUS)
+        self.ids = []
+        self.labels = []
+        self._label_trigrams = []
+        self.longitudes = np.empty(0)
+        self.latitudes = np.empty(0)
+        self.cells = None
+
+    @classmethod
+    def from_entities(cls, entities, language='en', **kwargs):
+        """:param entities: dict of id: entity, as EntityStore.get_many returns them"""
+        matcher = cls(**kwargs)
+        candidates = []
+        for entity_id, entity in entities.items():
+            location = coordinates(entity)
+            if location:
+                candidates.append((entity_id, entity.get('labels', {}).get(language, ''), *location))
+        matcher.add_candidates(candidates)
+        return matcher
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add_candidates(self, candidates):
+        """:param candidates: iterable of (id, label, longitude, latitude)"""
+        longitudes, latitudes = [], []
+        for candidate_id, label, longitude, latitude in candidates:
+            self.ids.append(candidate_id)
+            self.labels.append(label)
+            self._label_trigrams.append(None)
+            longitudes.append(longitude)
+            latitudes.append(latitude)
+        self.longitudes = np.concatenate([self.longitudes, np.asarray(longitudes, dtype=float)])
+        self.latitudes = np.concatenate([self.latitudes, np.asarray(latitudes, dtype=float)])
+        self.cells = None
+
+    def _column_width(self, rows):
+        """Degrees of longitude the radius spans at the latitude in a row that is furthest from the equator"""
+        furthest = np.minimum(np.maximum(np.abs(rows), np.abs(rows + 1)) * self.row_height, 89.0)
+        return self.row_height / np.cos(np.radians(furthest))
+
+    def _cell_keys(self, longitudes, latitudes):
+        rows = np.floor(latitudes / self.row_height).astype(np.int64)
+        columns = np.floor(longitudes / self._column_width(rows)).astype(np.int64)
+        return rows, columns
+
+    def _build(self):
+        """Cell (row, column): array of the positions of the candidates in it"""
+        rows, columns = self._cell_keys(self.longitudes, self.latitudes)
+        order = np.lexsort((columns, rows))
+        keys = np.stack([rows[order], columns[order]], axis=1)
+        starts = np.flatnonzero(np.any(np.diff(keys, axis=0) != 0, axis=1)) + 1
+        self.cells = {}
+        for cell in np.split(order, starts) if len(order) else []:
+            self.cells[(int(rows[cell[0]]), int(columns[cell[0]]))] = cell
+
+    def _around(self, row_min, row_max, longitude_min, longitude_max):
+        """
+        Positions of the candidates that can be within the radius of a point
+        in the rows, between the longitudes
+        """
+        found = []
+        for near_row in range(row_min - 1, row_max + 2):
+            # at most the radius in degrees of longitude anywhere in the row
+            width = self._column_width(np.array([near_row]))[0]
+            spans = [(longitude_min, longitude_max)]
+            # across the antimeridian
+            if longitude_min - width < -180:
+                spans.append((longitude_min + 360, longitude_max + 360))
+            if longitude_max + width > 180:
+                spans.append((longitude_min - 360, longitude_max - 360))
+            columns = set()
+            for span_min, span_max in spans:
+                columns.update(range(int(np.floor((span_min - width) / width)),
+                                     int(np.floor((span_max + width) / width)) + 1))
+            for column in sorted(columns):
+                cell = self.cells.get((near_row, column))
+                if cell is not None:
+                    found.append(cell)
+        return np.concatenate(found) if found else None
+
+    def match(self, features):
+        """
+        :param features: iterable of (key, name, longitude, latitude)
+        :returns: dict of key: list of (candidate id, meters, score), best first
+        """
+        if self.cells is None:
+            self._build()
+        features = list(features)
+        matches = {key: [] for key, name, longitude, latitude in features}
+        if not features or not self.ids:
+            return matches
+        longitudes = np.array([feature[2] for feature in features], dtype=float)
+        latitudes = np.array([feature[3] for feature in features], dtype=float)
+        label_trigrams = self._label_trigrams
+        rows, columns = self._cell_keys(longitudes, latitudes)
+        # features in blocks of cells share one distance calculation
+        block_rows, block_columns = rows // BLOCK, columns // BLOCK
+        order = np.lexsort((block_columns, block_rows))
+        starts = np.flatnonzero((np.diff(block_rows[order]) != 0) | (np.diff(block_columns[order]) != 0)) + 1
+        for group in np.split(order, starts):
+            candidates = self._around(int(rows[group].min()), int(rows[group].max()),
+                                      longitudes[group].min(), longitudes[group].max())
+            if candidates is None:
+                continue
+            distances = haversine(longitudes[group], latitudes[group],
+                                  self.longitudes[candidates], self.latitudes[candidates])
+            feature_numbers, candidate_numbers = np.nonzero(distances <= self.radius)
+            if not len(feature_numbers):
+                continue
+            meters = distances[feature_numbers, candidate_numbers]
+            distance_scores = (1 - self.name_weight) * (1 - meters / self.radius)
+            group_trigrams = {}
+            for feature_number, position, distance, distance_score in zip(
+                    feature_numbers.tolist(), candidates[candidate_numbers].tolist(),
+                    meters.tolist(), distance_scores.tolist()):
+                key, name = features[group[feature_number]][:2]
+                if feature_number not in group_trigrams:
+                    group_trigrams[feature_number] = name_trigrams(name)
+                if label_trigrams[position] is None:
+                    label_trigrams[position] = name_trigrams(self.labels[position])
+                score = distance_score + self.name_weight * name_similarity(
+                    group_trigrams[feature_number], label_trigrams[position])
+                matches[key].append((self.ids[position], distance, score))
+        for key, found in matches.items():
+            found.sort(key=lambda match: -match[2])
+            del found[self.limit:]
+        return matches
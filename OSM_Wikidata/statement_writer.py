@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+ Writes the statements from the "Wikidata statements" section of cleanup.json to Wikidata
+
+ All the new claims for an item, with their references, go into a single wbeditentity call.
+ Claims the item already has, according to the EntityStore, are left out. Every step is
+ appended to a journal, so a run that got interrupted picks up where it stopped
+"""
+import json
+import os
+import re
+import time
+from http.cookiejar import CookieJar
+from pathlib import Path
+from urllib.parse import urlencode
+from urllib.request import HTTPCookieProcessor, Request, build_opener
+
+from .entity_store import API_URL, TIMEOUT, USER_AGENT
+
+parent_dir = Path(__file__).resolve().parent
+
+JOURNAL_FILE = parent_dir / 'statement_journal.jsonl'
+PROPERTY_ID = re.compile(r'^P[1-9][0-9]*$')
+MAXLAG = 5
+# times an edit is tried again while the servers lag
+MAXLAG_RETRIES = 10
+SUMMARY = 'Statements from OpenStreetMap school data'
+
+PLANNED, STARTED, DONE, SKIPPED, FAILED = 'planned', 'started', 'done', 'skipped', 'failed'
+
+
+def statement_key(label):
+    """
+    Statements are referred to in different spellings, 'primary school statement',
+    'primarySchoolStatement' and 'primarySchool_statement' are all the same statement
+    """
+    key = re.sub(r'[\W_]', '', label).casefold()
+    return key[:-len('statement')] if key.endswith('statement') else key
+
+
+def item_value(item_id):
+    return {'value': {'entity-type': 'item', 'numeric-id': int(item_id[1:]), 'id': item_id},
+            'type': 'wikibase-entityid'}
+
+
+def snak(wd_property, item_id):
+    return {'snaktype': 'value', 'property': wd_property, 'datavalue': item_value(item_id)}
+
+
+class Statement:
+    """
+    One claim, wd_property: value (an item), with the (property, item) pairs of its reference
+    """
+    __slots__ = ('label', 'wd_property', 'value', 'references')
+
+    def __init__(self, label, wd_property, value, references):
+        self.label = label
+        self.wd_property = wd_property
+        self.value = value
+        self.references = references
+
+    def __repr__(self):
+        return 'Statement({!r}, {!r}, {!r})'.format(self.label, self.wd_property, self.value)
+
+    def claim(self):
+        """The claim as wbeditentity expects it"""
+        claim = {'mainsnak': snak(self.wd_property, self.value), 'type': 'statement', 'rank': 'normal'}
+        if self.references:
+            snaks = {}
+            for wd_property, item_id in self.references:
+                snaks.setdefault(wd_property, []).append(snak(wd_property, item_id))
+            claim['references'] = [{'snaks': snaks}]
+        return claim
+
+    def exists_in(self, entity):
+        """Whether the entity already has this claim, whatever its references"""
+        for claim in entity.get('claims', {}).get(self.wd_property, []):
+            value = claim.get('mainsnak', {}).get('datavalue', {}).get('value')
+            if isinstance(value, dict) and value.get('id') == self.value:
+                return True
+        return False
+
+
+def resolve_property(label, properties, catalog=None):
+    """
+    The P-id for a property as a statement or reference gives it: a P-id, a label from
+    "Wikidata properties", or else the full label of a property in the catalog
+
+    :returns: the P-id, or None if there is no property by that name
+    """
+    if PROPERTY_ID.match(label):
+        return label
+    if label in properties:
+        return properties[label]
+    if catalog is not None:
+        wanted = label.casefold()
+        for wd_property, property_label, description, aliases in catalog.entries():
+            if property_label.casefold() == wanted:
+                return wd_property
+    return None
+
+
+def load_statements(data, catalog=None):
+    """
+    The statements of cleanup.json, by statement_key
+
+    Every statement is [property, item, references]. Properties, items and references can be referred to by
+    their labels in "Wikidata properties", "Wikidata items" and "Wikidata references", properties also by
+    their label in catalog, a PropertyCatalog
+
+    :raises ValueError: for a statement without a property, or with a property that can't be resolved
+    """
+    properties = data.get('Wikidata properties', {})
+    items = data.get('Wikidata items', {})
+
+    def references(label, labels):
+        pairs = []
+        for reference_label in labels:
+            wd_property, value = data['Wikidata references'][reference_label]
+            reference_property = resolve_property(wd_property, properties, catalog)
+            if reference_property is None:
+                raise ValueError('Reference "{}" of statement "{}": no property called "{}"'.format(
+                    reference_label, label, wd_property))
+            pairs.append((reference_property, items.get(value, value)))
+        return pairs
+
+    statements = {}
+    for label, statement in data.get('Wikidata statements', {}).items():
+        if len(statement) != 3:
+            raise ValueError('Statement "{}" has to be [property, item, references]'.format(label))
+        wd_property = resolve_property(statement[0], properties, catalog)
+        if wd_property is None:
+            raise ValueError('Statement "{}": no property called "{}"'.format(label, statement[0]))
+        statements[statement_key(label)] = Statement(label, wd_property, items.get(statement[-2], statement[-2]),
+                                                     references(label, statement[-1]))
+    return statements
+
+
+def edits_for_features(interpretations, matches, statements):
+    """
+    :param interpretations: dict of fid: (tags, statement labels), as InterpretLayerJob has them
+    :param matches: dict of fid: [(Q-id, meters, score), ...], the best match is taken as the item of the feature
+    :param statements: the result of load_statements
+    :returns: dict of Q-id: list of Statement
+    """
+    edits = {}
+    for fid, (tags, labels) in interpretations.items():
+        if not matches.get(fid):
+            continue
+        item_id = matches[fid][0][0]
+        for label in labels:
+            statement = statements.get(statement_key(label))
+            if statement is not None and statement not in edits.setdefault(item_id, []):
+                edits[item_id].append(statement)
+    return edits
+
+
+class Journal:
+    """
+    Append-only record of what happened to every item, one JSON object per line.
+    Only the last line for an item counts
+    """
+    def __init__(self, journal_file=JOURNAL_FILE):
+        self.journal_file = Path(journal_file)
+        self.states = {}
+        if self.journal_file.exists():
+            with open(self.journal_file, encoding='utf-8') as handle:
+                for line in handle:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut short by a crash
+                        continue
+                    self.states[entry['item']] = entry
+        self._handle = open(self.journal_file, 'a', encoding='utf-8')
+
+    def state(self, item_id):
+        entry = self.states.get(item_id)
+        return entry['step'] if entry else None
+
+    def record(self, item_id, step, **details):
+        entry = dict(item=item_id, step=step, time=time.time(), **details)
+        self.states[item_id] = entry
+        self._handle.write(json.dumps(entry) + '\n')
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+
+    def close(self):
+        self._handle.close()
+
+
+class ApiSession:
+    """Logged in session with the MediaWiki API, for a bot password from Special:BotPasswords"""
+    def __init__(self, username, password, api_url=API_URL):
+        self.api_url = api_url
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()))
+        login_token = self.call(action='query', meta='tokens', type='login')['query']['tokens']['logintoken']
+        result = self.call(action='login', lgname=username, lgpassword=password, lgtoken=login_token)
+        if result.get('login', {}).get('result') != 'Success':
+            raise RuntimeError('Logging in as {} failed: {}'.format(username, result.get('login', result)))
+        self.csrf_token = self.call(action='query', meta='tokens')['query']['tokens']['csrftoken']
+
+    def call(self, **parameters):
+        """A POST request, :returns: the decoded response, maxlag and rate limit errors included"""
+        parameters.setdefault('format', 'json')
+        request = Request(self.api_url, data=urlencode(parameters).encode('utf-8'),
+                          headers={'User-Agent': USER_AGENT})
+        with self.opener.open(request, timeout=TIMEOUT) as response:
+            result = json.load(response)
+            result['retry-after'] = response.headers.get('Retry-After')
+        return result
+
+
+class StatementWriter:
+    """
+    writer = StatementWriter(ApiSession(username, password), EntityStore())
+    writer.write(edits_for_features(interpretations, matches, load_statements(data)))
+
+    Items that are done according to the journal are skipped. Items an edit was started for,
+    but not finished, are fetched again before deciding what they still need
+    """
+    def __init__(self, session, store, journal_file=JOURNAL_FILE, summary=SUMMARY, maxlag=MAXLAG):
+        self.session = session
+        self.store = store
+        self.journal = Journal(journal_file)
+        self.summary = summary
+        self.maxlag = maxlag
+        self.counts = {DONE: 0, SKIPPED: 0, FAILED: 0}
+
+    def _edit(self, item_id, claims, revision):
+        """:returns: the response of wbeditentity, after waiting out the lag of the servers"""
+        for attempt in range(MAXLAG_RETRIES):
+            result = self.session.call(action='wbeditentity', id=item_id, data=json.dumps({'claims': claims}),
+                                       baserevid=revision, summary=self.summary, bot=1, maxlag=self.maxlag,
+                                       token=self.session.csrf_token)
+            code = result.get('error', {}).get('code')
+            if code not in ('maxlag', 'ratelimited'):
+                return result
+            try:
+                delay = float(result.get('retry-after') or self.maxlag)
+            except ValueError:
+                delay = self.maxlag
+            time.sleep(delay * (attempt + 1))
+        return result
+
+    def write(self, edits, progress=None, cancelled=None):
+        """
+        :param edits: dict of Q-id: list of Statement
+        :param progress: callable receiving the percentage of items done
+        :param cancelled: callable, when it returns True no further edits are made
+        :returns: counts of the items done, skipped and failed
+        """
+        to_do = sorted(item_id for item_id in edits if self.journal.state(item_id) not in (DONE, SKIPPED))
+        # the edit may have gone through before the crash, the cache wouldn't know
+        self.store.invalidate([item_id for item_id in to_do if self.journal.state(item_id) == STARTED])
+        entities = self.store.get_many(to_do)
+        for number, item_id in enumerate(to_do, 1):
+            if cancelled is not None and cancelled():
+                break
+            entity = entities.get(item_id)
+            if entity is None:
+                self.journal.record(item_id, FAILED, error='no such item')
+                self.counts[FAILED] += 1
+                continue
+            new = [statement for statement in edits[item_id] if not statement.exists_in(entity)]
+            if not new:
+                self.journal.record(item_id, SKIPPED)
+                self.counts[SKIPPED] += 1
+                continue
+            self.journal.record(item_id, STARTED, revision=entity['revision'],
+                                statements=[statement.label for statement in new])
+            result = self._edit(item_id, [statement.claim() for statement in new], entity['revision'])
+            if 'error' in result:
+                self.journal.record(item_id, FAILED, error=result['error'].get('info', result['error'].get('code')))
+                self.counts[FAILED] += 1
+            else:
+                self.journal.record(item_id, DONE, revision=result.get('entity', {}).get('lastrevid'))
+                self.counts[DONE] += 1
+            self.store.invalidate([item_id])
+            if progress is not None:
+                progress(100.0 * number / len(to_do))
+        return self.counts
+
+    def close(self):
+        self.journal.close()
@@ -0,0 +1,74 @@
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+# The plugins are imported as packages from the root of the repository, without QGIS
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+class StubServer:
+    """
+    A stand-in for the Wikidata API and Overpass on localhost
+
+    respond(parameters) gets the GET and POST parameters of a request, as a dict of name: value,
+    and returns the JSON to answer with, or (status, headers, JSON). requests holds the parameters
+    of every request, in order
+    """
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def handle_request(self, body=b''):
+                parameters = parse_qs(urlsplit(self.path).query)
+                parameters.update(parse_qs(body.decode('utf-8')))
+                parameters = {name: values[-1] for name, values in parameters.items()}
+                stub.requests.append(parameters)
+                answer = stub.respond(parameters)
+                status, headers, result = answer if isinstance(answer, tuple) else (200, {}, answer)
+                content = json.dumps(result).encode('utf-8')
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                self.handle_request()
+
+            def do_POST(self):
+                self.handle_request(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/w/api.php'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    """stub_server(respond) starts a StubServer, it is shut down after the test"""
+    servers = []
+
+    def start(respond):
+        servers.append(StubServer(respond))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.close()
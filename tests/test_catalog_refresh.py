@@ -0,0 +1,81 @@
+import io
+import json
+import re
+
+import pytest
+
+from OSM_Wikidata.catalog_refresh import refresh, stream_bindings
+from OSM_Wikidata.property_catalog import PropertyCatalog
+
+PROPERTIES = [
+    ('P17', 'country', 'sovereign state of this item', 'land, state'),
+    ('P31', 'instance of', 'that class of which this subject is a particular example', 'is a'),
+    ('P137', 'operator', 'person, profession or organization that operates the equipment', ''),
+    ('P1448', 'official name', 'official name of the subject in its official language(s)', 'nom officiel'),
+    ('P1813', 'short name', 'short name of a place, organisation, person, journal, Wikidata property, etc.', 'kürzel'),
+]
+
+
+def binding(wd_property, label, description, aliases):
+    result = {'property': {'type': 'uri', 'value': 'http://www.wikidata.org/entity/' + wd_property},
+              'propertyLabel': {'type': 'literal', 'value': label, 'xml:lang': 'en'},
+              'propertyDescription': {'type': 'literal', 'value': description}}
+    if aliases:
+        result['altLabel_list'] = {'type': 'literal', 'value': aliases}
+    return result
+
+
+def sparql_result(properties):
+    return {'head': {'vars': ['property', 'propertyLabel', 'propertyDescription', 'altLabel_list']},
+            'results': {'bindings': [binding(*entry) for entry in properties]}}
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 1 << 16])
+def test_stream_bindings_over_chunk_boundaries(chunk_size):
+    # 'ü', 'é' and '✓' are 2 and 3 bytes in UTF-8, small chunks split them
+    properties = PROPERTIES + [('P2000', 'café ✓', 'ü' * 5, '')]
+    content = json.dumps(sparql_result(properties), ensure_ascii=False).encode('utf-8')
+    bindings = list(stream_bindings(io.BytesIO(content), chunk_size))
+    assert [item['propertyLabel'] for item in bindings] == [entry[1] for entry in properties]
+    assert bindings[-1]['propertyDescription'] == 'üüüüü'
+
+
+def test_stream_bindings_cut_short():
+    content = json.dumps(sparql_result(PROPERTIES)).encode('utf-8')
+    with pytest.raises(ValueError):
+        list(stream_bindings(io.BytesIO(content[:len(content) // 2]), 16))
+
+
+def sparql_endpoint(properties):
+    """respond() for the stub server: one page of properties, like "WD properties.rq" asks for"""
+    def respond(parameters):
+        after = int(re.search(r'\?propertyId > (\d+)', parameters['query']).group(1))
+        limit = int(re.search(r'LIMIT (\d+)', parameters['query']).group(1))
+        page = [entry for entry in properties if int(entry[0][1:]) > after][:limit]
+        return sparql_result(page)
+    return respond
+
+
+def test_incremental_refresh(stub_server, tmp_path):
+    json_file, catalog_file = tmp_path / 'WD properties.json', tmp_path / 'properties.catalog'
+    available = PROPERTIES[:3]
+    server = stub_server(sparql_endpoint(available))
+    assert refresh(json_file, catalog_file, server.url, page_size=2) == 3
+    # pages of 2, after 0 and after 31
+    assert len(server.requests) == 2
+
+    available.extend(PROPERTIES[3:])
+    server.requests.clear()
+    assert refresh(json_file, catalog_file, server.url, page_size=2) == 2
+    assert [re.search(r'\?propertyId > (\d+)', request['query']).group(1) for request in server.requests] == \
+        ['137', '1813']
+
+    catalog = PropertyCatalog(catalog_file, json_file=None)
+    assert list(catalog) == ['P17', 'P31', 'P137', 'P1448', 'P1813']
+    assert catalog['P1813'] == 'short name'
+    assert catalog.aliases('P17') == ['land', 'state']
+    catalog.close()
+    with open(json_file, encoding='utf-8') as handle:
+        entries = json.load(handle)
+    assert [entry['property'] for entry in entries] == ['P17', 'P31', 'P137', 'P1448', 'P1813']
+    assert entries[-1]['altLabel_list'] == 'kürzel'
@@ -0,0 +1,131 @@
+import random
+import re
+
+import pytest
+
+from OSM_Wikidata.cleanup_engine import CleanupEngine, CleanupRule
+from OSM_Wikidata.literal_index import LiteralIndex, required_literals
+
+NAMES = [
+    'St. Micheal Nursery/Primary Sch.',
+    'ST MARY MAGDALANE P/S',
+    'Stelizabeth Domnic Prep. School',
+    'Kampala S.S.',
+    'Kawempe Muslim SS',
+    'Mengo Early Child Development Centre',
+    'E.C.D Kireka',
+    'Saintt Lawrance Acadamy',
+    'S.D.A Nursery & Primary School',
+    'Seventh Day Adventist P.S',
+    'C/U Kasubi Primary  School',
+    'COU Church of Uganda Pri. Sch',
+    'R.C.C. Nsambya',
+    'Rc Kisubi Boarding Sch',
+    'Secret Heart Intergrated Juniour School',
+    'Good Sheperd Teletabbies Nursery School',
+    'Devine Mercy Quaran School',
+    'Busega Coolege HighWay',
+    'Modern Buss iness Institute',
+    'Kyambogo International School Iii',
+    'Standard II Stardard',
+    '  Gayaza High School  ',
+    'Aloysious Martyr Cntr',
+    'Namirembe Prep School',
+    'ÉCOLE Sainte-Thérèse',
+    '',
+]
+
+
+def sequential(rules, name):
+    """What the engine has to match: every rule applied with re.sub, in order"""
+    for rule in rules:
+        name = re.sub(rule.source, rule.template, name, flags=rule.flags)
+    return name
+
+
+def generated_names(count, seed=1):
+    words = ['St', 'St.', 'Saint', 'Micheal', 'P/S', 'Pri', 'Sch', 'SS', 'S.S.', 'C/U', 'RC', 'R.C.C', 'ECD',
+             'Nursery', '&', 'Prep', 'Iii', 'Kampala', 'Mengo', 'Acadamy', 'Stelizabeth', 'Sacred', 'Heart',
+             'SDA', 'Cou', 'School', 'Chool', '  ', '-', '.']
+    generator = random.Random(seed)
+    return [' '.join(generator.choice(words) for _ in range(generator.randint(1, 6))) for _ in range(count)]
+
+
+@pytest.fixture(scope='module')
+def engine():
+    return CleanupEngine.from_file()
+
+
+def test_same_as_sequential_substitution(engine):
+    for name in NAMES + generated_names(2000):
+        assert engine.clean(name) == sequential(engine.rules, name), name
+
+
+def test_clean_many(engine):
+    names = NAMES + [None] + NAMES
+    assert list(engine.clean_many(names)) == [engine.clean(name) if name is not None else None for name in names]
+
+
+def test_required_literals_hold_for_every_match(engine):
+    """A rule that matches a name always finds one of its literals in it, or the prefilter would skip it"""
+    for name in NAMES + generated_names(500, seed=2):
+        folded = name.casefold()
+        for rule in engine.rules:
+            if rule.literals and rule.regex.search(name):
+                assert any(literal in folded for literal in rule.literals), (rule, name)
+
+
+@pytest.mark.parametrize('source, flags, literals', [
+    ('Micheal', 0, {'micheal'}),
+    ('[Ss]chool', 0, {'school'}),
+    ('S[ae]cre[dt]\\s+Heart', 0, {'sacred', 'sacret', 'secred', 'secret'}),
+    ('[A-Z]ool', 0, {'ool'}),
+    # i matches İ and ı when ignoring case, they casefold to something else
+    ('Micheal', re.IGNORECASE, {'cheal'}),
+    ('(?i)micheal', 0, {'cheal'}),
+    ('Iii', re.IGNORECASE, None),
+    ('(?i:Sch)ool', 0, {'school'}),
+    ('cat|dog', 0, {'cat', 'dog'}),
+    ('Prep|Preparatory', 0, {'prep'}),
+    ('Saint(ly)? Mary', 0, {'saint'}),
+    ('Acc*ademy', 0, {'ademy'}),
+    ('(Hill)?\\s+', 0, None),
+    ('\\s+', 0, None),
+])
+def test_required_literals(source, flags, literals):
+    found = required_literals(source, flags)
+    assert found == (frozenset(literals) if literals is not None else None)
+    for text in ('Micheal', 'MICHEAL', 'school', 'Sacred Heart', 'cat', 'Preparatory', 'Saintly Mary', 'Academy'):
+        if re.search(source, text, flags) and found:
+            assert any(literal in text.casefold() for literal in found)
+
+
+def test_literal_index():
+    index = LiteralIndex()
+    index.add('sch', 1)
+    index.add('school', 2)
+    index.add('prep', 4)
+    assert index.scan('primary school') == 3
+    assert index.scan('prep sc') == 4
+    assert index.scan('kampala') == 0
+    assert LiteralIndex().scan('anything') == 0
+
+
+def test_replacement_brings_in_a_later_rule():
+    # "Saint Mry" only appears once the first rule has run
+    engine = CleanupEngine([CleanupRule('Saint ', '^St\\s'), CleanupRule('Saint Mary', 'Saint Mry')])
+    assert engine.introduces[0] & 1 << 1
+    assert not engine.candidates('St Mry') & 1 << 1
+    assert engine.clean('St Mry') == 'Saint Mary'
+
+
+def test_removal_joins_a_later_literal():
+    engine = CleanupEngine([CleanupRule('', '-'), CleanupRule('Academy', 'Acadamy')])
+    assert engine.introduces[0] & 1 << 1
+    assert engine.clean('Aca-damy') == 'Academy'
+
+
+def test_unrelated_replacement_introduces_nothing():
+    engine = CleanupEngine([CleanupRule('Michael', 'Micheal'), CleanupRule('Academy', 'Acadamy')])
+    assert engine.introduces[0] == 0
+    assert engine.clean('Micheal Acadamy') == 'Michael Academy'
@@ -0,0 +1,18 @@
+import ast
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def without_docstring(path):
+    """The module as parsed, apart from its docstring, which tells which one is the copy"""
+    module = ast.parse(path.read_text(encoding='utf-8'))
+    assert isinstance(module.body[0], ast.Expr) and isinstance(module.body[0].value, ast.Constant)
+    return ast.dump(ast.Module(body=module.body[1:], type_ignores=[]))
+
+
+@pytest.mark.parametrize('name', ['profiling.py', 'task_scheduler.py'])
+def test_actualizar_medidas_has_the_same_module(name):
+    assert without_docstring(ROOT / 'ActualizarMedidas' / name) == without_docstring(ROOT / 'OSM_Wikidata' / name)
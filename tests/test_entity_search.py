@@ -0,0 +1,90 @@
+import asyncio
+import threading
+import time
+
+from OSM_Wikidata.entity_search import EntitySearch, TokenBucket
+
+
+def respond(parameters):
+    if parameters['search'] == 'refused':
+        return 400, {}, {'error': {'code': 'badvalue'}}
+    if parameters['search'] == 'invalid':
+        return {'error': {'code': 'badvalue', 'info': 'Unrecognized value'}}
+    return {'search': [{'id': 'Q1', 'label': parameters['search'], 'description': 'school'}]}
+
+
+def test_refused_search_does_not_stop_the_others(stub_server, tmp_path):
+    server = stub_server(respond)
+    search = EntitySearch(tmp_path / 'entities.sqlite', api_url=server.url, backoff=0)
+    found = search.search_many(['Kampala  School', 'refused', 'invalid', 'Gulu School'])
+    assert found == {
+        'Kampala School': [{'id': 'Q1', 'label': 'Kampala School', 'description': 'school'}],
+        'Gulu School': [{'id': 'Q1', 'label': 'Gulu School', 'description': 'school'}],
+    }
+    assert sorted(search.failed) == ['invalid', 'refused']
+    # neither is retried
+    assert len(server.requests) == 4
+
+
+def test_duplicate_names_are_searched_once(stub_server, tmp_path):
+    server = stub_server(respond)
+    search = EntitySearch(tmp_path / 'entities.sqlite', api_url=server.url)
+    found = search.search_many(['Mengo School', 'Mengo  School', ' Mengo School ', 'Gulu School', 'Gulu School'])
+    assert sorted(found) == ['Gulu School', 'Mengo School']
+    assert sorted(request['search'] for request in server.requests) == ['Gulu School', 'Mengo School']
+    # and not again while the results are fresh
+    assert search.search_many(['Mengo School']) == {'Mengo School': found['Mengo School']}
+    assert len(server.requests) == 2
+
+
+def test_concurrency_is_bounded(stub_server, tmp_path):
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def slow(parameters):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+        return respond(parameters)
+
+    server = stub_server(slow)
+    search = EntitySearch(tmp_path / 'entities.sqlite', api_url=server.url, concurrency=3, rate=1000)
+    found = search.search_many(['School {}'.format(number) for number in range(30)])
+    assert len(found) == 30
+    assert 1 < running[1] <= 3
+
+
+def test_token_bucket():
+    async def acquire(bucket, count):
+        started = time.monotonic()
+        for _ in range(count):
+            await bucket.acquire()
+        return time.monotonic() - started
+
+    # a burst of 5 right away, the other 20 at 50 per second
+    elapsed = asyncio.run(acquire(TokenBucket(50, capacity=5), 25))
+    assert 0.38 <= elapsed < 1.0
+    assert asyncio.run(acquire(TokenBucket(50, capacity=5), 5)) < 0.05
+
+
+def test_rate_is_respected(stub_server, tmp_path):
+    times = []
+
+    def timed(parameters):
+        times.append(time.monotonic())
+        return respond(parameters)
+
+    server = stub_server(timed)
+    search = EntitySearch(tmp_path / 'entities.sqlite', api_url=server.url, rate=20)
+    search.search_many(['School {}'.format(number) for number in range(40)])
+    assert len(server.requests) == 40
+    times.sort()
+    # a burst of 20, the other 20 at 20 per second
+    assert times[-1] - times[0] >= 0.9
+    # and never more than that in any stretch of time, one request of slack for the timing
+    for first in range(len(times)):
+        for last in range(first + 1, len(times)):
+            assert last - first + 1 <= 20 + 20 * (times[last] - times[first]) + 1
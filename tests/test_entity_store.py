@@ -0,0 +1,77 @@
+from OSM_Wikidata.entity_store import EntityStore, retry_delay
+
+
+def wikidata(revision=7):
+    """respond() for the stub server: every id exists, at revision"""
+    def respond(parameters):
+        entities = {}
+        for entity_id in parameters['ids'].split('|'):
+            entity = {'id': entity_id, 'lastrevid': revision}
+            if 'labels' in parameters['props']:
+                entity['labels'] = {'en': {'language': 'en', 'value': 'label of {}'.format(entity_id)}}
+                entity['claims'] = {}
+                entity['sitelinks'] = {}
+            entities[entity_id] = entity
+        return {'entities': entities}
+    return respond
+
+
+IDS = ['Q{}'.format(number) for number in range(1, 121)]
+
+
+def test_cold_fetch_in_batches(stub_server, tmp_path):
+    server = stub_server(wikidata())
+    store = EntityStore(tmp_path / 'entities.sqlite', api_url=server.url)
+    labels = store.labels(IDS)
+    assert labels['Q120'] == 'label of Q120'
+    assert len(labels) == 120
+    assert [len(request['ids'].split('|')) for request in server.requests] == [50, 50, 20]
+    assert all(request['action'] == 'wbgetentities' for request in server.requests)
+    assert all('labels' in request['props'].split('|') for request in server.requests)
+
+
+def test_warm_cache_makes_no_requests(stub_server, tmp_path):
+    server = stub_server(wikidata())
+    EntityStore(tmp_path / 'entities.sqlite', api_url=server.url).get_many(IDS)
+    server.requests.clear()
+    store = EntityStore(tmp_path / 'entities.sqlite', api_url=server.url)
+    assert len(store.get_many(IDS)) == 120
+    assert server.requests == []
+    assert store.request_count == 0
+
+
+def test_stale_entries_are_revalidated(stub_server, tmp_path):
+    server = stub_server(wikidata())
+    EntityStore(tmp_path / 'entities.sqlite', api_url=server.url).get_many(IDS)
+    server.requests.clear()
+    store = EntityStore(tmp_path / 'entities.sqlite', api_url=server.url, max_age=0)
+    store.get_many(IDS)
+    # nothing was edited, so only the revisions are asked for
+    assert [request['props'] for request in server.requests] == ['info'] * 3
+
+    server.respond = wikidata(revision=8)
+    server.requests.clear()
+    assert store.get('Q1')['revision'] == 8
+    assert [request['props'] for request in server.requests] == ['info', 'info|labels|claims|sitelinks']
+
+
+def test_maxlag_is_retried(stub_server, tmp_path):
+    respond = wikidata()
+
+    def lagging(parameters):
+        if len(server.requests) == 1:
+            return 200, {'Retry-After': '0'}, {'error': {'code': 'maxlag', 'info': 'Waiting for a database server'}}
+        return respond(parameters)
+
+    server = stub_server(lagging)
+    store = EntityStore(tmp_path / 'entities.sqlite', api_url=server.url, backoff=0)
+    assert store.labels(['Q42']) == {'Q42': 'label of Q42'}
+    assert len(server.requests) == 2
+    assert server.requests[0]['maxlag'] == '5'
+
+
+def test_retry_delay():
+    assert retry_delay(0, backoff=1) == 1
+    assert retry_delay(3, backoff=1) == 8
+    assert retry_delay(0, backoff=1, retry_after='5') == 5
+    assert retry_delay(0, backoff=1, retry_after='Wed, 21 Oct 2015 07:28:00 GMT') == 1
@@ -0,0 +1,51 @@
+import pytest
+
+from OSM_Wikidata.cleanup_engine import expand_key, load_cleanup_data, macro_sources
+from OSM_Wikidata.interpret_engine import InterpretEngine
+from OSM_Wikidata.macro_graph import MacroGraph
+from OSM_Wikidata.rule_cache import CompiledRules
+
+DATA = load_cleanup_data()
+
+
+@pytest.fixture(scope='module')
+def engine():
+    return InterpretEngine.from_data(DATA)
+
+
+@pytest.mark.parametrize('name', ['St Mary Secondary School', 'St Mary S.S.'])
+def test_secondary_school(engine, name):
+    # <<Secondary School>> is the cleanup rule for S.S., interpret rules see the name it leaves as well
+    tags, statements = engine.interpret({'name': name})
+    assert tags['isced:level'] == '2;3;4'
+    assert 'secondarySchoolStatement' in statements
+
+
+@pytest.mark.parametrize('name', ['Kasubi Nursery and Primary School', 'Kasubi N/P School'])
+def test_nursery_and_primary_school(engine, name):
+    assert '<<Nursery and Primary School>>' in [rule.key for rule in engine.matching_rules('name', name)]
+    tags, statements = engine.interpret({'name': name})
+    assert {'primarySchoolStatement', 'nurserySchoolStatement'} <= set(statements)
+
+
+def test_primary_school(engine):
+    # <<Primary School>> isn't a cleanup rule, it stands for its literal text
+    tags, statements = engine.interpret({'name': 'Kampala Primary School'})
+    assert tags['isced:level'] == '1'
+    assert 'secondarySchoolStatement' not in statements
+
+
+def test_macro_graph_expands_keys_like_expand_key():
+    graph = MacroGraph.from_data(DATA)
+    macros = macro_sources(DATA)
+    for source in ('<<Secondary School>>', '<<Primary School>>', 'x <<Nursery and Primary School>> y'):
+        assert graph.expand_key(source) == expand_key(source, macros)
+
+
+def test_edited_rule_keeps_the_name_in_keys():
+    rules = CompiledRules(DATA)
+    position = next(number for number, pattern in enumerate(rules.cleanup_patterns)
+                    if pattern[0] == 'Secondary School ')
+    rules.edit_cleanup_rule(position, 'Secondary School ', r'\bS\.?S\.?\b', 0)
+    for name in ('St Mary Secondary School', 'St Mary SS'):
+        assert rules.interpret_engine.interpret({'name': name})[0]['isced:level'] == '2;3;4'
@@ -0,0 +1,202 @@
+import random
+import struct
+import zlib
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from OSM_Wikidata.osm_import import (NODE, RELATION, WAY, delta_array, delta_list, import_points,
+                                     packed_array, packed_list)
+
+FILTERS = {'amenity': {'school'}}
+KEYS = ['amenity', 'name']
+
+# id: (latitude, longitude, tags), in units of 1e-7 degrees
+NODES = {
+    10: (3476000, 325800000, {'amenity': 'school', 'name': 'Mengo'}),
+    11: (-10000, 325000000, {}),
+    12: (-10000, 325010000, {}),
+    13: (-20000, 325010000, {}),
+    14: (-20000, 325000000, {}),
+    15: (4000000, 330000000, {}),
+    16: (4000000, 330100000, {'amenity': 'hospital'}),
+    20: (2000000, 329000000, {'name': 'gate'}),
+}
+# in a block of its own, whose string table has none of the keys of the filter
+ROAD_NODES = {30: (1000000, 320000000, {'highway': 'crossing'})}
+# id: (node ids, tags)
+WAYS = {
+    100: ([11, 12, 13, 14, 11], {'amenity': 'school', 'name': 'Kawempe'}),
+    101: ([20, 15], {'building': 'yes'}),
+}
+# id: (members, tags), 21 and 22 aren't in the extract
+RELATIONS = {
+    200: ([(NODE, 21), (WAY, 101)], {'amenity': 'school', 'name': 'Gayaza', 'type': 'multipolygon'}),
+    201: ([(NODE, 22)], {'amenity': 'school;college', 'name': 'Nowhere'}),
+}
+MEMBER_TYPES = {NODE: 0, WAY: 1, RELATION: 2}
+
+EXPECTED = [
+    (NODE, 10, {'amenity': 'school', 'name': 'Mengo'}, 32.58, 0.3476),
+    (WAY, 100, {'amenity': 'school', 'name': 'Kawempe'}, 32.5005, -0.0015),
+    # the missing node 21 is left out of the mean
+    (RELATION, 200, {'amenity': 'school', 'name': 'Gayaza'}, (32.9 + 33.0) / 2, (0.2 + 0.4) / 2),
+    (RELATION, 201, {'amenity': 'school;college', 'name': 'Nowhere'}, None, None),
+]
+
+
+def varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def zigzag(value):
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def field(number, value):
+    if isinstance(value, int):
+        return varint(number << 3) + varint(value)
+    return varint(number << 3 | 2) + varint(len(value)) + value
+
+
+def packed(values):
+    return b''.join(varint(value) for value in values)
+
+
+def deltas(values):
+    previous = 0
+    coded = []
+    for value in values:
+        coded.append(zigzag(value - previous))
+        previous = value
+    return packed(coded)
+
+
+class StringTable:
+    def __init__(self):
+        self.strings = ['']
+
+    def __call__(self, text):
+        if text not in self.strings:
+            self.strings.append(text)
+        return self.strings.index(text)
+
+    def encode(self):
+        return b''.join(field(1, text.encode('utf-8')) for text in self.strings)
+
+
+def dense_nodes(nodes, strings):
+    ids = sorted(nodes)
+    keys_vals = []
+    for node_id in ids:
+        for key, value in nodes[node_id][2].items():
+            keys_vals.extend((strings(key), strings(value)))
+        keys_vals.append(0)
+    return field(2, field(1, deltas(ids)) + field(8, deltas([nodes[node_id][0] for node_id in ids]))
+                 + field(9, deltas([nodes[node_id][1] for node_id in ids])) + field(10, packed(keys_vals)))
+
+
+def tagged(element_id, tags, strings):
+    return (field(1, element_id) + field(2, packed([strings(key) for key in tags]))
+            + field(3, packed([strings(value) for value in tags.values()])))
+
+
+def primitive_block(groups, strings):
+    return field(1, strings.encode()) + b''.join(field(2, group) for group in groups) + field(17, 100)
+
+
+def blob(block_type, data, compress):
+    content = field(2, len(data)) + field(3, zlib.compress(data)) if compress else field(1, data)
+    header = field(1, block_type.encode('ascii')) + field(3, len(content))
+    return struct.pack('>I', len(header)) + header + content
+
+
+def write_pbf(path):
+    blocks = [blob('OSMHeader', field(4, b'OsmSchema-V0.6'), False)]
+    strings = StringTable()
+    blocks.append(blob('OSMData', primitive_block([dense_nodes(NODES, strings)], strings), True))
+    strings = StringTable()
+    blocks.append(blob('OSMData', primitive_block([dense_nodes(ROAD_NODES, strings)], strings), False))
+    strings = StringTable()
+    ways = b''.join(field(3, tagged(way_id, tags, strings) + field(8, deltas(refs)))
+                    for way_id, (refs, tags) in sorted(WAYS.items()))
+    relations = b''.join(field(4, tagged(relation_id, tags, strings)
+                               + field(8, packed([0] * len(members)))
+                               + field(9, deltas([member_id for member_type, member_id in members]))
+                               + field(10, packed([MEMBER_TYPES[member_type] for member_type, member_id in members])))
+                         for relation_id, (members, tags) in sorted(RELATIONS.items()))
+    blocks.append(blob('OSMData', primitive_block([ways, relations], strings), True))
+    path.write_bytes(b''.join(blocks))
+
+
+def xml_tags(tags):
+    return ''.join('<tag k="{}" v="{}"/>'.format(key, value) for key, value in tags.items())
+
+
+def write_osm(path):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<osm version="0.6" generator="test">']
+    for node_id, (latitude, longitude, tags) in sorted({**NODES, **ROAD_NODES}.items()):
+        lines.append('<node id="{}" lat="{}" lon="{}">{}</node>'.format(node_id, latitude / 1e7, longitude / 1e7,
+                                                                         xml_tags(tags)))
+    for way_id, (refs, tags) in sorted(WAYS.items()):
+        lines.append('<way id="{}">{}{}</way>'.format(way_id, ''.join('<nd ref="{}"/>'.format(ref) for ref in refs),
+                                                      xml_tags(tags)))
+    for relation_id, (members, tags) in sorted(RELATIONS.items()):
+        lines.append('<relation id="{}">{}{}</relation>'.format(relation_id, ''.join(
+            '<member type="{}" ref="{}" role=""/>'.format(member_type, ref) for member_type, ref in members),
+            xml_tags(tags)))
+    lines.append('</osm>')
+    path.write_text('\n'.join(lines), encoding='utf-8')
+
+
+def check(points):
+    assert [point[:3] for point in points] == [expected[:3] for expected in EXPECTED]
+    for point, expected in zip(points, EXPECTED):
+        if expected[3] is None:
+            assert point[3:] == (None, None)
+        else:
+            assert point[3:] == (pytest.approx(expected[3]), pytest.approx(expected[4]))
+
+
+def test_import_pbf(tmp_path):
+    path = tmp_path / 'extract.osm.pbf'
+    write_pbf(path)
+    check(list(import_points(path, FILTERS, KEYS)))
+
+
+def test_import_osm(tmp_path):
+    path = tmp_path / 'extract.osm'
+    write_osm(path)
+    check(list(import_points(path, FILTERS, KEYS)))
+
+
+def test_cancelled(tmp_path):
+    path = tmp_path / 'extract.osm.pbf'
+    write_pbf(path)
+    assert list(import_points(path, FILTERS, KEYS, cancelled=lambda: True)) == []
+
+
+def test_packed_array():
+    generator = random.Random(1)
+    values = [0, 1, 127, 128, 300, 2 ** 32, 2 ** 63, 2 ** 64 - 1] + [generator.getrandbits(40) for _ in range(200)]
+    buffer = packed(values)
+    assert packed_list(buffer) == values
+    assert packed_array(buffer).tolist() == values
+    assert packed_array(b'').tolist() == []
+
+
+def test_delta_array():
+    generator = random.Random(2)
+    values = [generator.randint(-2 ** 40, 2 ** 40) for _ in range(200)]
+    buffer = deltas(values)
+    assert delta_list(buffer) == values
+    assert delta_array(buffer).tolist() == values
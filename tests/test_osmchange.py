@@ -0,0 +1,33 @@
+import pytest
+
+from OSM_Wikidata.osmchange import NODE, RELATION, WAY, element_of, layer_element_type, parse_id
+
+
+def test_element_of():
+    assert element_of({'full_id': 'w45'}) == (WAY, 45)
+    assert element_of({'osm_type': 'relation', 'osm_id': '7'}) == (RELATION, 7)
+    assert element_of({'osm_type': 'node', 'osm_id': 12.0}) == (NODE, 12)
+    assert element_of({'osm_id': None, 'osm_way_id': '9'}) == (WAY, 9)
+    assert element_of({'name': 'Mengo'}) is None
+    # the layers of the OGR OSM driver
+    assert element_of({'osm_id': '12'}, layer_element_type('point', False)) == (NODE, 12)
+    assert element_of({'osm_id': '34'}, layer_element_type('line', False)) == (WAY, 34)
+    assert element_of({'osm_id': '56'}, layer_element_type('line', True)) == (RELATION, 56)
+    assert element_of({'osm_id': '78'}, layer_element_type('polygon', True)) == (RELATION, 78)
+    assert element_of({'osm_way_id': '90'}, layer_element_type('polygon', True)) == (WAY, 90)
+    # without knowing the layer an osm_id alone doesn't tell
+    assert element_of({'osm_id': '12'}) is None
+    assert element_of({'osm_type': 'changeset', 'osm_id': '12'}, NODE) is None
+
+
+def test_large_ids_keep_their_precision():
+    # float() would make this 9007199254740992
+    assert element_of({'osm_type': 'node', 'osm_id': '9007199254740993'}) == (NODE, 9007199254740993)
+
+
+@pytest.mark.parametrize('value', ['n123', '12.5', '', 'NULL', 12.5, 0, '-3'])
+def test_ids_that_dont_parse(value):
+    with pytest.raises(ValueError):
+        parse_id(value)
+    with pytest.raises(ValueError):
+        element_of({'osm_type': 'node', 'osm_id': value})
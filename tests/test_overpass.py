@@ -0,0 +1,78 @@
+import os
+import re
+import time
+
+from OSM_Wikidata.overpass import OverpassClient, ResponseCache, build_query, tiles
+
+QUERY = build_query({'amenity': {'school'}})
+
+# schools near Kampala, some of them in the tiles two bounding boxes share
+SCHOOLS = [
+    {'type': 'node', 'id': 1, 'lat': 0.30, 'lon': 32.55, 'tags': {'amenity': 'school', 'name': 'Mengo'}},
+    {'type': 'node', 'id': 2, 'lat': 0.40, 'lon': 32.60, 'tags': {'amenity': 'school', 'name': 'Kawempe'}},
+    {'type': 'way', 'id': 3, 'center': {'lat': 0.10, 'lon': 32.70}, 'tags': {'amenity': 'school'}},
+    {'type': 'node', 'id': 4, 'lat': 0.60, 'lon': 32.90, 'tags': {'amenity': 'school', 'name': 'Mukono'}},
+]
+
+
+def overpass(remark=None):
+    """respond() for the stub server: the schools in the bounding box of the query"""
+    def respond(parameters):
+        south, west, north, east = map(float, re.search(r'\(([-\d.,]+)\);', parameters['data']).group(1).split(','))
+        elements = [school for school in SCHOOLS
+                    if south <= school.get('center', school)['lat'] < north
+                    and west <= school.get('center', school)['lon'] < east]
+        response = {'version': 0.6, 'elements': elements}
+        if remark:
+            response['remark'] = remark
+        return response
+    return respond
+
+
+def client(server, tmp_path, ttl=3600):
+    return OverpassClient(server.url, ResponseCache(tmp_path / 'cache', ttl), backoff=0)
+
+
+def test_overlapping_bboxes_share_tiles(stub_server, tmp_path):
+    server = stub_server(overpass())
+    first_bbox, second_bbox = (0.0, 32.5, 0.5, 33.0), (0.25, 32.5, 0.75, 33.0)
+    first = client(server, tmp_path)
+    assert sorted(first.elements(QUERY, first_bbox)) == [('node', 1), ('node', 2), ('way', 3)]
+    assert first.request_count == len(tiles(first_bbox)) == 4
+
+    second = client(server, tmp_path)
+    assert sorted(second.elements(QUERY, second_bbox)) == [('node', 1), ('node', 2), ('node', 4)]
+    # the row of tiles from 0.25 to 0.5 came from the cache
+    assert second.cache_hits == 2
+    assert second.request_count == 2
+    assert len(server.requests) == 6
+
+
+def test_expired_tiles_are_fetched_again(stub_server, tmp_path):
+    server = stub_server(overpass())
+    bbox = (0.0, 32.5, 0.25, 32.75)
+    client(server, tmp_path).elements(QUERY, bbox)
+    cache = ResponseCache(tmp_path / 'cache', ttl=3600)
+    (path,) = cache.cache_dir.glob('*/*.json.gz')
+    an_hour_ago = time.time() - 3601
+    os.utime(path, (an_hour_ago, an_hour_ago))
+
+    again = client(server, tmp_path)
+    assert sorted(again.elements(QUERY, bbox)) == [('way', 3)]
+    assert (again.request_count, again.cache_hits) == (1, 0)
+    assert cache.prune() == 0
+    os.utime(path, (an_hour_ago, an_hour_ago))
+    assert cache.prune() == 1
+
+
+def test_runtime_errors_are_not_cached(stub_server, tmp_path):
+    server = stub_server(overpass('runtime error: Query timed out in "query" at line 3 after 180 seconds.'))
+    bbox = (0.0, 32.5, 0.25, 32.75)
+    client(server, tmp_path).elements(QUERY, bbox)
+    assert list((tmp_path / 'cache').glob('*/*.json.gz')) == []
+
+    server.respond = overpass()
+    again = client(server, tmp_path)
+    assert sorted(again.elements(QUERY, bbox)) == [('way', 3)]
+    assert (again.request_count, again.cache_hits) == (1, 0)
+    assert len(list((tmp_path / 'cache').glob('*/*.json.gz'))) == 1
@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+from OSM_Wikidata.profiling import NULL_STAGE, Profiler, describe
+
+
+def test_disabled_profiler_records_nothing():
+    logged = []
+    profiler = Profiler(log=logged.append)
+    assert profiler.stage('cleanup') is NULL_STAGE
+    with profiler.stage('cleanup') as stage:
+        stage.count(10)
+
+    @profiler.profiled()
+    def work():
+        return 42
+
+    assert work() == 42
+    assert profiler.records == [] and logged == []
+
+
+def test_stages():
+    logged = []
+    profiler = Profiler(enabled=True, log=logged.append)
+    with profiler.stage('layer scan', 'schools', 100):
+        pass
+    with profiler.stage('cleanup', 'schools') as stage:
+        stage.count(60)
+        stage.count(40)
+    with pytest.raises(ValueError):
+        with profiler.stage('cleanup', 'schools'):
+            raise ValueError
+
+    @profiler.profiled('rule compile')
+    def compile_rules():
+        return 'compiled'
+
+    assert compile_rules() == 'compiled'
+    assert [(record['stage'], record['features'], record['failed']) for record in profiler.records] == [
+        ('layer scan', 100, False), ('cleanup', 100, False), ('cleanup', None, True), ('rule compile', None, False)]
+    assert all(record['memory_delta'] is None for record in profiler.records)
+    assert logged[0].startswith('Stage "layer scan" (schools): ')
+    assert logged[2].endswith(', failed')
+
+    summary = profiler.summary()
+    assert summary['cleanup']['calls'] == 2
+    assert summary['cleanup']['features'] == 100
+    assert summary['cleanup']['longest'] <= summary['cleanup']['seconds']
+    assert summary['rule compile']['features'] is None
+    assert [line.split(':')[0] for line in profiler.summary_lines()] == sorted(
+        summary, key=lambda name: -summary[name]['seconds'])
+
+
+def test_describe():
+    record = {'stage': 'cleanup', 'detail': None, 'seconds': 0.5, 'features': 1000, 'memory_delta': 3 * 2 ** 20,
+              'failed': False}
+    assert describe(record) == 'Stage "cleanup": 500.0 ms, 1000 features (2000/s), +3.0 MB'
+
+
+def test_memory_and_json(tmp_path):
+    profiler = Profiler(enabled=True, memory=True)
+    try:
+        with profiler.stage('build'):
+            data = [bytes(1000) for _ in range(1000)]
+    finally:
+        profiler.disable()
+    assert data and profiler.records[0]['memory_delta'] > 500000
+
+    path = tmp_path / 'profile.json'
+    profiler.to_json(path)
+    with open(path, encoding='utf-8') as handle:
+        written = json.load(handle)
+    assert written['records'] == profiler.records
+    assert written['summary']['build']['calls'] == 1
+
+    profiler.reset()
+    assert profiler.records == [] and profiler.summary() == {}
@@ -0,0 +1,37 @@
+from OSM_Wikidata.property_search import EXACT_ID, FUZZY, LABEL_PREFIX, PropertySearchIndex, SearchIndexJob
+
+
+class Catalog:
+    def entries(self):
+        yield 'P31', 'instance of', 'that class of which this subject is a particular example', ['is a']
+        yield 'P137', 'operator', 'person or organization that operates the item', ['operated by']
+        yield 'P1082', 'population', 'number of people inhabiting the place', []
+
+
+class Task:
+    def setProgress(self, percentage):
+        pass
+
+    def isCancelled(self):
+        return False
+
+
+def test_ranks():
+    index = PropertySearchIndex.from_catalog(Catalog())
+    assert index.search('P31') == [(EXACT_ID, 0)]
+    assert index.search('operat')[0] == (LABEL_PREFIX, 1)
+    assert index.search_ids('poplation') == ['P1082']
+    assert index.search('poplation')[0][0] == FUZZY
+
+
+def test_built_ahead_of_the_first_search():
+    index = PropertySearchIndex.from_catalog(Catalog())
+    assert index._sorted and index._trigrams
+
+
+def test_search_index_job():
+    delivered = []
+    job = SearchIndexJob(Catalog(), delivered.append)
+    assert job.run(Task())
+    job.finished(True)
+    assert delivered == [job.index] and len(job.index) == 3
@@ -0,0 +1,75 @@
+import time
+
+from OSM_Wikidata.cleanup_engine import CleanupRule
+from OSM_Wikidata.regex_guard import GuardedCleanupEngine, GuardedCleanupProcess
+
+BUDGET = 0.01
+
+
+def slowed(engine, position, slow_calls):
+    """Makes the rule at position take twice the budget on the calls whose number is in slow_calls"""
+    original_plan = engine._plan
+    calls = []
+
+    def plan(mask):
+        steps = []
+        for step_position, substitute, template in original_plan(mask):
+            if step_position == position:
+                def substitute(template, name, substitute=substitute):
+                    calls.append(name)
+                    if len(calls) in slow_calls:
+                        time.sleep(2 * BUDGET)
+                    return substitute(template, name)
+            steps.append((step_position, substitute, template))
+        steps = engine._plans[mask] = tuple(steps)
+        return steps
+
+    engine._plan = plan
+    engine._plans.clear()
+    return calls
+
+
+def make_engine():
+    return GuardedCleanupEngine([CleanupRule('Saint ', r'^St\.?\s'), CleanupRule('Primary School', r'\bP/S\b')],
+                                BUDGET)
+
+
+def test_single_stall_is_not_an_overrun():
+    engine = make_engine()
+    slowed(engine, 0, {1})
+    guard = engine.guard()
+    assert guard.clean('St Mary P/S') == 'Saint Mary Primary School'
+    assert not guard.quarantined and not guard.overrun_counts
+
+
+def test_repeated_overruns_quarantine_for_the_job_only():
+    engine = make_engine()
+    slowed(engine, 0, set(range(1, 100)))
+    guard = engine.guard()
+    names = ['St Mary P/S', 'St Jude P/S', 'St Paul P/S', 'St Mark P/S']
+    cleaned = list(guard.clean_many(names))
+    # every overrun is confirmed on the same name, the third one quarantines the rule
+    assert cleaned[:2] == ['Saint Mary Primary School', 'Saint Jude Primary School']
+    assert cleaned[2:] == ['St Paul Primary School', 'St Mark Primary School']
+    assert list(guard.quarantined) == [0]
+    assert 'quarantined' in guard.report()[0]
+    # the shared engine and the next job keep the rule
+    assert engine.guard().allowed == 0b11
+    assert engine.clean('St Luke P/S') == 'Saint Luke Primary School'
+
+
+def test_suspect_rule_is_quarantined_on_its_first_overrun():
+    engine = GuardedCleanupEngine([CleanupRule('x', r'(a+)+b')], BUDGET)
+    assert engine.suspects == {0}
+    slowed(engine, 0, {1, 2})
+    guard = engine.guard()
+    assert guard.clean('aab') == 'aab'
+    assert list(guard.quarantined) == [0]
+
+
+def test_process_quarantines_a_rule_that_hangs():
+    rules = [CleanupRule('x', r'^(a|aa)+$'), CleanupRule('Saint ', r'^St\.?\s')]
+    with GuardedCleanupProcess(rules, hard_time_budget=0.5) as guarded:
+        cleaned = list(guarded.clean_many(['St Mary', 'a' * 40 + 'b', 'St Jude']))
+    assert cleaned == ['Saint Mary', 'a' * 40 + 'b', 'Saint Jude']
+    assert list(guarded.quarantined) == [0]
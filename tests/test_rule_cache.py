@@ -0,0 +1,90 @@
+import json
+import re
+import shutil
+
+import pytest
+
+from OSM_Wikidata.cleanup_engine import CLEANUP_FILE
+from OSM_Wikidata.rule_cache import load_rules, save_rules
+
+
+@pytest.fixture
+def cleanup_file(tmp_path):
+    return shutil.copy(CLEANUP_FILE, tmp_path / 'cleanup.json')
+
+
+def position_of(rules, replacement):
+    return next(number for number, pattern in enumerate(rules.cleanup_patterns) if pattern[0] == replacement)
+
+
+def test_edits_of_a_copy_leave_the_rules_as_they_are(cleanup_file, tmp_path):
+    rules = load_rules(cleanup_file, tmp_path / 'rules.cache')
+    engine = rules.cleanup_engine
+    edited = rules.copy()
+    edited.edit_cleanup_rule(position_of(rules, 'Michael'), 'Michael', 'Mich[ae]+l', 0)
+    assert rules.cleanup_engine is engine
+    assert rules.cleanup_engine.clean('St Michael') == 'Saint Michael'
+    assert edited.cleanup_engine.clean('Michel') == 'Michael'
+    assert rules.cleanup_engine.clean('Michel') == 'Michel'
+
+
+def test_save_rules(cleanup_file, tmp_path):
+    cache_file = tmp_path / 'rules.cache'
+    rules = load_rules(cleanup_file, cache_file)
+    position = position_of(rules, 'Michael')
+    contents = ['Mich[ae]+l  # Michel', '            # and Micheal']
+    saved = save_rules(rules, {position: ('Michael', contents)}, cleanup_file, cache_file)
+    assert saved.cleanup_engine.clean('Michel') == 'Michael'
+    assert rules.cleanup_engine.clean('Michel') == 'Michel'
+
+    with open(cleanup_file, encoding='utf-8') as handle:
+        data = json.load(handle)
+    assert data['cleanup']['name'][position] == {'Michael': contents}
+    # string rules keep their shape
+    assert data['cleanup']['name'][-2] == {
+        ' Nursery and Primary School': '(?uxi)\\sN(ur|ursery)*/\\s*Pr*(im|imary)*'}
+
+    loaded = load_rules(cleanup_file, cache_file)
+    assert loaded.cached
+    assert loaded.cleanup_engine.clean('Michel') == 'Michael'
+
+
+def test_nothing_is_saved_when_a_rule_does_not_compile(cleanup_file, tmp_path):
+    cache_file = tmp_path / 'rules.cache'
+    rules = load_rules(cleanup_file, cache_file)
+    before = open(cleanup_file, 'rb').read()
+    with pytest.raises(re.error):
+        save_rules(rules, {position_of(rules, 'Michael'): ('Michael', 'Mich(')}, cleanup_file, cache_file)
+    assert open(cleanup_file, 'rb').read() == before
+
+
+def test_save_rules_keeps_the_layout(cleanup_file, tmp_path):
+    rules = load_rules(cleanup_file, tmp_path / 'rules.cache')
+    with open(cleanup_file, encoding='utf-8') as handle:
+        before = handle.read().splitlines()
+    adventist = rules.data['cleanup']['name'][position_of(rules, 'Seventh-day Adventist')]
+    lines = list(adventist['Seventh-day Adventist'])
+    lines[1] = '[Ss](eventh|vth)*   # Seventh, could be abbreviated'
+    save_rules(rules, {position_of(rules, 'Michael'): ('Michael', ['Mich[ae]+l']),
+                       position_of(rules, 'Seventh-day Adventist'): ('Seventh-day Adventist', lines)},
+               cleanup_file, tmp_path / 'rules.cache')
+    with open(cleanup_file, encoding='utf-8') as handle:
+        after = handle.read().splitlines()
+    changed = [(old, new) for old, new in zip(before, after) if old != new]
+    assert len(before) == len(after)
+    assert changed == [
+        ('      {"Michael": ["Micheal"]},', '      {"Michael": ["Mich[ae]+l"]},'),
+        ('       "[Ss](eventh)*   # Seventh, could be abbreviated",',
+         '       "[Ss](eventh|vth)*   # Seventh, could be abbreviated",'),
+    ]
+
+
+def test_saving_the_second_of_two_rules_with_the_same_replacement(cleanup_file, tmp_path):
+    rules = load_rules(cleanup_file, tmp_path / 'rules.cache')
+    first = position_of(rules, 'Saint ')
+    assert rules.cleanup_patterns[first + 1][0] == 'Saint '
+    save_rules(rules, {first + 1: ('Saint ', ['^S[tT][\\.\\s]*'])}, cleanup_file, tmp_path / 'rules.cache')
+    with open(cleanup_file, encoding='utf-8') as handle:
+        data = json.load(handle)
+    assert data['cleanup']['name'][first] == {'Saint ': ['^Saintt*\\s']}
+    assert data['cleanup']['name'][first + 1] == {'Saint ': ['^S[tT][\\.\\s]*']}
@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from OSM_Wikidata.spatial_matcher import SpatialMatcher, haversine
+
+RADIUS = 500
+
+
+def brute_force(candidates, features, radius=RADIUS):
+    """Every (feature, candidate) pair within the radius, by comparing all of them"""
+    distances = haversine(np.array([feature[2] for feature in features]),
+                          np.array([feature[3] for feature in features]),
+                          np.array([candidate[2] for candidate in candidates]),
+                          np.array([candidate[3] for candidate in candidates]))
+    return {(features[number][0], candidates[other][0]): distances[number, other]
+            for number, other in zip(*np.nonzero(distances <= radius))}
+
+
+def matched(matcher, features):
+    return {(key, candidate_id): meters for key, found in matcher.match(features).items()
+            for candidate_id, meters, score in found}
+
+
+def clustered(generator, count, longitude, latitude, spread):
+    """Points around a place, spread in degrees, longitudes wrapped around the antimeridian"""
+    points = []
+    for number in range(count):
+        point_longitude = longitude + generator.uniform(-spread, spread) / max(np.cos(np.radians(latitude)), 0.05)
+        point_latitude = min(max(latitude + generator.uniform(-spread, spread), -89.9), 89.9)
+        points.append(((point_longitude + 540) % 360 - 180, point_latitude))
+    return points
+
+
+@pytest.mark.parametrize('longitude, latitude', [
+    (32.58, 0.31),      # Kampala, on the equator
+    (32.58, -0.005),    # rows on either side of the equator
+    (18.95, 69.65),     # Tromsø
+    (15.6, 78.2),       # Longyearbyen
+    (-62.3, 82.5),      # Alert, where a column is many times as wide as a row is high
+    (179.999, -16.5),   # Fiji, across the antimeridian
+    (-179.999, 65.0),   # Chukotka, across the antimeridian far north
+])
+def test_same_as_brute_force(longitude, latitude):
+    generator = random.Random('{},{}'.format(longitude, latitude))
+    candidates = [('Q{}'.format(number), 'school', point_longitude, point_latitude) for number, (
+        point_longitude, point_latitude) in enumerate(clustered(generator, 300, longitude, latitude, 0.03))]
+    features = [(number, 'school', point_longitude, point_latitude) for number, (
+        point_longitude, point_latitude) in enumerate(clustered(generator, 300, longitude, latitude, 0.03))]
+    matcher = SpatialMatcher(radius=RADIUS, limit=len(candidates))
+    matcher.add_candidates(candidates)
+    expected = brute_force(candidates, features)
+    assert expected, 'the points should be close enough to find some matches'
+    found = matched(matcher, features)
+    assert found.keys() == expected.keys()
+    for pair, meters in expected.items():
+        assert found[pair] == pytest.approx(meters)
+
+
+def test_cell_boundaries():
+    matcher = SpatialMatcher(radius=RADIUS, limit=10)
+    row_height = matcher.row_height
+    # a candidate just above a row boundary, features just below it and in the next columns
+    candidates = [('Q1', 'a', 10.0, 20 * row_height + 1e-7)]
+    features = [(number, 'a', 10.0 + offset, 20 * row_height - 1e-7)
+                for number, offset in enumerate([0.0, 0.002, 0.004, -0.004, 0.0049])]
+    matcher.add_candidates(candidates)
+    assert matched(matcher, features).keys() == brute_force(candidates, features).keys()
+
+
+def test_scores():
+    matcher = SpatialMatcher(radius=RADIUS)
+    matcher.add_candidates([('Q1', 'Mengo Primary School', 32.5600, 0.3000),
+                            ('Q2', 'Kampala Parents School', 32.5601, 0.3000),
+                            ('Q3', 'Far away school', 32.6, 0.3)])
+    found = matcher.match([('f', 'Mengo Primary School', 32.5601, 0.3000)])['f']
+    assert [candidate_id for candidate_id, meters, score in found] == ['Q1', 'Q2']
+    assert found[0][2] > found[1][2]
@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from OSM_Wikidata.cleanup_engine import load_cleanup_data
+from OSM_Wikidata.entity_store import EntityStore
+from OSM_Wikidata.statement_writer import ApiSession, StatementWriter, load_statements
+
+UBOS_REFERENCE = [{'snaks': {'P248': [{'snaktype': 'value', 'property': 'P248', 'datavalue': {
+    'value': {'entity-type': 'item', 'numeric-id': 22679902, 'id': 'Q22679902'}, 'type': 'wikibase-entityid'}}]}}]
+
+# what every statement of cleanup.json has to put on an item
+EXPECTED = {
+    'country Uganda statement': ('P17', 'Q1036'),
+    'primary school statement': ('P31', 'Q9842'),
+    'nursery school statement': ('P31', 'Q1076052'),
+    'secondary school statement': ('P31', 'Q159334'),
+    'school statement': ('P31', 'Q3914'),
+    'church Of Uganda statement': ('P137', 'Q1723759'),
+    'seventh Day Adventist statement': ('P137', 'Q104319'),
+}
+
+
+class Catalog:
+    def entries(self):
+        yield 'P17', 'country', 'sovereign state of this item', []
+        yield 'P137', 'operator', 'person or organization that operates the item', ['operated by']
+
+
+def wikidata(parameters):
+    if parameters['action'] == 'query':
+        return {'query': {'tokens': {'logintoken': 'login+\\', 'csrftoken': 'csrf+\\'}}}
+    if parameters['action'] == 'login':
+        return {'login': {'result': 'Success'}}
+    if parameters['action'] == 'wbgetentities':
+        return {'entities': {entity_id: {'id': entity_id, 'lastrevid': 1, 'labels': {}, 'claims': {}, 'sitelinks': {}}
+                             for entity_id in parameters['ids'].split('|')}}
+    if parameters['action'] == 'wbeditentity':
+        return {'success': 1, 'entity': {'id': parameters['id'], 'lastrevid': 2}}
+    return {'error': {'code': 'badvalue'}}
+
+
+def test_payload_for_every_statement(stub_server, tmp_path):
+    server = stub_server(wikidata)
+    statements = load_statements(load_cleanup_data())
+    assert sorted(statement.label for statement in statements.values()) == sorted(EXPECTED)
+    items = {'Q{}'.format(number): [statement] for number, statement in enumerate(statements.values(), 100)}
+    writer = StatementWriter(ApiSession('bot', 'secret', api_url=server.url),
+                             EntityStore(tmp_path / 'entities.sqlite', api_url=server.url),
+                             journal_file=tmp_path / 'journal.jsonl')
+    assert writer.write(items) == {'done': 7, 'skipped': 0, 'failed': 0}
+
+    edits = [request for request in server.requests if request['action'] == 'wbeditentity']
+    assert len(edits) == 7
+    for request in edits:
+        label = items[request['id']][0].label
+        wd_property, value = EXPECTED[label]
+        assert json.loads(request['data']) == {'claims': [{
+            'mainsnak': {'snaktype': 'value', 'property': wd_property, 'datavalue': {
+                'value': {'entity-type': 'item', 'numeric-id': int(value[1:]), 'id': value},
+                'type': 'wikibase-entityid'}},
+            'type': 'statement', 'rank': 'normal', 'references': UBOS_REFERENCE}]}, label
+        assert request['baserevid'] == '1'
+        assert request['token'] == 'csrf+\\'
+
+
+def test_property_by_catalog_label():
+    data = {'Wikidata statements': {'operator statement': ['operator', 'Q1723759', []]}}
+    assert load_statements(data, Catalog())['operator'].wd_property == 'P137'
+
+
+def test_unresolved_property_is_rejected():
+    # a property is never guessed from the label of the statement
+    data = {'Wikidata properties': {'operated by': 'P137'},
+            'Wikidata statements': {'church Of Uganda statement': ['Q1723759', []]}}
+    with pytest.raises(ValueError, match='church Of Uganda'):
+        load_statements(data)
+    data['Wikidata statements'] = {'church Of Uganda statement': ['operated', 'Q1723759', []]}
+    with pytest.raises(ValueError, match='no property called "operated"'):
+        load_statements(data, Catalog())
@@ -0,0 +1,140 @@
+import threading
+import time
+
+from OSM_Wikidata.task_scheduler import ChunkScheduler
+
+
+class Task:
+    """What PerformQueriesTask hands the scheduler"""
+    def __init__(self, cancel_after=None):
+        self.progress = []
+        self.cancel_after = cancel_after
+        self.cancelled = False
+        self.delivered = []
+
+    def setProgress(self, percentage):
+        self.progress.append(percentage)
+
+    def isCancelled(self):
+        return self.cancelled
+
+    def deliver(self, job, result):
+        self.delivered.append((job, result))
+        if self.cancel_after is not None and len(self.delivered) >= self.cancel_after:
+            self.cancelled = True
+
+
+class PlainJob:
+    def __init__(self, completes=True):
+        self.completes = completes
+        self.ran = False
+
+    def run(self, task):
+        self.ran = True
+        task.setProgress(50)
+        return self.completes
+
+
+class ChunkedJob:
+    """Chunk n takes longer the lower n is, so the chunks finish in reverse"""
+    def __init__(self, count, parallel=True):
+        self.count = count
+        self.parallel = parallel
+        self.ran = []
+        self.collected = []
+        self.lock = threading.Lock()
+        self.running = 0
+        self.most_running = 0
+
+    def chunks(self):
+        return list(range(self.count))
+
+    def run_chunk(self, chunk, task):
+        with self.lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        time.sleep(0.005 * (self.count - chunk))
+        with self.lock:
+            self.running -= 1
+            self.ran.append(chunk)
+        return chunk * 10
+
+    def collect(self, chunk, result):
+        self.collected.append((chunk, result))
+
+    def chunk_finished(self, result):
+        """Only there so the results get delivered, PerformQueriesTask calls it"""
+
+
+class StreamedJob(ChunkedJob):
+    def chunks(self):
+        for chunk in range(self.count):
+            self.read = chunk + 1
+            yield chunk
+
+    def chunk_count(self):
+        return self.count
+
+
+def scheduler(task, max_parallel=4):
+    return ChunkScheduler(task.setProgress, task.isCancelled, task.deliver, max_parallel)
+
+
+def test_plain_jobs_share_the_progress():
+    task = Task()
+    jobs = [PlainJob(), PlainJob()]
+    assert scheduler(task).run(jobs)
+    assert task.progress == [25.0, 75.0, 100.0]
+
+
+def test_a_job_that_does_not_complete_stops_the_rest():
+    task = Task()
+    jobs = [PlainJob(completes=False), PlainJob()]
+    assert not scheduler(task).run(jobs)
+    assert not jobs[1].ran
+
+
+def test_results_in_the_order_of_the_chunks():
+    task = Task()
+    job = ChunkedJob(8)
+    assert scheduler(task, max_parallel=4).run([job])
+    assert job.ran != sorted(job.ran)
+    assert job.collected == [(chunk, chunk * 10) for chunk in range(8)]
+    assert task.delivered == [(job, chunk * 10) for chunk in range(8)]
+    assert 1 < job.most_running <= 4
+    assert task.progress[-1] == 100.0
+
+
+def test_a_job_that_is_not_parallel_runs_one_chunk_at_a_time():
+    task = Task()
+    job = ChunkedJob(5, parallel=False)
+    assert scheduler(task, max_parallel=4).run([job])
+    assert job.ran == list(range(5))
+    assert job.most_running == 1
+    assert task.progress == [20.0, 40.0, 60.0, 80.0, 100.0, 100.0]
+
+
+def test_cancel_stops_submitting_chunks():
+    task = Task(cancel_after=1)
+    job = ChunkedJob(20)
+    assert not scheduler(task, max_parallel=2).run([job])
+    # the chunks that were running when the task got cancelled still finish, no new ones start
+    assert len(job.ran) <= 3
+    assert [chunk for chunk, result in job.collected] == list(range(len(job.collected)))
+
+
+def test_streamed_chunks_are_read_as_they_are_needed():
+    task = Task(cancel_after=2)
+    job = StreamedJob(10, parallel=False)
+    assert not scheduler(task).run([job])
+    assert job.ran == [0, 1]
+    assert job.read == 3
+    assert task.progress == [10.0, 20.0]
+
+
+def test_without_deliver():
+    task = Task()
+    job = ChunkedJob(3)
+    assert ChunkScheduler(task.setProgress, task.isCancelled).run([job])
+    assert job.collected == [(0, 0), (1, 10), (2, 20)]
+    assert task.delivered == []